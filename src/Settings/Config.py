@@ -27,10 +27,13 @@ last_update_check = 0
 [Providers]
 languages_order = []
 providers_order = ['www.torec.net', 'www.subscenter.org', 'www.subtitle.co.il', 'www.opensubtitles.org', 'www.addic7ed.com']
+providers_max_in_flight = {'www.torec.net' : 1, 'www.subscenter.org' : 2, 'www.opensubtitles.org' : 4, 'www.addic7ed.com' : 1}
+providers_requests_per_second = {'www.addic7ed.com' : 1}
 
 [Flow]
 in_depth_search = True
 do_properties_based_rank = True
+prehash_workers = 4
 
 [Association]
 associate_extensions = False
@@ -144,6 +147,18 @@ class SubiTConfig(EasyConfig):
         WriteDebug('Value: %s.%s => %s' % (section, option, return_value))
         return return_value
     
+    def getDict(self, section, option, on_error_value = {}):
+        """ Return the config value as dict. """
+        return_value = on_error_value
+
+        WriteDebug('Retrieving: %s.%s as dict' % (section, option))        
+        try:    
+            return_value = self._get(section, option)
+        except: 
+            WriteDebug('Failure while trying to get value, using default')
+        WriteDebug('Value: %s.%s => %s' % (section, option, return_value))
+        return return_value
+
     def getList(self, section, option, on_error_value = []):
         """ Return the config value as list. """
         return_value = on_error_value
@@ -109,6 +109,21 @@ class SubFlow(object):
                     except Exception as eX:
                         WriteDebug("Failed to append sub_stage: %s" % eX)
 
+    def _get_movie_name_from_discovered_title(self):
+        """ Get the movie name from the title that was discovered for the
+            SingleInput beforehand (see SubInputs.discoverMovieFilesTitles). 
+            For episodes, the numbering is added to the name. Returns None if 
+            there is no such title.
+        """
+        title = self._single_input.title
+        if not title:
+            return None
+        from api.title import SeriesTitle
+        if isinstance(title, SeriesTitle) and title.got_numbering:
+            return '%s S%02dE%02d' % \
+                (title.name, title.season_number, title.episode_number)
+        return title.name
+
     def _get_movie_name_from_opensubtitles_global_sub_provider\
         (self, file_name, full_path):
         """ Get the movie name using hash query features, and also file name 
@@ -379,8 +394,11 @@ class SubFlow(object):
 
         # Second try, Certain chooser, OpenSubtitles query
         WriteDebug('Entering second try, using certain chooser, and opensubtitles query.')
-        os_query = self._get_movie_name_from_opensubtitles_global_sub_provider\
-            (self._single_input.query, self._single_input.full_path)
+        os_query = self._get_movie_name_from_discovered_title()
+        if not os_query:
+            os_query = \
+                self._get_movie_name_from_opensubtitles_global_sub_provider\
+                (self._single_input.query, self._single_input.full_path)
         if os_query:
             WriteDebug('OpenSubtitles succeeded, query: %s' % os_query)
             version_sub_stage = self._get_version_sub_stage\
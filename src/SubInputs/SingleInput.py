@@ -27,6 +27,9 @@ class SingleInput(object):
         self.directory = directory
         # The full path (optional) to the file.
         self.full_path = full_path
+        # The title (optional) of the file, if it was discovered beforehand.
+        # It's an instance of api.title's MovieTitle or SeriesTitle.
+        self.title = None
         # Finished working on the SingleInput instance? This value might be 
         # True even for Inputs that we didn't ended up with a subtitle.
         self.finisehd = False
@@ -2,6 +2,8 @@
     function acts as an iterator by yielding objects of SingleInput type.
 """
 import os
+from Queue import Queue
+from threading import Thread
 
 from SubInputs.SingleInput import SingleInput
 from SubInputs.SubInputsUtils import GetMovieFilesInDirectory
@@ -32,10 +34,92 @@ def getSingleInputsFromDirectories(directories, recursive = False):
         directories. If the recursive parameter is set to True, The function
         will return instances for files inside sub directories also. The 
         directories should have a full path.
+
+        The SingleInputs of each directory are yielded as soon as it's listed.
+        Meanwhile, their movie files are prehashed and their titles are 
+        discovered by another thread (see prepareSingleInputs).
+    """
+    if not directories:
+        return
+    preparation_queue = Queue()
+    preparer = Thread(target = prepareSingleInputs, args = (preparation_queue,))
+    preparer.daemon = True
+    preparer.start()
+    try:
+        for directory in directories:
+            single_inputs = \
+                list(getSingleInputsFromDirectory(directory, recursive))
+            preparation_queue.put(single_inputs)
+            for single_input in single_inputs:
+                yield single_input
+    finally:
+        # Lets the preparer know that there are no more SingleInputs.
+        preparation_queue.put(None)
+
+def prepareSingleInputs(preparation_queue):
+    """ Prepare the lists of SingleInputs that are taken from the given queue,
+        until None is taken: prehash their movie files, and discover their 
+        titles. The prehash of each list is finished before the next list is 
+        prepared, so the reads of each directory stay close together.
+    """
+    while True:
+        single_inputs = preparation_queue.get()
+        if single_inputs is None:
+            break
+        prehash_result = prehashMovieFiles(
+            [single_input.full_path for single_input in single_inputs])
+        discoverMovieFilesTitles(single_inputs)
+        if prehash_result:
+            prehash_result.wait()
+    WriteDebug('Finished preparing the SingleInputs.')
+
+def prehashMovieFiles(movie_files):
+    """ Start hashing the given movie files in the background (only those that
+        are missing a subtitle), so their hashes are already cached when the
+        SubFlow reaches them. The number of files that are read at the same 
+        time is taken from the config (Flow.prehash_workers), 0 disables it.
+        Returns an AsyncResult of the prehash (see api.filehash.prehash_files),
+        or None if it wasn't started.
+    """
+    from Settings.Config import SubiTConfig
+    prehash_workers = SubiTConfig.Singleton().getInt\
+        ('Flow', 'prehash_workers', 4)
+    if not prehash_workers or not movie_files:
+        return None
+    try:
+        from api.filehash import prehash_files
+        files_to_hash = [movie_file for movie_file in movie_files
+                         if IsMovieFile(movie_file) and
+                         not IsMovieFileGotSubtitle(movie_file)]
+        WriteDebug('Prehashing %s movie files.' % len(files_to_hash))
+        return prehash_files(files_to_hash, prehash_workers)
+    except Exception as eX:
+        WriteDebug('Failed starting the prehash of the movie files: %s' % eX)
+        return None
+
+def discoverMovieFilesTitles(single_inputs):
+    """ Discover the titles of the movie files of the given SingleInputs 
+        together, with as few requests to OpenSubtitles as possible. The title
+        of each SingleInput is set once it's discovered, so the SubFlow uses it
+        if it reaches the SingleInput after that.
     """
-    for directory in directories:
-        for single_input in getSingleInputsFromDirectory(directory, recursive):
-            yield single_input
+    files_inputs = dict((single_input.full_path, single_input)
+                        for single_input in single_inputs 
+                        if single_input.full_path)
+    if not files_inputs:
+        return
+    try:
+        from api.scheduling import RequestContext, Priorities
+        from api.titlediscovery import discover_titles_from_file_paths
+        WriteDebug('Discovering the titles of %s movie files.' % 
+                   len(files_inputs))
+        with RequestContext(Priorities.BATCH):
+            titles = discover_titles_from_file_paths(files_inputs.keys())
+        for movie_file, title in titles.iteritems():
+            if title:
+                files_inputs[movie_file].title = title
+    except Exception as eX:
+        WriteDebug('Failed discovering the titles of the movie files: %s' % eX)
 
 def getSingleInputsFromDirectory(directory, recursive = False):
     """ Get SingleInput instances for the movie files inside the given 
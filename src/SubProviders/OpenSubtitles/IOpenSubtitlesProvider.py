@@ -3,7 +3,6 @@ import Utils
 from xmlrpclib import Server as XmlRpcServer
 
 import os
-import struct
 from functools import reduce
 
 import SubiT
@@ -314,35 +313,12 @@ class IOpenSubtitlesProvider(ISubProvider):
     
     @staticmethod
     def HashFile( filepath ): 
+        # The hash is shared with the api's OpenSubtitles provider.
+        from api.filehash import calculate_file_hash
         try:  
-            longlongformat = 'q'  # long long 
-            bytesize = struct.calcsize(longlongformat) 
-                    
-            f = open(filepath, "rb") 
-                
-            filesize = os.path.getsize(filepath) 
-            hash = filesize 
-                
-            if filesize < 65536 * 2: 
-                   return "SizeError" 
-
-            for x in range(65536/bytesize): 
-                    buffer = f.read(bytesize) 
-                    (l_value,)= struct.unpack(longlongformat, buffer)  
-                    hash += l_value 
-                    hash = hash & 0xFFFFFFFFFFFFFFFF #to remain as 64bit number  
-                     
-
-            f.seek(max(0,filesize-65536),0) 
-            for x in range(65536/bytesize): 
-                    buffer = f.read(bytesize) 
-                    (l_value,)= struct.unpack(longlongformat, buffer)  
-                    hash += l_value 
-                    hash = hash & 0xFFFFFFFFFFFFFFFF 
-
-            f.close() 
-            returnedhash =  "%016x" % hash 
-            return returnedhash 
+            return calculate_file_hash(filepath)[0]
+        except BufferError:
+            return "SizeError"
         except:
             WriteDebug('Failed calculating hash, returning null')
             return ''
\ No newline at end of file
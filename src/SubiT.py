@@ -103,6 +103,63 @@ class SubiTWorkerThread(Thread):
         else:
             self.number_of_failures += 1
 
+    def _dump_requests_metrics(self):
+        """ Will write the metrics of the API's requests (if any request was 
+            sent) as JSON, to a file in the program's directory.
+        """
+        try:
+            import os
+            from api.requestsmanager import get_metrics, dump_metrics
+            if not get_metrics():
+                return
+            metrics_path = os.path.join(GetProgramDir(), 'requests_metrics.json')
+            WriteDebug('Writing requests metrics to: %s' % metrics_path)
+            dump_metrics(metrics_path)
+        except Exception as eX:
+            WriteDebug('Failed writing requests metrics: %s' % eX)
+
+    def _close_requests_managers(self):
+        """ Will stop the threads that obtain Torec's tickets, and close the
+            API's requests managers (with their sessions and worker threads).
+            Should be called once the work against the providers is finished.
+        """
+        try:
+            from api.providers.torec.hamster import stop_all_hamsters
+            from api.requestsmanager import close_all_managers
+            WriteDebug('Closing the requests managers.')
+            # The hamsters use the managers, so they are stopped first.
+            stop_all_hamsters()
+            close_all_managers()
+        except Exception as eX:
+            WriteDebug('Failed closing the requests managers: %s' % eX)
+
+    def _configure_requests_managers(self):
+        """ Will apply the concurrency limits of each provider, taken from the
+            config (Providers.providers_max_in_flight and 
+            Providers.providers_requests_per_second, both are dicts of the 
+            provider's full name => value), to the API's requests managers.
+        """
+        try:
+            from api.requestsmanager import configure_manager
+            config = SubiTConfig.Singleton()
+            max_in_flight = config.getDict\
+                ('Providers', 'providers_max_in_flight', {})
+            requests_per_second = config.getDict\
+                ('Providers', 'providers_requests_per_second', {})
+            for provider_name in set(max_in_flight) | set(requests_per_second):
+                settings = {}
+                if provider_name in max_in_flight:
+                    settings['max_in_flight'] = \
+                        int(max_in_flight[provider_name])
+                if provider_name in requests_per_second:
+                    settings['requests_per_second'] = \
+                        float(requests_per_second[provider_name])
+                WriteDebug('Configuring requests manager of %s: %s' % 
+                           (provider_name, settings))
+                configure_manager(provider_name, **settings)
+        except Exception as eX:
+            WriteDebug('Failed configuring the requests managers: %s' % eX)
+
     def _put_user_single_input_in_queue(self):
         query = getInteractor().getSearchInput\
             (DIRC_LOGS.INSERT_MOVIE_NAME_FOR_QUERY)
@@ -133,6 +190,8 @@ class SubiTWorkerThread(Thread):
         # We are checking for update in each program's load.
         self.doUpdateCheck()
 
+        self._configure_requests_managers()
+
         # Now we are ready for the real work.
         from SubFlow import SubFlow
         close_on_finish = SubiTConfig.Singleton().getBoolean\
@@ -174,6 +233,8 @@ class SubiTWorkerThread(Thread):
 
         WriteDebug('Successful downloads: %s' % self.number_of_success)
         WriteDebug('Failed downloads: %s' % self.number_of_failures)
+        self._dump_requests_metrics()
+        self._close_requests_managers()
         # Finish up.
         writeLog(FINISH_LOGS.FINISHED)
         writeLog(FINISH_LOGS.APPLICATION_WILL_NOW_EXIT)                
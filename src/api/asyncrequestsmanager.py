@@ -0,0 +1,135 @@
+import logging
+logger = logging.getLogger("subit.api.asyncrequestsmanager")
+from threading import Lock
+from multiprocessing.dummy import Pool as ThreadPool
+
+from exceptions import RequestsManagerClosed
+from scheduling import get_current_context
+
+
+__all__ = ['AsyncRequestsManager']
+
+
+class AsyncRequestsManager(object):
+    """
+    A non-blocking front for a RequestsManager (or for the
+    OpenSubtitlesRequestsManager). It has the same surface as the manager it
+    wraps: perform_request, perform_request_next, perform_request_text,
+    download_file and the xml-rpc methods, but instead of blocking, each call
+    returns an AsyncResult (see multiprocessing.pool) right away. The caller
+    can use the result's get(), wait() and ready() methods, or pass a callback
+    that is called with the response once it arrives.
+
+    The calls are executed by a pool of worker threads that belongs to the
+    provider, and that has as many workers as the provider's max_in_flight
+    setting. So, a single thread can issue the requests of hundreds of inputs,
+    while the number of threads stays bounded by the providers' limits. The
+    requests are still admitted by the wrapped manager, so the async and the
+    blocking callers of the same provider share its concurrency and rate
+    limits.
+
+    >>> from api.requestsmanager import RequestsManager
+    >>> AsyncRequestsManager(RequestsManager(max_in_flight = 3))
+    <AsyncRequestsManager manager=<RequestsManager>, workers=3>
+    """
+    def __init__(self, requests_manager):
+        self.requests_manager = requests_manager
+        self._lock = Lock()
+        self._workers = 0
+        self._pool = None
+        self._ensure_pool()
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        return ("<AsyncRequestsManager manager=%s, workers=%d>" %
+            (self.requests_manager, self._workers))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _ensure_pool(self):
+        """
+        Makes sure that the pool has a worker for each in-flight slot of the
+        manager. If max_in_flight grew, the pool is replaced with a bigger one,
+        and the previous pool finishes its pending calls in the background.
+        """
+        max_in_flight = self.requests_manager.settings['max_in_flight']
+        with self._lock:
+            if self._pool and self._workers >= max_in_flight:
+                return self._pool
+            logger.debug("Creating a pool of %d workers." % max_in_flight)
+            old_pool = self._pool
+            self._pool = ThreadPool(max_in_flight)
+            self._workers = max_in_flight
+            if old_pool:
+                old_pool.close()
+            return self._pool
+
+    def _submit(self, func, args, kwargs):
+        callback = kwargs.pop('callback', None)
+        if self.requests_manager.closed:
+            raise RequestsManagerClosed("The requests manager is closed.")
+        # The call is executed by a worker, so we pass it the RequestContext of
+        # the caller (with its priority and cancellation).
+        return self._ensure_pool().apply_async(_call_in_context, 
+            (get_current_context(), func, args, kwargs), callback = callback)
+
+    def configure(self, **settings):
+        """ Configures the wrapped manager, see RequestsManager.configure. """
+        self.requests_manager.configure(**settings)
+        self._ensure_pool()
+
+    def perform_request(self, *args, **kwargs):
+        return self._submit(
+            self.requests_manager.perform_request, args, kwargs)
+
+    def perform_request_next(self, *args, **kwargs):
+        return self._submit(
+            self.requests_manager.perform_request_next, args, kwargs)
+
+    def perform_request_text(self, *args, **kwargs):
+        return self._submit(
+            self.requests_manager.perform_request_text, args, kwargs)
+
+    def download_file(self, *args, **kwargs):
+        return self._submit(
+            self.requests_manager.download_file, args, kwargs)
+
+    def __getattr__(self, name):
+        """
+        Any other attribute is taken from the wrapped manager. Methods (e.g.,
+        the xml-rpc methods of OpenSubtitles) are wrapped so they return an
+        AsyncResult as well.
+        """
+        if name.startswith('_'):
+            raise AttributeError(name)
+        attr = getattr(self.requests_manager, name)
+        if not callable(attr):
+            return attr
+        def func_exec(*args, **kwargs):
+            return self._submit(attr, args, kwargs)
+        return func_exec
+
+    def close(self):
+        """
+        Closes the wrapped manager, and stops the workers. Calls that didn't
+        start yet fail with RequestsManagerClosed.
+        """
+        with self._lock:
+            if self._pool:
+                self._pool.close()
+        self.requests_manager.close()
+
+    @property
+    def closed(self):
+        return self.requests_manager.closed
+
+
+def _call_in_context(context, func, args, kwargs):
+    with context:
+        return func(*args, **kwargs)
@@ -0,0 +1,112 @@
+import logging
+logger = logging.getLogger("subit.api.discoverysession")
+import os
+from threading import Lock
+from collections import OrderedDict
+
+
+__all__ = ['DiscoverySession', 'get_discovery_session']
+
+
+# The number of sessions that are kept by get_discovery_session.
+MAX_SESSIONS = 64
+
+
+class DiscoverySession(object):
+    """
+    Holds what OpenSubtitles knows about a single file, so the title discovery
+    and the identifiers extraction of the same input share the server's
+    answers instead of querying it separately.
+
+    The file is hashed once, and a single SearchSubtitles call with the hash
+    is used for both the title (the imdb id, the kind and the parent series)
+    and the release name of the file. Only if the results of that call don't
+    lead to a title, the title is queried by the hash with CheckMovieHash2 (and
+    GetIMDBMovieDetails). The session is thread safe.
+
+    >>> DiscoverySession("movie.mkv", None)
+    <DiscoverySession file_path='movie.mkv', file_hash='None'>
+    """
+    def __init__(self, file_path, os_provider):
+        self.file_path = file_path
+        self.os_provider = os_provider
+        self.file_hash = None
+        self.file_size = None
+        self._lock = Lock()
+        self._searched = False
+        self._title = None
+        self._release_name = None
+        self._title_fallback_done = False
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        return "<DiscoverySession file_path='%s', file_hash='%s'>" % (
+            self.file_path, self.file_hash)
+
+    def _search(self):
+        """ Must be called while holding the lock. """
+        if self._searched:
+            return
+        self._searched = True
+        self.file_hash, self.file_size = \
+            self.os_provider.calculate_file_hash(self.file_path)
+        if not self.file_hash:
+            return
+        self._title, self._release_name = \
+            self.os_provider.get_title_and_release_name_by_hash(
+                self.file_hash, self.file_size)
+        logger.debug("Search by hash resulted in title: %s, release: %s",
+            self._title, self._release_name)
+
+    def get_title(self):
+        """ Returns the title of the file, or None if it's unknown. """
+        with self._lock:
+            self._search()
+            if not self._title and self.file_hash and \
+                not self._title_fallback_done:
+                self._title_fallback_done = True
+                self._title = self.os_provider.get_title_by_hash(
+                    self.file_hash, self.file_size)
+                logger.debug("Title by hash is: %s", self._title)
+            return self._title
+
+    def get_release_name(self):
+        """ Returns the release name of the file, or None if it's unknown. """
+        with self._lock:
+            self._search()
+            return self._release_name
+
+
+_sessions_lock = Lock()
+# (file path, size, mtime) => DiscoverySession, from the least recently used.
+_sessions = OrderedDict()
+
+def get_discovery_session(file_path, os_provider):
+    """
+    Returns the DiscoverySession of the file. The same session is returned for
+    the same file (as long as it didn't change, and the provider uses the same
+    requests manager), so all the lookups of a single input share it. The last
+    MAX_SESSIONS sessions are kept.
+    """
+    try:
+        stat = os.stat(file_path)
+        key = (os.path.normcase(os.path.abspath(file_path)), stat.st_size,
+               stat.st_mtime)
+    except OSError:
+        # The hash will fail as well, unless the provider doesn't need the file.
+        key = (os.path.normcase(os.path.abspath(file_path)), None, None)
+    with _sessions_lock:
+        session = _sessions.pop(key, None)
+        # A provider with another requests manager might get other answers.
+        if not session or (_get_requests_manager(session.os_provider) is not
+                           _get_requests_manager(os_provider)):
+            session = DiscoverySession(file_path, os_provider)
+        _sessions[key] = session
+        while len(_sessions) > MAX_SESSIONS:
+            _sessions.popitem(last = False)
+        return session
+
+def _get_requests_manager(os_provider):
+    return getattr(os_provider, 'server', os_provider)
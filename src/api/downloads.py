@@ -0,0 +1,238 @@
+import logging
+logger = logging.getLogger("subit.api.downloads")
+import re
+import codecs
+from tempfile import SpooledTemporaryFile
+
+import utils
+from exceptions import InvalidDownloadContent, DownloadTooLarge
+
+
+__all__ = ['Download', 'sniff_file_type']
+
+
+DOWNLOAD_CHUNK_SIZE = 16 * 1024
+# Downloads smaller than this are kept in memory, bigger ones are rolled over
+# to a temporary file on disk.
+SPOOL_MAX_MEMORY_BYTES = 1024 * 1024
+# The number of bytes we need in order to identify the file type.
+SNIFF_BYTES = 64
+
+# A list of (file type, pattern of the first bytes). Subtitles are either
+# archives, or plain text files in one of the common formats. Text files that
+# start with a UTF-16 BOM are matched after they are decoded.
+FILE_SIGNATURES = [
+    ('zip',     re.compile(r"PK\x03\x04")),
+    ('rar',     re.compile(r"Rar!\x1a\x07")),
+    ('gzip',    re.compile(r"\x1f\x8b")),
+    ('7z',      re.compile(r"7z\xbc\xaf\x27\x1c")),
+    ('srt',     re.compile(r"(\xef\xbb\xbf)?\s*\d+\s*\r?\n\s*\d+:\d+")),
+    ('ssa',     re.compile(r"(\xef\xbb\xbf)?\s*\[Script Info\]", re.I)),
+    ('sub',     re.compile(r"(\xef\xbb\xbf)?\s*\{\d+\}\{\d*\}")),
+    ('vtt',     re.compile(r"(\xef\xbb\xbf)?WEBVTT(\s|$)")),
+]
+# The patterns of the pages that the providers send instead of a subtitle
+# (e.g., when the download limit is reached). Only downloads that match them
+# are rejected, files in formats that we don't know are kept.
+ERROR_PAGE_SIGNATURES = [
+    re.compile(
+        r"(\xef\xbb\xbf)?\s*<(!doctype\s+html|html|head|body|title)\b", re.I),
+    re.compile(r"(\xef\xbb\xbf)?\s*\{\s*\"(error|message)\"", re.I),
+]
+UNKNOWN_FILE_TYPE = 'unknown'
+
+
+def sniff_file_type(head):
+    """
+    Returns the type of the file according to its first bytes, 'unknown' if
+    it's not in one of the formats we know, or None if it's empty or an error
+    page.
+
+    >>> sniff_file_type("PK\\x03\\x04\\x14\\x00")
+    'zip'
+    >>> sniff_file_type("1\\r\\n00:00:01,000 --> 00:00:02,000\\r\\n")
+    'srt'
+    >>> sniff_file_type(u"1\\r\\n00:00:01,000".encode("utf-16"))
+    'srt'
+    >>> sniff_file_type("WEBVTT\\r\\n\\r\\n00:01.000 --> 00:02.000")
+    'vtt'
+    >>> sniff_file_type("Hello")
+    'unknown'
+    >>> print sniff_file_type("<!DOCTYPE html><html>")
+    None
+    """
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        # An odd number of bytes means that we got part of a character.
+        head = head[:len(head) - len(head) % 2].decode(
+            'utf-16', 'replace').encode('utf-8')
+
+    for file_type, pattern in FILE_SIGNATURES:
+        if pattern.match(head):
+            return file_type
+    if not head.strip():
+        return None
+    for pattern in ERROR_PAGE_SIGNATURES:
+        if pattern.match(head):
+            return None
+    return UNKNOWN_FILE_TYPE
+
+
+class Download(object):
+    """
+    A download whose headers were received, but whose body was not read yet.
+    This way, the caller can decide whether the download is worth transferring
+    (by looking at content_length for example), before actually reading it.
+
+    The body is streamed in chunks into a spooled temporary buffer. If the
+    first bytes are an error page (see sniff_file_type), InvalidDownloadContent
+    is raised, and if the body is bigger than max_size bytes, DownloadTooLarge
+    is raised. In both cases the rest of the body is not transferred.
+
+    The first bytes of the body can be looked at with peek before deciding to
+    read the rest of it.
+
+    The download must be closed after use (the instance is a context manager),
+    on_close is called once the download is closed.
+    """
+    def __init__(self, url, response, max_size, on_close = None):
+        from requests.structures import CaseInsensitiveDict
+        self.url = url
+        self.headers = CaseInsensitiveDict(response.headers)
+        self.max_size = max_size
+        self.file_type = None
+        # The number of bytes that were transferred so far.
+        self.bytes_read = 0
+        self._response = response
+        self._chunks = None
+        # The bytes that were transferred by peek, and not read yet.
+        self._peeked = ""
+        self._on_close = on_close
+        self._closed = False
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        return ("<Download url='%s', content_length=%s, file_type=%s>" %
+            (self.url, self.content_length, self.file_type))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def content_length(self):
+        """ The size that the server reported, or None if it's unknown. """
+        try:
+            return int(self.headers["Content-Length"])
+        except (KeyError, ValueError):
+            return None
+
+    @property
+    def file_name(self):
+        """
+        The name of the file, taken from the Content-Disposition header, or
+        from the last portion of the url if the header is missing.
+        """
+        disposition = self.headers.get("Content-Disposition", "")
+        if 'filename' not in disposition:
+            logger.debug("Failed getting the file name for the download.")
+            splitted_url = self.url.rsplit('/', 1)
+            return splitted_url[1] if len(splitted_url) == 2 else ""
+
+        file_name = utils.take_first(utils.get_regex_results(
+            disposition, "(?<=filename\=).*(?=$)"))
+        return file_name.strip('"\'')
+
+    def _get_chunks(self):
+        if self._chunks is None:
+            self._chunks = self._response.iter_content(DOWNLOAD_CHUNK_SIZE)
+        return self._chunks
+
+    def _iter_body(self):
+        peeked, self._peeked = self._peeked, ""
+        if peeked:
+            yield peeked
+        for chunk in self._get_chunks():
+            yield chunk
+
+    def peek(self, size = SNIFF_BYTES):
+        """
+        Returns the first size bytes of the body (or the whole body, if it's
+        shorter) without consuming them, so they are still returned by read.
+        Only the chunks that hold these bytes are transferred.
+        """
+        chunks = self._get_chunks()
+        while len(self._peeked) < size:
+            chunk = next(chunks, None)
+            if chunk is None:
+                break
+            self._peeked += chunk
+        return self._peeked[:size]
+
+    def read_to_buffer(self):
+        """
+        Reads the body into a spooled temporary file, and returns it (seeked to
+        the start). The caller is responsible for closing the returned buffer.
+        """
+        if (self.content_length is not None and 
+            self.content_length > self.max_size):
+            raise DownloadTooLarge("The download is too large: %d bytes." %
+                self.content_length)
+
+        buffer = SpooledTemporaryFile(max_size = SPOOL_MAX_MEMORY_BYTES)
+        try:
+            self._read_into(buffer)
+        except:
+            buffer.close()
+            raise
+        buffer.seek(0)
+        return buffer
+
+    def _read_into(self, buffer):
+        head = ""
+        size = 0
+        for chunk in self._iter_body():
+            size += len(chunk)
+            self.bytes_read = size
+            if size > self.max_size:
+                raise DownloadTooLarge("The download is larger than: %d bytes."
+                    % self.max_size)
+
+            if self.file_type is None:
+                head += chunk
+                if len(head) < SNIFF_BYTES:
+                    continue
+                self._sniff(head)
+                chunk, head = head, None
+            buffer.write(chunk)
+
+        # The whole body was smaller than SNIFF_BYTES.
+        if self.file_type is None:
+            self._sniff(head)
+            buffer.write(head)
+
+    def _sniff(self, head):
+        self.file_type = sniff_file_type(head)
+        if not self.file_type:
+            raise InvalidDownloadContent(
+                "The download is an error page: %r" % head[:SNIFF_BYTES])
+        logger.debug("The download is a %s file.", self.file_type)
+
+    def read(self):
+        """ Reads the body and returns it as a string. """
+        buffer = self.read_to_buffer()
+        try:
+            return buffer.read()
+        finally:
+            buffer.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._response.close()
+        if self._on_close:
+            self._on_close()
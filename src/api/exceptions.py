@@ -24,3 +24,10 @@ class FailedDownloadingSubtitleBuffer(Exception): pass
 
 class HTMLParsingError(Exception): pass
 
+
+class RequestsManagerClosed(Exception): pass
+class ProviderUnavailable(Exception): pass
+class InvalidDownloadContent(FailedDownloadingSubtitleBuffer): pass
+class DownloadTooLarge(FailedDownloadingSubtitleBuffer): pass
+class RequestCancelled(Exception): pass
+class FixtureNotFound(Exception): pass
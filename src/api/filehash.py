@@ -0,0 +1,259 @@
+import logging
+logger = logging.getLogger("subit.api.filehash")
+import os
+import time
+import struct
+from threading import Lock
+
+from singleflight import SingleFlight
+from utils import get_user_data_path, create_parent_directory
+
+
+__all__ = ['calculate_file_hash', 'prehash_files', 'FileHashCache',
+           'configure_file_hash_cache', 'get_file_hash_cache']
+
+
+# The hash covers the first and the last HASH_BLOCK_SIZE bytes of the file.
+HASH_BLOCK_SIZE = 65536
+# Each block is summed as 8192 little-endian unsigned 64 bit integers.
+_BLOCK_FORMAT = struct.Struct('<%dQ' % (HASH_BLOCK_SIZE / 8))
+_HASH_MASK = 0xFFFFFFFFFFFFFFFF
+
+# The cache is kept in the user's own data directory, other users shouldn't
+# be able to read (or plant) the hashes of our files.
+DEFAULT_CACHE_PATH = get_user_data_path('file-hashes.sqlite')
+# Files that were modified less than that many seconds ago are not cached.
+# Some file systems store the mtime in seconds (or even two seconds), so such
+# a file might still change without changing its mtime.
+RACY_MTIME_SECS = 2
+# Stored as the database's user_version, a database with another version is
+# emptied, since its rows might be compared differently.
+_SCHEMA_VERSION = 2
+# The number of files that prehash_files reads at the same time.
+PREHASH_WORKERS = 4
+
+
+class FileHashCache(object):
+    """
+    Stores the hashes of the files in a small SQLite database, so files that
+    didn't change are not read again (which is expensive on network drives).
+
+    A file is identified by its device and inode (or by its path where there
+    are no inodes), and its hash is valid as long as its size, mtime (as the
+    float that os.stat returns) and inode did not change. When they do, the
+    hash is calculated again and replaces the stored one. The cache is thread
+    safe.
+
+    >>> cache = FileHashCache(":memory:")
+    >>> cache.get(__file__) is None
+    True
+    >>> cache.put(__file__, "8e245d9679d31e12")
+    >>> cache.get(__file__)
+    '8e245d9679d31e12'
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._connection = None
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        return "<FileHashCache db_path='%s', hits=%d, misses=%d>" % (
+            self.db_path, self.hits, self.misses)
+
+    def _get_connection(self):
+        """ Must be called while holding the lock. """
+        if not self._connection:
+            import sqlite3
+            create_parent_directory(self.db_path)
+            self._connection = sqlite3.connect(
+                self.db_path, check_same_thread = False)
+            version, = self._connection.execute(
+                "PRAGMA user_version").fetchone()
+            if version != _SCHEMA_VERSION:
+                self._connection.execute("DROP TABLE IF EXISTS file_hashes")
+                self._connection.execute(
+                    "PRAGMA user_version = %d" % _SCHEMA_VERSION)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS file_hashes ("
+                "file_id TEXT PRIMARY KEY, size INTEGER, mtime REAL, "
+                "inode INTEGER, hash TEXT)")
+        return self._connection
+
+    def get(self, file_path, stat = None):
+        """
+        Returns the stored hash of the file, or None if it's missing, or if
+        the file changed since it was stored.
+        """
+        stat = stat or os.stat(file_path)
+        with self._lock:
+            row = self._get_connection().execute(
+                "SELECT size, mtime, inode, hash FROM file_hashes "
+                "WHERE file_id = ?", (_get_file_id(file_path, stat),)
+                ).fetchone()
+            if row and row[:3] == (stat.st_size, stat.st_mtime, stat.st_ino):
+                self.hits += 1
+                return str(row[3])
+            self.misses += 1
+            return None
+
+    def put(self, file_path, file_hash, stat = None):
+        stat = stat or os.stat(file_path)
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute(
+                "INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?, ?)",
+                (_get_file_id(file_path, stat), stat.st_size,
+                 stat.st_mtime, stat.st_ino, file_hash))
+            connection.commit()
+
+    def close(self):
+        with self._lock:
+            if self._connection:
+                self._connection.close()
+                self._connection = None
+
+
+def _get_file_id(file_path, stat):
+    # On Windows, Python 2 doesn't report the inode (st_ino is always 0).
+    if stat.st_ino:
+        return "%d:%d" % (stat.st_dev, stat.st_ino)
+    return "path:%s" % os.path.normcase(os.path.abspath(file_path))
+
+
+_cache_lock = Lock()
+_cache = FileHashCache(DEFAULT_CACHE_PATH)
+
+def configure_file_hash_cache(db_path):
+    """
+    Replaces the cache of calculate_file_hash with a cache that is stored in
+    db_path. If db_path is None, the hashes are not cached.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache:
+            _cache.close()
+        _cache = FileHashCache(db_path) if db_path else None
+
+def get_file_hash_cache():
+    return _cache
+
+
+# Concurrent calls for the same file (a prehash worker and the flow that
+# reached the file) read the file only once.
+_hashes_in_flight = SingleFlight()
+
+def calculate_file_hash(file_path):
+    """
+    Calculates the hash value of the file using OpenSubtitles's algorithm: the
+    file size plus the sum of the 64 bit integers in the first and the last
+    64KB of the file, modulo 2**64. Returns a tuple of (hash, file size), the
+    hash is encoded as a lowercase hex string of 16 chars.
+
+    Each block is read in a single call, and is summed with a single unpack of
+    the whole block (instead of 8 bytes at a time). The hashes are stored in
+    the FileHashCache, so the hash of a file that didn't change is not
+    calculated again.
+
+    Raises BufferError if the file is smaller than two blocks.
+    """
+    return _hashes_in_flight.do(
+        os.path.normcase(os.path.abspath(file_path)),
+        _calculate_file_hash, file_path)
+
+def _calculate_file_hash(file_path):
+    stat = os.stat(file_path)
+    file_size = stat.st_size
+    if file_size < HASH_BLOCK_SIZE * 2:
+        raise BufferError("The file size is too small: %s" % file_size)
+
+    cache = _cache
+    returned_hash = cache and _get_cached_hash(cache, file_path, stat)
+    if returned_hash:
+        logger.debug("Cached hash value of %s is: %s", file_path,
+            returned_hash)
+        return (returned_hash, file_size)
+
+    file_hash = file_size
+    with open(file_path, "rb") as movie_file:
+        file_hash += _sum_block(movie_file.read(HASH_BLOCK_SIZE))
+        movie_file.seek(file_size - HASH_BLOCK_SIZE, os.SEEK_SET)
+        file_hash += _sum_block(movie_file.read(HASH_BLOCK_SIZE))
+
+    returned_hash = "%016x" % (file_hash & _HASH_MASK)
+    logger.debug("Hash value of %s is: %s", file_path, returned_hash)
+    if cache and time.time() - stat.st_mtime >= RACY_MTIME_SECS:
+        _put_cached_hash(cache, file_path, returned_hash, stat)
+    return (returned_hash, file_size)
+
+def _get_cached_hash(cache, file_path, stat):
+    try:
+        return cache.get(file_path, stat)
+    except Exception as eX:
+        logger.warning("Failed reading the hashes cache: %s", eX)
+        return None
+
+def _put_cached_hash(cache, file_path, file_hash, stat):
+    try:
+        cache.put(file_path, file_hash, stat)
+    except Exception as eX:
+        logger.warning("Failed writing to the hashes cache: %s", eX)
+
+def prehash_files(file_paths, max_workers = PREHASH_WORKERS):
+    """
+    Calculates the hashes of the files in the background, so they are already
+    in the cache by the time they are needed. The files are sorted by their
+    directory and name, and max_workers threads hash them in that order, so
+    the reads of each directory stay close together (which matters on spinning
+    disks and network shares).
+
+    Returns an AsyncResult (see multiprocessing.pool) of a list of (file path,
+    hash) tuples in the sorted order, where the hash is None for files that
+    couldn't be hashed. Returns None if the cache is disabled, because the
+    hashes would be lost anyway.
+
+    >>> prehash_files([]).get()
+    []
+    """
+    if not _cache:
+        logger.debug("The hashes are not cached, skipping the prehash.")
+        return None
+    from multiprocessing.dummy import Pool as ThreadPool
+    file_paths = sorted(set(file_paths), key = _get_directory_order)
+    logger.debug("Prehashing %d files using %d workers.", len(file_paths),
+        max_workers)
+    pool = ThreadPool(max(1, min(max_workers, len(file_paths))))
+    try:
+        # With a chunksize of 1, the workers take the files in order.
+        return pool.map_async(_prehash_file, file_paths, chunksize = 1)
+    finally:
+        # The workers exit once all the files are hashed.
+        pool.close()
+
+def _get_directory_order(file_path):
+    """ Sorts the files of each directory together, and then by their names. """
+    return os.path.split(os.path.normcase(os.path.abspath(file_path)))
+
+def _prehash_file(file_path):
+    try:
+        return (file_path, calculate_file_hash(file_path)[0])
+    except Exception as eX:
+        logger.debug("Failed prehashing %s: %s", file_path, eX)
+        return (file_path, None)
+
+def _sum_block(block):
+    """
+    Returns the sum of the block's integers (without the modulo).
+
+    >>> block = "\\x01" + "\\x00" * 7 + "\\xff" * 8 * 8191
+    >>> "%016x" % (_sum_block(block) & _HASH_MASK)
+    'ffffffffffffe002'
+    """
+    if len(block) != HASH_BLOCK_SIZE:
+        raise IOError("Read %d bytes instead of %d." %
+            (len(block), HASH_BLOCK_SIZE))
+    return sum(_BLOCK_FORMAT.unpack(block))
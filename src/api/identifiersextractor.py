@@ -6,6 +6,7 @@ from exceptions import InvalidQueriesValue
 from title import SeriesTitle
 from title import MovieTitle
 from namenormalization import normalize_name
+from api.discoverysession import get_discovery_session
 from api.providers import get_provider_instance
 from api.providers import ProvidersNames
 from api.languages import Languages
@@ -181,9 +182,10 @@ def _get_release_name_using_opensubtitles_hash(files_paths):
     try:
         os_provider = _get_os_provider()
         for file_path in files_paths:
-            file_hash, file_size  = os_provider.calculate_file_hash(file_path)
-            release_name = os_provider.get_release_name_by_hash(
-                file_hash, file_size)
+            # The title discovery of the file probably searched by its hash
+            # already, so the session returns the release name of that search.
+            release_name = get_discovery_session(
+                file_path, os_provider).get_release_name()
             if release_name:
                 return release_name
     except Exception as ex:
@@ -0,0 +1,192 @@
+import logging
+logger = logging.getLogger("subit.api.metrics")
+from threading import Lock
+from urlparse import urlparse
+
+
+__all__ = ['MetricsRegistry', 'Histogram', 'get_endpoint_class']
+
+
+# The upper bounds (in seconds) of the histograms' buckets. The last bucket
+# holds everything above the last bound.
+DEFAULT_BUCKETS_SECS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+COUNTERS = [
+    'requests', 'bytes_in', 'bytes_out', 'retries', 'timeouts', 'errors',
+    'cache_hits', 'cache_misses'
+]
+
+
+def get_endpoint_class(url):
+    """
+    Returns the class of the endpoint that the url points to. The class is the
+    first component of the url's path, so the number of classes is small, and
+    urls of the same page type (e.g., all the subtitle pages) share a class.
+
+    >>> get_endpoint_class("http://www.torec.net/sub.asp?sub_id=1")
+    '/sub.asp'
+    >>> get_endpoint_class("http://www.torec.net/ajax/sub/guest_time.asp")
+    '/ajax'
+    >>> get_endpoint_class("http://www.torec.net")
+    '/'
+    """
+    path = urlparse(url).path
+    return "/" + path.lstrip("/").split("/", 1)[0]
+
+
+class Histogram(object):
+    """
+    A simple histogram with fixed buckets.
+
+    >>> histogram = Histogram([1, 2])
+    >>> histogram.observe(0.5)
+    >>> histogram.observe(1.5)
+    >>> histogram.observe(3)
+    >>> histogram.to_dict()['buckets']
+    [[1, 1], [2, 1], ['+inf', 1]]
+    """
+    def __init__(self, bounds = DEFAULT_BUCKETS_SECS):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        return "<Histogram count=%d, total=%.3f>" % (self.count, self.total)
+
+    def observe(self, value):
+        index = len(self.bounds)
+        for idx, bound in enumerate(self.bounds):
+            if value <= bound:
+                index = idx
+                break
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        self.maximum = max(self.maximum, value)
+
+    def to_dict(self):
+        return {
+            'count'     : self.count,
+            'total'     : self.total,
+            'mean'      : self.total / self.count if self.count else 0.0,
+            'max'       : self.maximum,
+            'buckets'   : [
+                [bound, count] for bound, count in
+                zip(self.bounds + ['+inf'], self.counts)],
+        }
+
+
+class _EndpointMetrics(object):
+    def __init__(self):
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.latency = Histogram()
+        self.queue_wait = Histogram()
+
+    def to_dict(self):
+        metrics = dict(self.counters)
+        metrics['latency_secs'] = self.latency.to_dict()
+        metrics['queue_wait_secs'] = self.queue_wait.to_dict()
+        return metrics
+
+
+class MetricsRegistry(object):
+    """
+    Collects the metrics of the requests of all the providers. The metrics are
+    kept per provider, and per endpoint class within each provider: the
+    counters (requests, bytes_in, bytes_out, retries, timeouts, errors,
+    cache_hits and cache_misses), and histograms of the latency and of the
+    time that the requests waited for admission.
+
+    The registry is thread safe.
+
+    >>> registry = MetricsRegistry()
+    >>> registry.record_request("torec", "/sub.asp", 0.2, 100, 10)
+    >>> registry.record_cache_hit("torec", "/sub.asp")
+    >>> metrics = registry.get_metrics()["torec"]["/sub.asp"]
+    >>> metrics['requests'], metrics['bytes_in'], metrics['cache_hits']
+    (1, 100, 1)
+    """
+    def __init__(self):
+        self._lock = Lock()
+        # provider name => endpoint class => _EndpointMetrics
+        self._providers = {}
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        return "<MetricsRegistry providers=%s>" % sorted(self._providers)
+
+    def _get_endpoint(self, provider, endpoint):
+        """ Must be called while holding the lock. """
+        endpoints = self._providers.setdefault(provider, {})
+        if endpoint not in endpoints:
+            endpoints[endpoint] = _EndpointMetrics()
+        return endpoints[endpoint]
+
+    def _increase(self, provider, endpoint, counter, value = 1):
+        with self._lock:
+            self._get_endpoint(provider, endpoint).counters[counter] += value
+
+    def record_request(
+        self, provider, endpoint, latency_secs, bytes_in = 0, bytes_out = 0):
+        """ Records a request that was sent (including all its attempts). """
+        with self._lock:
+            metrics = self._get_endpoint(provider, endpoint)
+            metrics.counters['requests'] += 1
+            metrics.counters['bytes_in'] += bytes_in
+            metrics.counters['bytes_out'] += bytes_out
+            metrics.latency.observe(latency_secs)
+
+    def record_queue_wait(self, provider, endpoint, wait_secs):
+        with self._lock:
+            self._get_endpoint(provider, endpoint).queue_wait.observe(wait_secs)
+
+    def record_retry(self, provider, endpoint):
+        self._increase(provider, endpoint, 'retries')
+
+    def record_timeout(self, provider, endpoint):
+        self._increase(provider, endpoint, 'timeouts')
+
+    def record_error(self, provider, endpoint):
+        self._increase(provider, endpoint, 'errors')
+
+    def record_cache_hit(self, provider, endpoint):
+        self._increase(provider, endpoint, 'cache_hits')
+
+    def record_cache_miss(self, provider, endpoint):
+        self._increase(provider, endpoint, 'cache_misses')
+
+    def get_metrics(self):
+        """
+        Returns the metrics as a dictionary of provider name => endpoint class
+        => metrics dictionary. The returned dictionary is a copy.
+        """
+        with self._lock:
+            return dict(
+                (provider, dict(
+                    (endpoint, metrics.to_dict())
+                    for endpoint, metrics in endpoints.iteritems()))
+                for provider, endpoints in self._providers.iteritems())
+
+    def reset(self):
+        with self._lock:
+            self._providers.clear()
+
+    def dump_json(self, file_path = None):
+        """
+        Returns the metrics as a JSON string. If file_path is given, the JSON
+        is also written to that file.
+        """
+        import json
+        dump = json.dumps(self.get_metrics(), indent = 2, sort_keys = True)
+        if file_path:
+            logger.debug("Writing metrics to: %s", file_path)
+            with open(file_path, "w") as metrics_file:
+                metrics_file.write(dump)
+        return dump
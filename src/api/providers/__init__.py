@@ -7,7 +7,13 @@ from api.requestsmanager import get_manager_instance
 from api.providers.providersnames import ProvidersNames
 
 
-__all__ = ['get_titles_versions', 'ProvidersNames']
+__all__ = ['prefetch_versions', 'select_version', 'ProvidersNames']
+
+
+# The number of versions (with the highest ranks) whose download is prepared
+# ahead of time by prefetch_versions, or by the providers that prepare their
+# best versions as they find them.
+PREFETCH_VERSIONS = 3
 
 # The list will contain the classes (not instances) of all the providers that
 # SubiT knows of.
@@ -68,4 +74,39 @@ def get_provider_instance(provider_name, languages,
     logger.debug("Received a RequestsManager: %s" % requests_manager)
     provider = provider_class(languages, requests_manager)
     logger.debug("Created a provider instance: %s" % provider)
-    return provider
\ No newline at end of file
+    return provider
+
+
+def _get_versions_providers(titles_versions):
+    providers = []
+    for provider_version in titles_versions.iter_versions():
+        if provider_version.provider not in providers:
+            providers.append(provider_version.provider)
+    return providers
+
+def prefetch_versions(titles_versions, max_versions = PREFETCH_VERSIONS):
+    """
+    Lets the providers prepare the download of the max_versions versions with
+    the highest ranks in titles_versions, which are the ones that are likely to
+    be selected. Should be called once the versions are ranked.
+
+    The prefetch_versions method of each provider is called with its versions
+    among them, from the highest rank. The other providers are called with an 
+    empty list, so they drop what they prepared for the versions earlier.
+    """
+    top_versions = titles_versions.get_top_versions(max_versions)
+    logger.debug("Prefetching versions: %s" % top_versions)
+    for provider in _get_versions_providers(titles_versions):
+        provider.prefetch_versions(
+            [provider_version for provider_version in top_versions 
+             if provider_version.provider is provider])
+
+def select_version(titles_versions, provider_version):
+    """
+    Tells the providers of the versions in titles_versions that 
+    provider_version was selected for downloading, so they drop what they 
+    prepared for the other versions.
+    """
+    logger.debug("Selected version: %s" % provider_version)
+    for provider in _get_versions_providers(titles_versions):
+        provider.version_selected(provider_version)
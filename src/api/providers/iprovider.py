@@ -20,6 +20,23 @@ class IProvider(object):
     def download_subtitle_buffer(self, provider_version):
         pass
 
+    def prefetch_versions(self, provider_versions):
+        """
+        Called with the versions of the provider that are likely to be 
+        downloaded (from the most likely), so a provider that has to prepare 
+        each download can do it ahead of time. The versions replace the ones of
+        the previous call. Does nothing by default.
+        """
+        pass
+
+    def version_selected(self, provider_version):
+        """
+        Called once a version (of this provider or of another) was selected for
+        downloading, so the provider can drop what it prepared for its other 
+        versions. Does nothing by default.
+        """
+        pass
+
     @property
     def languages_in_use(self):
         return self._languages_in_use
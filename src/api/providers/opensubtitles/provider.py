@@ -15,6 +15,9 @@ from api import utils
 
 __all__ = ['OpenSubtitlesProvider']
 
+# The maximal number of hashes that CheckMovieHash2 accepts in a single call.
+MAX_HASHES_PER_CALL = 200
+
 
 class OpenSubtitlesProvider(IProvider):
     provider_name = ProvidersNames.OPEN_SUBTITLES
@@ -35,10 +38,27 @@ class OpenSubtitlesProvider(IProvider):
         Languages.PORTUGUESE,
         Languages.CROATIAN
     ]
+    # The fields of the SearchSubtitles rows that the provider reads, the other
+    # fields are not kept in memory.
+    search_subtitles_fields = [
+        "IDMovieImdb",
+        "MovieName",
+        "MovieYear",
+        "MovieKind",
+        "SeriesSeason",
+        "SeriesEpisode",
+        "SeriesIMDBParent",
+        "MovieReleaseName",
+        "SubActualCD",
+        "ZipDownloadLink",
+        "SubLanguageID"
+    ]
 
     def __init__(self, languages, requests_manager):
         super(OpenSubtitlesProvider, self).__init__(languages, requests_manager)
         self.server = requests_manager
+        self.server.declare_search_subtitles_fields(
+            self.search_subtitles_fields)
 
     def _construct_title_from_search_subtitle_result(self, result):
         imdb_id = result["IDMovieImdb"]
@@ -64,7 +84,7 @@ class OpenSubtitlesProvider(IProvider):
                 episode_name, year, imdb_id)
         else:
             logger.debug("Got strange 'kind' value: %s"
-                % result["kind"])
+                % result["MovieKind"])
 
         return title
 
@@ -107,13 +127,11 @@ class OpenSubtitlesProvider(IProvider):
             else:
                 query_params["query"] += " %s" % title.episode_name
 
-        subtitle_results = self.server.SearchSubtitles([query_params])
-        if not subtitle_results or not subtitle_results['data']:
+        subtitle_results = self.server.search_subtitles(query_params)
+        if not subtitle_results:
             logger.error("Failed querying for title %s." % title)
             return titles_versions
 
-        subtitle_results = subtitle_results['data']
-
         # For each result, construct a ProviderVersion instance.
         for result in subtitle_results:
             title = self._construct_title_from_search_subtitle_result(result)
@@ -138,36 +156,10 @@ class OpenSubtitlesProvider(IProvider):
         (None, None) is returned. On success, a tuple of (hash, file size) is
         returned.
         """
-        import struct
-        from os.path import getsize
+        from api.filehash import calculate_file_hash
         logger.debug("Calculating hash value for: %s" % file_path)
         try:
-            long_long_format = 'q'  # long long
-            byte_size = struct.calcsize(long_long_format)
-
-            file_size = getsize(file_path)
-            logger.debug("File size is: %d" % file_size)
-            if file_size < 65536 * 2:
-                raise BufferError("The file size is too small: %s" % file_size)
-
-            hash = file_size
-            with open(file_path, "rb") as f:
-                for x in range(65536/byte_size):
-                    buffer = f.read(byte_size)
-                    (l_value,)= struct.unpack(long_long_format, buffer)
-                    hash += l_value
-                    hash = hash & 0xFFFFFFFFFFFFFFFF
-
-                f.seek(max(0,file_size-65536),0)
-                for x in range(65536/byte_size):
-                        buffer = f.read(byte_size)
-                        (l_value,)= struct.unpack(long_long_format, buffer)
-                        hash += l_value
-                        hash = hash & 0xFFFFFFFFFFFFFFFF
-
-            returned_hash =  "%016x" % hash
-            logger.debug("Hash value is: %s" % returned_hash)
-            return (returned_hash, file_size)
+            return calculate_file_hash(file_path)
         except Exception as eX:
             logger.error("Failed calculating the hash: %s" % eX)
             return (None, None)
@@ -178,11 +170,57 @@ class OpenSubtitlesProvider(IProvider):
         of IMDB, and not OpenSubtitles's one. i.e., 'tt<id>' and not '<id>'.
         If succeeded, the function returns either SeriesTitle or MovieTitle
         depends on what was queried. On failures, None is returned. If the
-        imdb_id is malformed, exception is raised.
+        imdb_id is malformed, exception is raised. The titles are served from
+        (and stored in) the manager's title cache, if it has one.
         """
         logger.debug("Getting title info with imdb id: %s" % imdb_id)
         opensubtitles_id = imdb_id_format_for_opensubtitles(imdb_id)
+        title_cache = self.server.get_title_cache()
+        title = title_cache and self._get_cached_title(title_cache, imdb_id)
+        if title:
+            logger.debug("Resulted cached title is: %s" % title)
+            return title
+
+        title = self._get_title_by_opensubtitles_id(opensubtitles_id)
+        if title and title_cache:
+            self._put_cached_title(title_cache, imdb_id, title)
+        return title
+
+    def warm_up_title_cache(self, imdb_ids):
+        """
+        Queries the details of the imdb ids that are missing from the title
+        cache (or expired), so the following calls to get_title_by_imdb_id 
+        with those ids are served from the cache. Returns the number of ids
+        that were queried.
+        """
+        title_cache = self.server.get_title_cache()
+        if not title_cache:
+            return 0
+        try:
+            missing_imdb_ids = title_cache.get_missing(imdb_ids)
+        except Exception as eX:
+            logger.error("Failed reading the title cache: %s" % eX)
+            return 0
+        logger.debug(
+            "Warming up the title cache with %d ids." % len(missing_imdb_ids))
+        for imdb_id in missing_imdb_ids:
+            self.get_title_by_imdb_id(imdb_id)
+        return len(missing_imdb_ids)
+
+    def _get_cached_title(self, title_cache, imdb_id):
+        try:
+            return title_cache.get(imdb_id)
+        except Exception as eX:
+            logger.error("Failed reading the title cache: %s" % eX)
+            return None
+
+    def _put_cached_title(self, title_cache, imdb_id, title):
+        try:
+            title_cache.put(imdb_id, title)
+        except Exception as eX:
+            logger.error("Failed writing to the title cache: %s" % eX)
 
+    def _get_title_by_opensubtitles_id(self, opensubtitles_id):
         response = self.server.GetIMDBMovieDetails(opensubtitles_id)
         if not response:
             logger.error("Got no response for the imdb id.")
@@ -236,13 +274,54 @@ class OpenSubtitlesProvider(IProvider):
         of them, and returns the one appearing most.
         """
         logger.debug("Getting title info with hash: %s" % file_hash)
+        return self._select_release_name(
+            self._do_search_subtitles_with_hash(file_hash, file_size))
 
+    def get_title_and_release_name_by_hash(self, file_hash, file_size):
+        """
+        Queries OpenSubtitles once (via SearchSubtitles with the hash value and
+        the size of the file) for both the title and the release name of the
+        file. The title is constructed from the result with the most common
+        imdb id, and the release name is the most common MovieReleaseName (see
+        get_release_name_by_hash). Returns a tuple of (title, release name), 
+        either of them might be None if it's missing from the results.
+        """
+        logger.debug("Getting title and release name with hash: %s" % 
+            file_hash)
+        results = self._do_search_subtitles_with_hash(file_hash, file_size)
+        return (self._select_title(results), self._select_release_name(results))
+
+    def _select_title(self, results):
+        """ Constructs the title of the most common imdb id in the results. """
+        imdb_ids = self._sum_search_results(results, 'IDMovieImdb', int)
+        if not imdb_ids:
+            return None
+        selected_id = max(imdb_ids.iteritems(), key=lambda i: i[1])[0]
+        logger.debug("Selected imdb id is: %s" % selected_id)
+        for result in results:
+            try:
+                if int(result.get('IDMovieImdb')) != selected_id:
+                    continue
+                title = self._construct_title_from_search_subtitle_result(
+                    result)
+            except Exception as eX:
+                logger.error("Failed constructing the title: %s" % eX)
+                continue
+            if title:
+                return title
+        return None
+
+    def _select_release_name(self, results):
+        """ Returns the release name that appears most, or None. """
         release_names = self._sum_search_results(
-            self._do_search_subtitles_with_hash(file_hash, file_size),
+            results,
             'MovieReleaseName',
             lambda v: v.strip().lower())
 
         logger.debug("release_names appearances is: %s" % release_names)
+        release_names.pop('', None)
+        if not release_names:
+            return None
         # Select the release with most appearances.
         release_names_sorted = \
             sorted(release_names.iteritems(), key=lambda i: i[1], reverse=True)
@@ -258,14 +337,39 @@ class OpenSubtitlesProvider(IProvider):
         was returned from the site.
         """
         logger.debug("Getting title info with hash: %s" % file_hash)
-        response = self.server.CheckMovieHash2([file_hash])
-        if not response or not response['data']:
-            logger.error("Failed getting response for the hash.")
-            return None
+        return self.get_titles_by_hashes([file_hash]).get(file_hash)
 
-        opensubtitles_id = response['data'][file_hash][0]['MovieImdbID']
-        return self.get_title_by_imdb_id(
-            opensubtitles_id_format_for_imdb(opensubtitles_id))
+    def get_titles_by_hashes(self, file_hashes):
+        """
+        Queries OpenSubtitles for the titles of many files at once. The hashes
+        are sent in as few CheckMovieHash2 calls as the server allows, and the
+        details of each distinct imdb id are queried once, even if several 
+        files share it. Returns a dictionary of hash => Title, hashes that 
+        were not resolved are missing from it.
+        """
+        logger.debug("Getting titles info for %d hashes." % len(file_hashes))
+        file_hashes = sorted(set(file_hashes))
+        imdb_ids = {}
+        for idx in range(0, len(file_hashes), MAX_HASHES_PER_CALL):
+            hashes_chunk = file_hashes[idx:idx + MAX_HASHES_PER_CALL]
+            response = self.server.CheckMovieHash2(hashes_chunk)
+            # The server returns an empty list if none of the hashes is known.
+            if not response or not isinstance(response['data'], dict):
+                logger.error("Failed getting response for the hashes.")
+                continue
+            for file_hash in hashes_chunk:
+                results = response['data'].get(file_hash)
+                if results:
+                    imdb_ids[file_hash] = opensubtitles_id_format_for_imdb(
+                        results[0]['MovieImdbID'])
+
+        titles_by_imdb_id = dict(
+            (imdb_id, self.get_title_by_imdb_id(imdb_id))
+            for imdb_id in set(imdb_ids.itervalues()))
+        return dict(
+            (file_hash, titles_by_imdb_id[imdb_id])
+            for file_hash, imdb_id in imdb_ids.iteritems()
+            if titles_by_imdb_id[imdb_id])
 
     def get_title_by_query(self, query):
         """
@@ -310,12 +414,11 @@ class OpenSubtitlesProvider(IProvider):
 
     def _do_search_subtitles(self, params):
         logger.debug("Sending query to SearchSubtitles: %s" % params)
-        response = self.server.SearchSubtitles([params])
-        if not response or not response['data']:
+        data = self.server.search_subtitles(params)
+        if not data:
             logger.error("Failed getting response for the query.")
             return None
 
-        data = response['data']
         logger.debug("Received %d results from the query." % len(data))
         return data
 
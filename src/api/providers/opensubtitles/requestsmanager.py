@@ -1,7 +1,20 @@
 from api.requestsmanager import RequestsManager
+from api.requestsmanager import ServerError
+from api.requestsmanager import DEFAULT_SETTINGS
+from api.requestsmanager import REQUEST_TIMEOUT_SECS
+from api.retrypolicy import call_with_retries
+from api.scheduling import Priorities, RequestContext
+from api.xmlrpctransport import SessionTransport
+from api.utils import get_user_data_path, create_parent_directory
+from searchbatcher import SearchSubtitlesBatcher
+from searchbatcher import ROW_FIELDS as BATCHER_ROW_FIELDS
+from titlecache import TitleCache
 
 import logging
 logger = logging.getLogger("subit.api.providers.opensubtitles.requestsmanager")
+import os
+import time
+from threading import Lock, Event, Thread
 
 from xmlrpclib import Server as XmlRpcServer
 from xmlrpclib import Error as XmlRpcError
@@ -12,18 +25,73 @@ __all__ = ['OpenSubtitlesRequestsManager']
 API_URL = 'http://api.opensubtitles.org/xml-rpc'
 USER_AGENT = "subit-api 1.0.0"
 OK_STATUS = "200 OK"
+# The statuses that are returned when the token expired (or is invalid).
+TOKEN_EXPIRED_STATUSES = ["401 Unauthorized", "406 No session"]
+# The server drops a session that was idle for 15 minutes.
+TOKEN_TTL_SECS = 15 * 60
+# The persisted token is rewritten (with its new expiry) at most once in that
+# period.
+TOKEN_SAVE_INTERVAL_SECS = 60
+
+OPENSUBTITLES_SETTINGS = dict(DEFAULT_SETTINGS, **{
+    'api_url'           : API_URL,
+    # The token is stored in that file (in the user's own data directory), so
+    # the next runs can use it instead of logging in again. None disables the
+    # persistence.
+    'token_file_path'   : get_user_data_path('opensubtitles-token'),
+    # If the manager was idle for keepalive_secs, a NoOperation call is sent
+    # to keep the session alive. None disables the keepalive.
+    'keepalive_secs'    : 10 * 60,
+    # The titles that were resolved by their imdb id are cached in that file
+    # (see TitleCache), in the user's own data directory. None disables the
+    # cache.
+    'title_cache_path'  : get_user_data_path('opensubtitles-titles.sqlite'),
+})
 
 
 class OpenSubtitlesRequestsManager(RequestsManager):
     """
-    A small wrapper for the XmlRpcServer. We store the token, and before each 
-    call to a server method, we increase the default socket timeout, and also,
-    apply a retry mechanism up to 3 failures.
+    A small wrapper for the XmlRpcServer. We store the token, and pass it to 
+    each call to a server method. The calls are sent through the manager's 
+    session (see SessionTransport), so they reuse its kept-alive connections,
+    have their own timeout, and get gzipped responses. Each call is admitted 
+    by the manager's AdmissionController, and is retried according to the 
+    manager's RetryPolicy and CircuitBreaker, just like the http requests. If
+    the call fails, None is returned.
+
+    The login is lazy: it happens on the first call, and the token is stored in
+    token_file_path (with its expiry), so the next runs reuse it instead of 
+    logging in again. While the token is in use, the session is kept alive 
+    with NoOperation calls, and if the server says that the token expired, we
+    log in again and repeat the call.
+
+    SearchSubtitles queries that are sent with search_subtitles() are batched
+    with the concurrent queries of other threads into a single call. Once the
+    fields of the rows are declared with declare_search_subtitles_fields(), 
+    the rows are parsed into CompactRows that hold only those fields.
     """
-    def __init__(self):
-        super(RequestsManager, self).__init__()
-        self.server = XmlRpcServer(API_URL)
-        self.token = self.server.LogIn(0, 0, 0, USER_AGENT)['token']
+    default_settings = OPENSUBTITLES_SETTINGS
+
+    def __init__(self, **settings):
+        super(OpenSubtitlesRequestsManager, self).__init__(**settings)
+        # The session is taken on each call, because configure() might replace
+        # it. The calls are also recorded or replayed by the session's 
+        # transport (if the manager has one).
+        api_url = self.settings['api_url']
+        self._xmlrpc_transport = SessionTransport(
+            lambda: self._session, REQUEST_TIMEOUT_SECS, USER_AGENT,
+            api_url.startswith("https"))
+        self.server = XmlRpcServer(api_url, self._xmlrpc_transport)
+        self.token = None
+        self._token_lock = Lock()
+        self._token_expiry = 0
+        self._token_saved_time = 0
+        self._keepalive_stop = Event()
+        self._keepalive_thread = None
+        self.search_batcher = SearchSubtitlesBatcher(
+            lambda queries: self.SearchSubtitles(queries))
+        self._title_cache = None
+        self._title_cache_lock = Lock()
 
     def __str__(self):
         return repr(self)
@@ -33,6 +101,123 @@ class OpenSubtitlesRequestsManager(RequestsManager):
                 "server='%(server)s', token='%(token)s'>" % 
                 object.__getattribute__(self, '__dict__'))
             
+    def _get_token_file_path(self):
+        # Recorded and replayed runs always log in, so the fixtures don't 
+        # depend on a token of an earlier run.
+        if self.settings['transport']:
+            return None
+        return self.settings['token_file_path']
+
+    def get_title_cache(self):
+        """
+        Returns the TitleCache of the manager, or None if the titles shouldn't
+        be cached. Just like the token, recorded and replayed runs don't use 
+        the cache, so the fixtures don't depend on the titles of earlier runs.
+        """
+        title_cache_path = self.settings['title_cache_path']
+        if self.settings['transport'] or not title_cache_path:
+            return None
+        with self._title_cache_lock:
+            if (not self._title_cache or
+                self._title_cache.db_path != title_cache_path):
+                self._title_cache = TitleCache(title_cache_path)
+            return self._title_cache
+
+    def _get_token(self):
+        """
+        Returns the current token. If there is none (or it expired), the token
+        that was stored by an earlier run is used, and if there is no such 
+        token, we log in.
+        """
+        with self._token_lock:
+            if self.token and time.time() < self._token_expiry:
+                return self.token
+            token, expiry = _load_token(
+                self._get_token_file_path(), self.settings['api_url'])
+            if not token:
+                logger.debug("Logging in to OpenSubtitles.")
+                response = self.server.LogIn(0, 0, 0, USER_AGENT)
+                if not response or response.get('status') != OK_STATUS:
+                    raise ServerError("Failed logging in: %s" % response)
+                token, expiry = response['token'], time.time() + TOKEN_TTL_SECS
+                self._token_saved_time = 0
+            self.token, self._token_expiry = token, expiry
+            self._save_token()
+        self._start_keepalive()
+        return token
+
+    def _touch_token(self, token):
+        """ The server extends the session whenever the token is used. """
+        with self._token_lock:
+            if self.token == token:
+                self._token_expiry = time.time() + TOKEN_TTL_SECS
+                self._save_token()
+
+    def _invalidate_token(self, token):
+        logger.debug("The token has expired: %s", token)
+        with self._token_lock:
+            if self.token == token:
+                self.token = None
+                self._token_expiry = 0
+                _remove_token(self._get_token_file_path())
+
+    def _save_token(self):
+        """ Must be called while holding the token lock. """
+        if time.time() - self._token_saved_time < TOKEN_SAVE_INTERVAL_SECS:
+            return
+        self._token_saved_time = time.time()
+        _save_token(
+            self._get_token_file_path(), self.settings['api_url'], self.token,
+            self._token_expiry)
+
+    def _start_keepalive(self):
+        if not self.settings['keepalive_secs'] or self._keepalive_thread:
+            return
+        with self._token_lock:
+            if self._keepalive_thread:
+                return
+            self._keepalive_thread = Thread(target = self._keepalive)
+            self._keepalive_thread.daemon = True
+            self._keepalive_thread.start()
+
+    def _keepalive(self):
+        """
+        Sends NoOperation whenever the token was idle for keepalive_secs, until
+        the manager is closed.
+        """
+        keepalive_secs = self.settings['keepalive_secs']
+        while not self._keepalive_stop.wait(keepalive_secs):
+            idle_secs = TOKEN_TTL_SECS - (self._token_expiry - time.time())
+            if self.token and idle_secs >= keepalive_secs:
+                logger.debug("Keeping the session alive.")
+                with RequestContext(Priorities.PREFETCH):
+                    self.NoOperation()
+            keepalive_secs = self.settings['keepalive_secs']
+
+    def close(self):
+        self._keepalive_stop.set()
+        if self._title_cache:
+            self._title_cache.close()
+        super(OpenSubtitlesRequestsManager, self).close()
+
+    def declare_search_subtitles_fields(self, fields):
+        """
+        Declares the fields of the SearchSubtitles rows that the caller reads.
+        The rows hold only the fields that were declared (by all the callers),
+        and the fields that the batcher needs, the rest are dropped while the
+        response is parsed (see SessionTransport.set_row_fields).
+        """
+        self._xmlrpc_transport.set_row_fields(
+            "SearchSubtitles", list(fields) + BATCHER_ROW_FIELDS)
+
+    def search_subtitles(self, query_params):
+        """
+        Sends a single SearchSubtitles query, batched together with the queries
+        of other threads (see SearchSubtitlesBatcher). Returns the rows of the
+        query's results, or None if the call failed.
+        """
+        return self.search_batcher.search(query_params)
+
     def __getattribute__(self, name):
         """
         Once called, we check if it's a specific names, if not, we assume that
@@ -43,36 +228,117 @@ class OpenSubtitlesRequestsManager(RequestsManager):
         try:
             return object.__getattribute__(self, name)
         except AttributeError:
-            logger.debug("Returning a wrapper for: %s" % name)
+            logger.debug("Returning a wrapper for: %s", name)
             def func_wrapper(func):
                 def func_exec(*args, **kwargs):
-                    logger.debug("Calling %s" % name)
+                    logger.debug("Calling %s", name)
                     import socket
-                    socket.setdefaulttimeout(10)
-                    max_retries = 3
+                    import requests
+                    def call():
+                        self._acquire_admission(name)
+                        try:
+                            token = self._get_token()
+                            val = func(token, *args, **kwargs)
+                            if (val and 
+                                val.get('status') in TOKEN_EXPIRED_STATUSES):
+                                self._invalidate_token(token)
+                                token = self._get_token()
+                                val = func(token, *args, **kwargs)
+                        finally:
+                            self._admission.release()
+                        if not val:
+                            raise ServerError("Got an empty response.")
+                        self._touch_token(token)
+                        return val
+                    start_time = time.time()
                     try:
-                        for c in range(1, max_retries + 1):
-                            try:
-                                val = func(self.token, *args, **kwargs)
-                                if val:
-                                    break
-                            except (socket.error, XmlRpcError) as eX:
-                                logger.debug("Call failed: %d:%s" % (c, eX))
-                                if c <= max_retries:
-                                    continue
-                                else:
-                                    raise eX
-                        if val and val['status'] != OK_STATUS:
+                        val = call_with_retries(
+                            call,
+                            self._retry_policy,
+                            self._circuit_breaker,
+                            (socket.error, XmlRpcError, ServerError,
+                             requests.ConnectionError, requests.Timeout),
+                            self._get_attempt_failed_recorder(name))
+                        if val['status'] != OK_STATUS:
                             raise Exception(
                                 "OpenSubtitles returned error: %s" 
                                 % val['status'])
                     except Exception as eX:
-                        logger.error("Failed calling %s: %s" % (name, eX))
+                        logger.error("Failed calling %s: %s", name, eX)
+                        self._metrics.record_error(self.provider_name, name)
                         return None
-                    logger.debug("Succeeded calling %s." % name)
+                    finally:
+                        bytes_in, bytes_out = \
+                            self._xmlrpc_transport.pop_transferred()
+                        self._metrics.record_request(
+                            self.provider_name, name, time.time() - start_time,
+                            bytes_in, bytes_out)
+                    logger.debug("Succeeded calling %s.", name)
                     return val
                 return func_exec
 
             # Get the name from the server's instance.
             attr = getattr(object.__getattribute__(self, 'server'), name)
-            return func_wrapper(attr)
\ No newline at end of file
+            return func_wrapper(attr)
+
+
+def _load_token(file_path, api_url):
+    """
+    Returns the (token, expiry) that are stored in the file, or (None, 0) if
+    there is no such file, or the token has expired (or belongs to another 
+    api_url).
+    """
+    import json
+    if not file_path or not os.path.exists(file_path):
+        return (None, 0)
+    try:
+        with open(file_path) as token_file:
+            stored = json.load(token_file)
+        if stored['api_url'] != api_url or stored['expiry'] <= time.time():
+            return (None, 0)
+        logger.debug("Using the stored token: %s", stored['token'])
+        return (str(stored['token']), stored['expiry'])
+    except Exception as eX:
+        logger.warning("Failed loading the token: %s", eX)
+        return (None, 0)
+
+def _save_token(file_path, api_url, token, expiry):
+    """
+    The token is a credential, so it's written to a new file that only the
+    user can read (which is never a file or a link that someone else placed
+    there), and the file is then renamed to file_path.
+    """
+    import json
+    if not file_path:
+        return
+    temp_path = "%s.%s.tmp" % (file_path, os.urandom(6).encode('hex'))
+    try:
+        create_parent_directory(file_path)
+        flags = (os.O_WRONLY | os.O_CREAT | os.O_EXCL | 
+            getattr(os, 'O_NOFOLLOW', 0) | getattr(os, 'O_BINARY', 0))
+        with os.fdopen(os.open(temp_path, flags, 0600), 'w') as token_file:
+            json.dump(
+                {'api_url' : api_url, 'token' : token, 'expiry' : expiry}, 
+                token_file)
+        _replace_file(temp_path, file_path)
+    except Exception as eX:
+        logger.warning("Failed saving the token: %s", eX)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def _replace_file(source_path, destination_path):
+    try:
+        os.rename(source_path, destination_path)
+    except OSError:
+        # On Windows, rename doesn't replace an existing file.
+        if not os.path.exists(destination_path):
+            raise
+        os.remove(destination_path)
+        os.rename(source_path, destination_path)
+
+def _remove_token(file_path):
+    if file_path and os.path.exists(file_path):
+        try:
+            os.remove(file_path)
+        except OSError as eX:
+            logger.warning("Failed removing the token: %s", eX)
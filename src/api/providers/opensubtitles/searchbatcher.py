@@ -0,0 +1,177 @@
+import logging
+logger = logging.getLogger(
+    "subit.api.providers.opensubtitles.searchbatcher")
+from threading import Lock, Event
+
+
+__all__ = ['SearchSubtitlesBatcher']
+
+
+# The time the first query of a batch waits for more queries to join it.
+SEARCH_LINGER_SECS = 0.05
+# The maximal number of queries that are sent in a single call.
+MAX_QUERIES_PER_CALL = 10
+# The server returns at most that many rows from a single call, so the rows of
+# a batch that reached the limit might be truncated.
+MAX_ROWS_PER_CALL = 500
+# The fields of the rows that are used to split them back to the queries.
+ROW_FIELDS = ['QueryNumber', 'MovieHash', 'IDMovieImdb', 'QueryParameters']
+
+
+class _Batch(object):
+    """ The queries that will be sent in a single call, and their results. """
+    def __init__(self):
+        self.queries = []
+        # The key of each query => its index in queries.
+        self.indexes = {}
+        # The index of each query => its rows, or None if the call failed.
+        self.results = {}
+        self.error = None
+        self.full = Event()
+        self.done = Event()
+
+    def add(self, query_params):
+        """ Adds the query (unless it's already in), returns its index. """
+        key = tuple(sorted(query_params.items()))
+        if key not in self.indexes:
+            self.indexes[key] = len(self.queries)
+            self.queries.append(query_params)
+        return self.indexes[key]
+
+
+class SearchSubtitlesBatcher(object):
+    """
+    SearchSubtitles accepts a list of queries, so instead of sending a call for
+    each query, the queries that are issued at the same time (by different
+    threads) are sent together. The first query of a batch waits linger_secs
+    for other queries to join, or until the batch has max_queries queries, and
+    then sends the call. Identical queries are sent once.
+
+    The returned rows are split back to the queries: by the QueryNumber of the
+    row if the server returned it, otherwise, by matching the row's MovieHash,
+    IDMovieImdb or query with the query's parameters. If the batch's rows might
+    have been truncated by the server, the queries of the batch are sent again
+    one by one, so each caller gets the same rows as if it sent the query by
+    itself.
+
+    >>> def search_func(queries):
+    ...     return {'status' : '200 OK', 'data' : [
+    ...         {'QueryNumber' : str(idx), 'MovieName' : query['query']}
+    ...         for idx, query in enumerate(queries)]}
+    >>> batcher = SearchSubtitlesBatcher(search_func, linger_secs = 0)
+    >>> [row['MovieName'] for row in batcher.search({'query' : 'matrix'})]
+    ['matrix']
+    """
+    def __init__(self, search_func, linger_secs = SEARCH_LINGER_SECS,
+        max_queries = MAX_QUERIES_PER_CALL):
+        """
+        search_func is called with a list of queries, and should return the
+        response of SearchSubtitles (or None if the call failed).
+        """
+        self.search_func = search_func
+        self.linger_secs = linger_secs
+        self.max_queries = max_queries
+        self._lock = Lock()
+        self._pending = None
+        self._calls = 0
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        return ("<SearchSubtitlesBatcher linger_secs=%s, max_queries=%d, "
+                "calls=%d>" % (self.linger_secs, self.max_queries, self._calls))
+
+    @property
+    def calls(self):
+        """ The number of calls that were sent so far. """
+        return self._calls
+
+    def search(self, query_params):
+        """
+        Sends the query (together with the other pending queries), and returns
+        the rows of its results, or None if the call failed. Exceptions that
+        are raised by search_func are raised to all the callers of the batch.
+        """
+        with self._lock:
+            batch = self._pending
+            is_leader = batch is None
+            if is_leader:
+                batch = self._pending = _Batch()
+            index = batch.add(query_params)
+            if len(batch.queries) >= self.max_queries:
+                self._pending = None
+                batch.full.set()
+
+        if is_leader:
+            batch.full.wait(self.linger_secs)
+            with self._lock:
+                if self._pending is batch:
+                    self._pending = None
+            self._send(batch)
+        else:
+            batch.done.wait()
+
+        if batch.error:
+            raise batch.error
+        return batch.results[index]
+
+    def _send(self, batch):
+        try:
+            logger.debug("Sending %d queries in a single call.",
+                len(batch.queries))
+            rows = self._call(batch.queries)
+            if (rows is not None and len(rows) >= MAX_ROWS_PER_CALL and
+                len(batch.queries) > 1):
+                logger.debug("The rows might be truncated, splitting.")
+                for index, query in enumerate(batch.queries):
+                    batch.results[index] = self._call([query])
+            else:
+                for index, query in enumerate(batch.queries):
+                    batch.results[index] = None if rows is None else [
+                        row for row in rows if _is_row_of(row, query, index)]
+        except Exception as eX:
+            batch.error = eX
+        finally:
+            batch.done.set()
+
+    def _call(self, queries):
+        """ Returns the rows of the response, or None if the call failed. """
+        with self._lock:
+            self._calls += 1
+        response = self.search_func(queries)
+        if not response:
+            return None
+        # The server returns False instead of an empty list.
+        return response['data'] or []
+
+
+def _is_row_of(row, query_params, query_number):
+    """
+    Returns whether the row is one of the results of the query.
+
+    >>> _is_row_of({'QueryNumber' : '1'}, {'query' : 'matrix'}, 1)
+    True
+    >>> _is_row_of({'MovieHash' : 'aa'}, {'moviehash' : 'aa'}, 0)
+    True
+    >>> _is_row_of({'IDMovieImdb' : '133093'}, {'imdbid' : '0133093'}, 0)
+    True
+    >>> _is_row_of(
+    ...     {'QueryParameters' : {'query' : 'matrix'}}, {'query' : 'Matrix'}, 0)
+    True
+    >>> _is_row_of({'MovieHash' : 'aa'}, {'query' : 'matrix'}, 0)
+    False
+    """
+    if 'QueryNumber' in row:
+        return int(row['QueryNumber']) == query_number
+    if 'moviehash' in query_params:
+        return row.get('MovieHash') == query_params['moviehash']
+    if 'imdbid' in query_params:
+        try:
+            return int(row.get('IDMovieImdb')) == int(query_params['imdbid'])
+        except (TypeError, ValueError):
+            return False
+    if 'query' in query_params:
+        row_query = (row.get('QueryParameters') or {}).get('query', '')
+        return row_query.lower() == query_params['query'].lower()
+    return False
@@ -0,0 +1,163 @@
+import logging
+logger = logging.getLogger("subit.api.providers.opensubtitles.titlecache")
+import time
+from threading import Lock
+
+from api.title import MovieTitle, SeriesTitle
+from api.utils import create_parent_directory
+
+
+__all__ = ['TitleCache']
+
+
+# The details of a title hardly ever change, so they are kept for a long time.
+TITLE_TTL_SECS = 30 * 24 * 60 * 60
+
+MOVIE_KIND = 'movie'
+EPISODE_KIND = 'episode'
+
+
+class TitleCache(object):
+    """
+    Stores the titles that were resolved by their imdb id in a small SQLite
+    database, so the details of the same title are not queried again (in this
+    run, or in the next ones) until they are ttl_secs old.
+
+    The series data is stored once for all of its episodes: each episode row
+    holds its own numbering, name and year, and points to a series row that
+    holds the series name. The cache is thread safe.
+
+    >>> cache = TitleCache(":memory:")
+    >>> cache.put("tt0133093", MovieTitle("The Matrix", 1999, "tt0133093"))
+    >>> cache.get("tt0133093")
+    <MovieTitle name='The Matrix', year=1999, imdb_id='tt0133093'>
+    >>> cache.get("tt0234215") is None
+    True
+    """
+    def __init__(self, db_path, ttl_secs = TITLE_TTL_SECS):
+        self.db_path = db_path
+        self.ttl_secs = ttl_secs
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self._connection = None
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        return "<TitleCache db_path='%s', hits=%d, misses=%d>" % (
+            self.db_path, self.hits, self.misses)
+
+    def _get_connection(self):
+        """ Must be called while holding the lock. """
+        if not self._connection:
+            import sqlite3
+            if self.db_path != ":memory:":
+                create_parent_directory(self.db_path)
+            self._connection = sqlite3.connect(
+                self.db_path, check_same_thread = False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS series ("
+                "imdb_id INTEGER PRIMARY KEY, name TEXT, stored_time REAL)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS titles ("
+                "imdb_id INTEGER PRIMARY KEY, kind TEXT, title_imdb_id TEXT, "
+                "name TEXT, year INTEGER, season INTEGER, episode INTEGER, "
+                "series_imdb_id INTEGER, stored_time REAL)")
+        return self._connection
+
+    def get(self, imdb_id):
+        """
+        Returns the title that was stored for the imdb id, or None if it's
+        missing or expired.
+        """
+        min_stored_time = time.time() - self.ttl_secs
+        with self._lock:
+            row = self._get_connection().execute(
+                "SELECT titles.kind, titles.title_imdb_id, titles.name, "
+                "titles.year, titles.season, titles.episode, "
+                "titles.series_imdb_id, series.name FROM titles "
+                "LEFT JOIN series ON titles.series_imdb_id = series.imdb_id "
+                "WHERE titles.imdb_id = ? AND titles.stored_time >= ?",
+                (_get_key(imdb_id), min_stored_time)).fetchone()
+            if not row:
+                self.misses += 1
+                return None
+            self.hits += 1
+
+        (kind, title_imdb_id, name, year, season, episode, series_imdb_id,
+         series_name) = row
+        if kind == MOVIE_KIND:
+            return MovieTitle(name, year, str(title_imdb_id))
+        if series_name is None:
+            return None
+        return SeriesTitle(
+            series_name, season, episode, str(title_imdb_id), name or "", year,
+            _get_imdb_id(series_imdb_id))
+
+    def put(self, imdb_id, title):
+        """ Stores the title (either MovieTitle or SeriesTitle) of imdb_id. """
+        now = time.time()
+        if isinstance(title, SeriesTitle):
+            series_key = _get_key(title.imdb_id)
+            title_row = (
+                _get_key(imdb_id), EPISODE_KIND, title.episode_imdb_id,
+                title.episode_name, title.year, title.season_number,
+                title.episode_number, series_key, now)
+        else:
+            series_key = None
+            title_row = (
+                _get_key(imdb_id), MOVIE_KIND, title.imdb_id, title.name,
+                title.year, None, None, None, now)
+
+        with self._lock:
+            connection = self._get_connection()
+            if series_key is not None:
+                connection.execute(
+                    "INSERT OR REPLACE INTO series VALUES (?, ?, ?)",
+                    (series_key, title.name, now))
+            connection.execute(
+                "INSERT OR REPLACE INTO titles VALUES "
+                "(?, ?, ?, ?, ?, ?, ?, ?, ?)", title_row)
+            connection.commit()
+
+    def get_missing(self, imdb_ids):
+        """
+        Returns the imdb ids (out of the given ones) that are missing from the
+        cache, or expired.
+        """
+        keys = dict((_get_key(imdb_id), imdb_id) for imdb_id in imdb_ids)
+        min_stored_time = time.time() - self.ttl_secs
+        missing = []
+        with self._lock:
+            connection = self._get_connection()
+            for key, imdb_id in sorted(keys.iteritems()):
+                if not connection.execute(
+                    "SELECT 1 FROM titles WHERE imdb_id = ? AND "
+                    "stored_time >= ?", (key, min_stored_time)).fetchone():
+                    missing.append(imdb_id)
+        return missing
+
+    def close(self):
+        with self._lock:
+            if self._connection:
+                self._connection.close()
+                self._connection = None
+
+
+def _get_key(imdb_id):
+    """
+    The ids are stored as integers, so 'tt0133093' and 'tt133093' are the same.
+
+    >>> _get_key('tt0133093')
+    133093
+    """
+    return int(imdb_id.replace("tt", ""))
+
+def _get_imdb_id(key):
+    """
+    >>> _get_imdb_id(133093)
+    'tt0133093'
+    """
+    return "tt%07d" % key
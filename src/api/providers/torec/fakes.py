@@ -0,0 +1,95 @@
+import logging
+logger = logging.getLogger("subit.api.providers.torec.fakes")
+import hashlib
+from threading import Lock
+from collections import OrderedDict
+
+
+__all__ = ['FakeReasons', 'FakesCatalogue', 'get_fakes_catalogue']
+
+
+# The number of bytes from the start of a download that identify it. Torec's
+# fake is a zip file, so these bytes hold the name, the date and the CRC of the
+# file inside it.
+FINGERPRINT_BYTES = 256
+# The number of fakes that the catalogue remembers.
+MAX_KNOWN_FAKES = 64
+
+
+class FakeReasons:
+    """
+    The reasons for which a download from Torec didn't get the subtitle, as
+    they are detected from the responses.
+    """
+    # The ticket was older than MAX_TICKET_SECS once the download request was
+    # answered, i.e., the request waited too long before it was sent.
+    EXPIRED_TICKET      = 'expired ticket'
+    # The download request was answered without the url of the subtitle.
+    REJECTED_DOWNLOAD   = 'rejected download'
+    # The download was an error page rather than a file.
+    INVALID_CONTENT     = 'invalid content'
+    # The download started with the bytes of a fake in the catalogue.
+    KNOWN_FAKE          = 'known fake'
+    # The download was small enough to be the fake, either by the size that
+    # the server reported, or once it was read.
+    FAKE_SIZE           = 'fake size'
+
+
+class FakesCatalogue(object):
+    """
+    Remembers the fingerprints (the hash of the first FINGERPRINT_BYTES bytes)
+    of the fake downloads, so once a fake was downloaded in full, the next ones
+    are recognized by their first bytes, and the rest of them isn't
+    transferred. The last max_fakes fingerprints are kept. The catalogue is
+    thread safe.
+
+    >>> catalogue = FakesCatalogue()
+    >>> catalogue.is_known_fake("PK\\x03\\x04fake")
+    False
+    >>> catalogue.add_fake("PK\\x03\\x04fake")
+    >>> catalogue.is_known_fake("PK\\x03\\x04fake")
+    True
+    >>> catalogue
+    <FakesCatalogue fakes=1>
+    """
+    def __init__(self, max_fakes = MAX_KNOWN_FAKES):
+        self.max_fakes = max_fakes
+        self._lock = Lock()
+        # fingerprint => None, from the least recently seen.
+        self._fingerprints = OrderedDict()
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        return "<FakesCatalogue fakes=%d>" % len(self._fingerprints)
+
+    def _get_fingerprint(self, head):
+        return hashlib.sha1(head[:FINGERPRINT_BYTES]).hexdigest()
+
+    def is_known_fake(self, head):
+        """ Returns whether head is the start of a known fake. """
+        fingerprint = self._get_fingerprint(head)
+        with self._lock:
+            if fingerprint not in self._fingerprints:
+                return False
+            self._fingerprints[fingerprint] = self._fingerprints.pop(
+                fingerprint)
+            return True
+
+    def add_fake(self, head):
+        """ Adds the fake whose first bytes are head to the catalogue. """
+        fingerprint = self._get_fingerprint(head)
+        logger.debug("Adding a fake with the fingerprint: %s", fingerprint)
+        with self._lock:
+            self._fingerprints.pop(fingerprint, None)
+            self._fingerprints[fingerprint] = None
+            while len(self._fingerprints) > self.max_fakes:
+                self._fingerprints.popitem(last = False)
+
+
+_fakes_catalogue = FakesCatalogue()
+
+def get_fakes_catalogue():
+    """ Returns the catalogue that is shared by all the Torec providers. """
+    return _fakes_catalogue
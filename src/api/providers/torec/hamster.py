@@ -1,42 +1,64 @@
 import logging
 logger = logging.getLogger("subit.api.providers.torec.hamster")
-from threading import Thread
-from collections import deque, namedtuple
+from threading import Thread, Condition, Lock
+from collections import deque
+from itertools import count
+import heapq
 import time
 
+from api.exceptions import ProviderUnavailable
+from api.scheduling import Priorities, RequestContext, get_current_context
 from api.providers.torec.provider import TOREC_PAGES
 
-__all__ = ['TorecHashCodesHamster']
+__all__ = ['TorecHashCodesHamster', 'SharedHamster', 'get_shared_hamster',
+           'stop_all_hamsters']
 
 
 # Time it takes for us to invalidate a ticket. The value is taken from the JS
 # in torec handling the waiting time.
 MAX_TICKET_SECS = 10
 TICKETS_QUEUE_SIZE = 5
-RUNNER_MAIN_LOOP_SLEEP_SECS = 1
+# The time to wait before requesting a ticket again after a failure.
+TICKET_RETRY_SECS = 1
+# The number of worker threads of each hamster, which is also the maximum
+# number of ticket requests that it performs at the same time.
+MAX_CONCURRENT_TICKET_REQUESTS = 2
 # The time each sub id will live inside the hamster. After this long, the sub
 # id will be removed from the list.
 MAX_TIME_FOR_SUB_ID_SECS = 120
 
 
 class SubIDRecord(object):
-    def __init__(self, 
-        time_added, post_content, tickets = deque(maxlen=TICKETS_QUEUE_SIZE)):
-
+    def __init__(self, time_added, post_content, tickets = None):
         self.time_added     = time_added
         self.post_content   = post_content
-        self.tickets        = tickets
+        self.tickets        = tickets if tickets is not None else \
+            deque(maxlen=TICKETS_QUEUE_SIZE)
+        # The time that the next ticket should be requested at. None while the
+        # request is in progress.
+        self.next_request_time = None
+        # The number of add_sub_id calls that were not removed yet. The record
+        # is removed once it drops to zero.
+        self.references     = 0
+        # The context of the request in progress. Tickets are requested ahead
+        # of time, with PREFETCH priority, unless someone waits for them.
+        self.request_context = None
+        self.priority = Priorities.PREFETCH
+        # The rank of the sub_id's versions. Among the requests that are due,
+        # the ones of the highest ranked sub_ids are performed first.
+        self.rank = 0
 
     @property
     def should_remove(self):
-        return (int(time.time()) - self.time_added) > MAX_TIME_FOR_SUB_ID_SECS
+        return (time.time() - self.time_added) > MAX_TIME_FOR_SUB_ID_SECS
 
     def __str__(self):
         return repr(self)
 
     def __repr__(self):
         return ("<SubIDRecord time_added={0.time_added} "
-            "post_content={0.post_content} tickets={0.tickets}>".format(self))
+            "post_content={0.post_content} tickets={0.tickets} "
+            "references={0.references} rank={0.rank}>".format(self))
 
 
 class TorecTicket(object):
@@ -48,19 +70,28 @@ class TorecTicket(object):
 
     @property
     def time_past(self):
-        return int(time.time()) - self.time_got
-    
+        return int(time.time() - self.time_got)
+
     @property
     def time_to_wait(self):
-        return MAX_TICKET_SECS - self.time_past
+        return MAX_TICKET_SECS - (time.time() - self.time_got)
 
     @property
     def is_still_valid(self):
         return self.time_to_wait >= 0
 
+    @property
+    def is_expired(self):
+        """
+        Whether the ticket is too old to be used. Unlike is_still_valid, it's
+        true only once the whole seconds that passed (which is what Torec is
+        told) are more than MAX_TICKET_SECS.
+        """
+        return self.time_past > MAX_TICKET_SECS
+
     def wait_required_time(self):
         ttw = self.time_to_wait
-        if ttw:
+        if ttw > 0:
             logger.debug("Ticket requires sleeping for {} secs".format(ttw))
             time.sleep(ttw)
 
@@ -74,124 +105,343 @@ class TorecTicket(object):
 
 class TorecHashCodesHamster(object):
     """
-    The hamster is responsible for obtaining download tickets from Torec's 
+    The hamster is responsible for obtaining download tickets from Torec's
     servers for all the sub_ids that was passed to it.
 
-    The hamster iterates over all its sub_ids, and makes sure that they have
-    valid ticket. Each sub_id has a queue of size TICKETS_QUEUE_SIZE that gets
-    filled as time passes.
+    The ticket requests are kept in a heap ordered by the time they are due.
+    A ticket is requested for a sub_id when it's added, and then again when
+    its last ticket is about to expire (or once it's taken), so a valid ticket
+    is always on its way without requesting tickets that nobody will use. The
+    worker thread sleeps until the next request is due, and get_ticket blocks
+    until a ticket arrives. Each sub_id has a queue of size TICKETS_QUEUE_SIZE
+    for its tickets.
 
     The hamster keeps requesting tickets for a given sub_id until the user marks
-    that sub_id for deletion.
+    that sub_id for deletion, or MAX_TIME_FOR_SUB_ID_SECS pass.
+
+    The requests are performed by max_workers threads, which live until stop
+    is called. The providers share a single hamster through
+    get_shared_hamster, rather than starting threads of their own.
     """
-    def __init__(self, requests_manager):
+    def __init__(self, requests_manager,
+        max_workers = MAX_CONCURRENT_TICKET_REQUESTS):
         self._requests_manager = requests_manager
 
         self._should_stop = False
         self._records = {}
-        # Start at his own thread.
-        hamsterRunner = Thread(target=self._runner)
-        hamsterRunner.daemon = True
-        hamsterRunner.start()
+        # Guards the records and the heap. Notified when a ticket is added, and
+        # when the heap or the stop flag change.
+        self._condition = Condition()
+        # (due time, sequence, sub_id, record) of the ticket requests.
+        self._requests_heap = []
+        self._sequence = count()
+        # The workers hold a reference to the hamster, so it's never destroyed
+        # before stop is called.
+        self._workers = []
+        for idx in range(max_workers):
+            worker = Thread(target=self._runner)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
 
-    def __del__(self):
-        """ 
-        On destruction, we call the stop method in order to stop the worker 
-        thread.
-        """
-        self.stop()
-
-    def _ensure_has_ticket(self, sub_id):
-        record = self._records[sub_id]
-
-        guest_code = None
-        while not guest_code:
-            logger.debug(
-                "Getting ticket with: {}".format(record.post_content))
-            guest_code = self._requests_manager.perform_request_next(
-                TOREC_PAGES.TICKET,
-                data = record.post_content)
-            if guest_code == 'error':
+    @property
+    def is_stopped(self):
+        return self._should_stop
+
+    def _schedule_request(self, sub_id, record, due_time):
+        """ Must be called while holding the condition. """
+        record.next_request_time = due_time
+        heapq.heappush(
+            self._requests_heap,
+            (due_time, next(self._sequence), sub_id, record))
+        self._condition.notify_all()
+
+    def _pop_due_requests(self, now):
+        """
+        Must be called while holding the condition. Pops the requests that are
+        due by now, and returns their (due time, sequence, sub_id, record). The
+        entries of removed records and rescheduled requests are dropped.
+        """
+        due_requests = []
+        while self._requests_heap and self._requests_heap[0][0] <= now:
+            entry = heapq.heappop(self._requests_heap)
+            due_time, _, sub_id, record = entry
+            if self._records.get(sub_id) is not record or \
+                record.next_request_time != due_time:
+                continue
+            if record.should_remove:
+                logger.debug(
+                    "_runner Removing record for sub_id: {}".format(sub_id))
+                del self._records[sub_id]
+                continue
+            due_requests.append(entry)
+        return due_requests
+
+    def _wait_for_due_request(self):
+        """
+        Must be called while holding the condition. Returns the (sub_id, record)
+        of the next request once it's due, or (None, None) when stopped. If a 
+        few requests are due, the one of the highest ranked sub_id is returned 
+        (the earliest one among equal ranks), and the rest stay in the heap.
+        """
+        while not self._should_stop:
+            if not self._requests_heap:
+                self._condition.wait()
+                continue
+
+            time_left = self._requests_heap[0][0] - time.time()
+            if time_left > 0:
+                self._condition.wait(time_left)
+                continue
+
+            due_requests = self._pop_due_requests(time.time())
+            if not due_requests:
+                continue
+            # t[3] is the record, and t[:2] is (due time, sequence).
+            due_requests.sort(key=lambda t: (-t[3].rank, t[:2]))
+            for entry in due_requests[1:]:
+                heapq.heappush(self._requests_heap, entry)
+
+            _, _, sub_id, record = due_requests[0]
+            record.next_request_time = None
+            return sub_id, record
+
+        return None, None
+
+    def _request_ticket(self, sub_id, record):
+        logger.debug("Getting ticket with: {}".format(record.post_content))
+        with self._condition:
+            context = record.request_context = RequestContext(record.priority)
+        try:
+            # The request is queued with the priority of its context, which is
+            # raised if get_ticket waits for it (see _raise_priority).
+            with context:
+                guest_code = self._requests_manager.perform_request_next(
+                    TOREC_PAGES.TICKET,
+                    data = record.post_content,
+                    priority = None)
+        except ProviderUnavailable as eX:
+            # Wait for the provider's circuit to half-open.
+            logger.warning("Failed getting ticket: {}".format(eX))
+            guest_code = None
+
+        with self._condition:
+            # The waiters (if there are any) raise the priority again.
+            record.request_context = None
+            record.priority = Priorities.PREFETCH
+            if not guest_code or guest_code == 'error':
                 logger.error(
                     "Failed getting ticket for sub_id: {}".format(sub_id))
+                self._schedule_request(
+                    sub_id, record, time.time() + TICKET_RETRY_SECS)
+                return
 
-        time_got = int(time.time())
-        ticket = TorecTicket(sub_id, time_got, guest_code)
-        logger.debug("Got ticket: {}".format(ticket))
-        record.tickets.append(ticket)
+            ticket = TorecTicket(sub_id, time.time(), guest_code)
+            logger.debug("Got ticket: {}".format(ticket))
+            record.tickets.append(ticket)
+            # The next ticket is requested as this one is about to expire.
+            self._schedule_request(
+                sub_id, record, ticket.time_got + MAX_TICKET_SECS)
 
     def _runner(self):
-        """ 
-        The worker in this class. each 5 secs send request for hash code, and 
-        stores it in the queue, the queue is built from tuple -> (time of 
-        request, hash code). After 10 items, the queue is blocked.
+        """
+        The worker in this class. Sleeps until the next ticket request is due,
+        performs it, and stores the ticket in the queue of the sub_id.
         """
         logger.debug("_runner started.")
 
-        while not self._should_stop:
-            # Because the dict might change during iteration, we can't use the 
-            # iterX methods.
-            for sub_id in self._records.keys():
-                record = self._records[sub_id]
-                if record.should_remove:
-                    logger.debug(
-                        "_runner Removing record for sub_id: {}".format(sub_id))
-                    del self._records[sub_id]
-                else:
-                    self._ensure_has_ticket(sub_id)
-
-            time.sleep(RUNNER_MAIN_LOOP_SLEEP_SECS)
-        
+        while True:
+            with self._condition:
+                sub_id, record = self._wait_for_due_request()
+            if record is None:
+                break
+            self._request_ticket(sub_id, record)
+
         logger.debug("_runner ending.")
 
     def stop(self):
-        """ Signals the working thread to stop. """
-        self._should_stop = True
+        """ Signals the working threads to stop. """
+        with self._condition:
+            self._should_stop = True
+            self._condition.notify_all()
 
-    def add_sub_id(self, sub_id):
-        """ 
-        Adds sub_id to the dict. Does not check whether or not that sub_id is
-        in the dict already. This means that if a ticket was already obtained, 
-        it will be removed for that sub_id.
-        """
+    def _add_record(self, sub_id, rank = 0):
+        """ Must be called while holding the condition. """
         # s according to Torec's JS is the screen width.
         post_content = {"sub_id" : sub_id, "s" : 1600}
         logger.debug("Constructed post_content: {}".format(post_content))
-        record = SubIDRecord(int(time.time()), post_content)
+        record = SubIDRecord(time.time(), post_content)
+        record.rank = rank
         self._records[sub_id] = record
+        self._schedule_request(sub_id, record, time.time())
+        return record
+
+    def add_sub_id(self, sub_id, rank = 0):
+        """
+        Adds sub_id to the dict, or adds a reference to it if it's in the dict
+        already (i.e., another provider added it). In that case, its tickets 
+        are kept, and it lives for another MAX_TIME_FOR_SUB_ID_SECS. Each call
+        should be followed by a call to remove_sub_id.
+
+        rank is the rank of the sub_id's versions (between 0 to 100). When the
+        ticket requests of a few sub_ids are due, the highest ranked go first.
+        The sub_id keeps the highest rank it was added with.
+        """
+        with self._condition:
+            record = self._records.get(sub_id)
+            if record is None:
+                record = self._add_record(sub_id, rank)
+            else:
+                record.time_added = time.time()
+                record.rank = max(record.rank, rank)
+            record.references += 1
 
     def remove_sub_id(self, sub_id):
-        del self._records[sub_id]
+        """
+        Removes a reference to the sub_id, and removes it from the dict once
+        there are no references left.
+        """
+        with self._condition:
+            record = self._records.get(sub_id)
+            if record is None:
+                return
+            record.references -= 1
+            if record.references <= 0:
+                del self._records[sub_id]
+
+    def _raise_priority(self, record, priority):
+        """
+        Raises the priority of the record's ticket requests (including the one
+        in progress) to priority. Must be called while holding the condition.
+        """
+        if priority >= record.priority:
+            return
+        record.priority = priority
+        if record.request_context:
+            record.request_context.raise_priority(priority)
 
     def _get_valid_ticket(self, sub_id):
-        record = self._records[sub_id]
-        tickets = record.tickets
-        while not tickets:
-            time.sleep(0.5)
-
-        ticket = tickets.popleft()
-        while not ticket.is_still_valid and tickets:
-            ticket = tickets.popleft()
+        """
+        Blocks until a valid ticket is available for the sub_id, and returns
+        it. Raises ProviderUnavailable if the hamster is stopped meanwhile.
 
-        # Recursion if there are no valid tickets
-        if not ticket.is_still_valid:
-            return _get_valid_ticket(sub_id)
+        While waiting, the ticket request is raised to the caller's priority,
+        but never above DOWNLOAD, since the ticket is needed for a download.
+        """
+        priority = max(get_current_context().priority, Priorities.DOWNLOAD)
+        with self._condition:
+            while not self._should_stop:
+                record = self._records.get(sub_id)
+                if record is None:
+                    record = self._add_record(sub_id)
+
+                tickets = record.tickets
+                while tickets and not tickets[0].is_still_valid:
+                    tickets.popleft()
+                if tickets:
+                    ticket = tickets.popleft()
+                    # Don't wait for the taken ticket to expire in order to
+                    # request the next one.
+                    if not tickets and record.next_request_time is not None:
+                        self._schedule_request(sub_id, record, time.time())
+                    return ticket
+
+                self._raise_priority(record, priority)
+                self._condition.wait()
+
+        raise ProviderUnavailable("The hamster was stopped.")
 
-        return ticket
-        
     def get_ticket(self, sub_id):
-        """ 
-        Retrieve the ticket associated with the provided sub_id. If the sub_id 
-        is not in the dict, this methods adds it. 
+        """
+        Retrieve the ticket associated with the provided sub_id. If the sub_id
+        is not in the dict, this methods adds it.
 
         The method waits until the appropriate time is passed for that ticket.
         """
-        if sub_id not in self._records:
-            self.add_sub_id(sub_id)
-
         ticket = self._get_valid_ticket(sub_id)
         logger.debug("Got a ticket: {}".format(ticket))
         ticket.wait_required_time()
 
         return ticket
-        
+
+
+class SharedHamster(object):
+    """
+    A reference to the hamster that is shared by all the users of a requests
+    manager, as returned by get_shared_hamster. Has the same methods as the
+    hamster for the tickets. The reference is released by release, or once
+    it's destroyed, and the hamster is stopped when its last reference is
+    released.
+    """
+    def __init__(self, requests_manager, hamster):
+        self._requests_manager = requests_manager
+        self.hamster = hamster
+
+    def __del__(self):
+        self.release()
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        return "<SharedHamster hamster={}>".format(self.hamster)
+
+    def add_sub_id(self, sub_id, rank = 0):
+        self.hamster.add_sub_id(sub_id, rank)
+
+    def remove_sub_id(self, sub_id):
+        self.hamster.remove_sub_id(sub_id)
+
+    def get_ticket(self, sub_id):
+        return self.hamster.get_ticket(sub_id)
+
+    def release(self):
+        """ Releases the reference. Does nothing if it was released already. """
+        with _hamsters_lock:
+            hamster, self.hamster = self.hamster, None
+            if hamster is None:
+                return
+            shared = _hamsters.get(self._requests_manager)
+            if not shared or shared[0] is not hamster:
+                # The hamster was stopped by stop_all_hamsters.
+                return
+            shared[1] -= 1
+            if shared[1]:
+                return
+            del _hamsters[self._requests_manager]
+        logger.debug("Stopping the hamster of: {}".format(
+            self._requests_manager))
+        hamster.stop()
+
+
+_hamsters_lock = Lock()
+# requests manager => [hamster, number of references]
+_hamsters = {}
+
+def get_shared_hamster(requests_manager):
+    """
+    Returns a new SharedHamster reference to the hamster of the requests
+    manager, and starts the hamster if it has no other references. So however
+    many providers are created, each requests manager is served by a single
+    hamster, with a constant number of threads.
+    """
+    with _hamsters_lock:
+        shared = _hamsters.get(requests_manager)
+        if not shared:
+            logger.debug("Starting a hamster for: {}".format(requests_manager))
+            shared = _hamsters[requests_manager] = [
+                TorecHashCodesHamster(requests_manager), 0]
+        shared[1] += 1
+        return SharedHamster(requests_manager, shared[0])
+
+def stop_all_hamsters():
+    """
+    Stops all the shared hamsters, and forgets about them, so the next call to
+    get_shared_hamster will start a new one. Should be called once the work
+    against Torec is finished.
+    """
+    with _hamsters_lock:
+        hamsters = [hamster for hamster, _ in _hamsters.values()]
+        _hamsters.clear()
+    for hamster in hamsters:
+        hamster.stop()
@@ -3,20 +3,30 @@ logger = logging.getLogger("subit.api.providers.torec.provider")
 from bs4 import BeautifulSoup
 import re
 from collections import namedtuple
+from threading import Lock
 
+from api.providers import PREFETCH_VERSIONS
 from api.providers.providersnames import ProvidersNames
 from api.providers.iprovider import IProvider
 from api.title import SeriesTitle, MovieTitle
-from api.version import ProviderVersion
+from api.version import ProviderVersion, rank_version
 from api.titlesversions import TitlesVersions
 from api.languages import Languages
 from api.utils import get_regex_match, get_regex_results
+from api.scheduling import Priorities
 from api.exceptions import HTMLParsingError
+from api.exceptions import InvalidDownloadContent
+from api.providers.torec.fakes import FakeReasons, FINGERPRINT_BYTES
+from api.providers.torec.fakes import get_fakes_catalogue
 
 
 __all__ = ['TorecProvider']
 
 
+# The input's ratio in the rank of a version (see api.version.rank_version),
+# when it's checked against TorecProvider.early_stop_rank.
+RANK_INPUT_RATIO = 60
+
 class TOREC_PAGES:
     DOMAIN   = r'www.torec.net'
     TICKET   = r'http://{}/ajax/sub/guest_time.asp'.format(DOMAIN)
@@ -33,18 +43,26 @@ class TorecProvider(IProvider):
     supported_languages = [
         Languages.HEBREW
     ]
+    # If set, get_title_versions skips the sub pages that were not fetched yet
+    # once it finds a version of the same title as the input's, whose rank is
+    # at least early_stop_rank.
+    early_stop_rank = None
 
     def __init__(self, languages, requests_manager):
         super(TorecProvider, self).__init__(languages, requests_manager)
-        from api.providers.torec.hamster import TorecHashCodesHamster
-        self._hamster = TorecHashCodesHamster(self.requests_manager)
-
-    def _get_provider_versions_for_subid(self, sub_id):
+        from api.providers.torec.hamster import get_shared_hamster
+        # Released once the provider is destroyed.
+        self._hamster = get_shared_hamster(self.requests_manager)
+        # The sub_ids that tickets are obtained for ahead of time, ordered by
+        # the ranks of their versions (see _set_prefetched_versions). The 
+        # provider holds a reference to each of them in the hamster. Guarded by
+        # the lock, since the downloads might run in other threads.
+        self._prefetched_sub_ids = []
+        self._prefetched_sub_ids_lock = Lock()
+
+    def _get_provider_versions_for_subid(self, sub_id, sub_page):
         from api.identifiersextractor import extract_identifiers
 
-        sub_page = self.requests_manager.perform_request(
-            TOREC_PAGES.SUB_PAGE.format(sub_id))
-
         soup = BeautifulSoup(sub_page)
         title = _get_title_from_sub_page(soup)
 
@@ -79,16 +97,168 @@ class TorecProvider(IProvider):
         sub_ids = _get_subids_from_tables_headers(tables_headers)
         logger.debug("Found sub_ids: {}".format(sub_ids))
 
+        sub_ids_versions = self._get_sub_ids_versions(sub_ids, title, version)
         titles_versions = TitlesVersions()
+        # The versions are added in the order of the search results, whatever
+        # the order that the sub pages arrived in.
+        provider_versions = []
         for sub_id in sub_ids:
-            self._hamster.add_sub_id(sub_id)
-            versions = self._get_provider_versions_for_subid(sub_id)
-            logger.debug("Got versions: {}".format(len(versions)))
-            for version in versions:
-                titles_versions.add_version(version)
+            for provider_version in sub_ids_versions.get(sub_id, []):
+                titles_versions.add_version(provider_version)
+                provider_versions.append(provider_version)
 
+        self._prefetch_best_versions(title, version, provider_versions)
         return titles_versions
 
+    def _prefetch_best_versions(self, title, version, provider_versions):
+        """
+        Obtains tickets ahead of time for the PREFETCH_VERSIONS versions that
+        are the likeliest to be downloaded: the versions of the input's title
+        first, from the highest rank against the input's version. Versions 
+        with the same rank keep the order of the search results.
+        """
+        def _get_rank(provider_version):
+            if not version:
+                return 0
+            return rank_version(version, provider_version, RANK_INPUT_RATIO)
+
+        ranked_versions = [
+            (_get_rank(provider_version), provider_version)
+            for provider_version in provider_versions]
+        # t[1] is the version, t[0] is its rank. The sort is stable.
+        ranked_versions.sort(key=lambda t: (t[1].title != title, -t[0]))
+        self._set_prefetched_versions(ranked_versions[:PREFETCH_VERSIONS])
+
+    def _get_async_requests_manager(self):
+        """
+        Returns the async front of the requests manager (see 
+        api.asyncrequestsmanager), whose pool of workers is shared by all the
+        providers that use the manager. Returns None if the manager was not
+        created by get_manager_instance, so it has no such front.
+        """
+        from api.requestsmanager import get_manager_instance
+        full_name = self.provider_name.full_name
+        if get_manager_instance(full_name) is not self.requests_manager:
+            return None
+        return get_manager_instance(full_name, asynchronous = True)
+
+    def _get_sub_ids_versions(self, sub_ids, title, version):
+        """
+        Fetches the sub pages of the sub_ids concurrently (as many at a time as
+        the requests manager's max_in_flight setting), by the async front of 
+        the requests manager, and parses them in the order of the sub_ids. 
+        Returns a dict of sub_id => its provider versions. If early_stop_rank 
+        is set, the sub_ids whose pages were not fetched by the time a good 
+        enough version was found are missing from the dict.
+
+        The pages are requested with the RequestContext of the caller (with its
+        priority and cancellation). A page is requested only once there is a
+        free in-flight slot, so the early stop doesn't leave requests behind. 
+        If the requests manager has no async front, the pages are fetched one 
+        at a time.
+        """
+        from collections import deque
+        async_manager = self._get_async_requests_manager()
+        if async_manager:
+            max_in_flight = self.requests_manager.settings['max_in_flight']
+        else:
+            max_in_flight = 1
+
+        pending_sub_ids = deque(sub_ids)
+        # (sub_id, AsyncResult or None) of the pages in flight, in order.
+        in_flight = deque()
+        def _request_next_page():
+            sub_id = pending_sub_ids.popleft()
+            sub_page_url = TOREC_PAGES.SUB_PAGE.format(sub_id)
+            if async_manager:
+                in_flight.append(
+                    (sub_id, async_manager.perform_request(sub_page_url)))
+            else:
+                in_flight.append((sub_id, None))
+
+        sub_ids_versions = {}
+        while pending_sub_ids or in_flight:
+            while pending_sub_ids and len(in_flight) < max_in_flight:
+                _request_next_page()
+            sub_id, result = in_flight.popleft()
+            if result:
+                sub_page = result.get()
+            else:
+                sub_page = self.requests_manager.perform_request(
+                    TOREC_PAGES.SUB_PAGE.format(sub_id))
+            versions = self._get_provider_versions_for_subid(sub_id, sub_page)
+            logger.debug("Got versions for sub_id {}: {}".format(
+                sub_id, len(versions)))
+            sub_ids_versions[sub_id] = versions
+            if self._is_good_enough(title, version, versions):
+                logger.debug("Skipping the rest of the sub pages.")
+                break
+        return sub_ids_versions
+
+    def _is_good_enough(self, title, version, provider_versions):
+        if self.early_stop_rank is None or not version:
+            return False
+        return any(
+            provider_version.title == title and 
+            rank_version(version, provider_version, RANK_INPUT_RATIO) >= 
+                self.early_stop_rank
+            for provider_version in provider_versions)
+
+    def _set_prefetched_versions(self, ranked_versions):
+        """
+        Prefetches the tickets of the sub_ids of ranked_versions, a list of
+        (rank, provider_version) from the likeliest to be downloaded. Each 
+        sub_id is passed to the hamster with the rank of its first version, so
+        its tickets are requested before the ones of lower ranked sub_ids.
+        """
+        sub_ids_ranks = []
+        for rank, provider_version in ranked_versions:
+            sub_id = provider_version.attributes['sub_id']
+            if sub_id not in [s for s, _ in sub_ids_ranks]:
+                sub_ids_ranks.append((sub_id, rank))
+        logger.debug("Prefetching tickets for sub_ids: {}".format(
+            sub_ids_ranks))
+        self._set_prefetched_sub_ids(sub_ids_ranks)
+
+    def _set_prefetched_sub_ids(self, sub_ids_ranks):
+        sub_ids = [sub_id for sub_id, _ in sub_ids_ranks]
+        with self._prefetched_sub_ids_lock:
+            for sub_id in self._prefetched_sub_ids:
+                if sub_id not in sub_ids:
+                    self._hamster.remove_sub_id(sub_id)
+            for sub_id, rank in sub_ids_ranks:
+                if sub_id not in self._prefetched_sub_ids:
+                    self._hamster.add_sub_id(sub_id, rank)
+            self._prefetched_sub_ids = sub_ids
+
+    def _drop_prefetched_sub_id(self, sub_id):
+        with self._prefetched_sub_ids_lock:
+            if sub_id in self._prefetched_sub_ids:
+                self._prefetched_sub_ids.remove(sub_id)
+                self._hamster.remove_sub_id(sub_id)
+
+    def prefetch_versions(self, provider_versions):
+        """
+        Obtains tickets for the sub_ids of the versions ahead of time, so their
+        download doesn't wait for the whole ticket time. The tickets are 
+        requested by the ranks of the versions (and by their order, among equal
+        ranks), and the tickets of the sub_ids that were prefetched before (and
+        are not in the versions) are dropped.
+        """
+        self._set_prefetched_versions(
+            [(provider_version.rank, provider_version)
+             for provider_version in provider_versions])
+
+    def version_selected(self, provider_version):
+        """ 
+        Drops the tickets of all the sub_ids but the one of the selected 
+        version (if it's a version of Torec).
+        """
+        selected_versions = []
+        if provider_version.provider is self:
+            selected_versions = [(provider_version.rank, provider_version)]
+        self._set_prefetched_versions(selected_versions)
+
     def download_subtitle_buffer(self, provider_version):
         sub_id       = provider_version.attributes['sub_id']
         version_code = provider_version.attributes['version_code']
@@ -96,53 +266,75 @@ class TorecProvider(IProvider):
         # The fake subtitle file is inside a zip file. The size of the zip file
         # is ~3KB. We set  our limit to 4KB just in case...
         fake_file_size_limit = 4096
+        # Counts both the fakes and the download requests that were rejected.
         max_fake_downloads = 5
 
+        fake_reasons = []
+
         def _try_download():
-            fake_downloads_count = 0
-            headers_to_add = {
-                'Cookie'  : 'Torec%5FNC%5Fs=1600;',
-                'Referer' : TOREC_PAGES.SUB_PAGE.format(sub_id)
-            }
+            headers_to_add = _get_download_headers(sub_id)
+            # The download request is sent with the caller's priority, and the
+            # download itself with DOWNLOAD priority, unless a ticket expires.
+            request_priority = None
+            download_priority = Priorities.DOWNLOAD
             # Run until we reach maximum fake downloads
-            while fake_downloads_count < max_fake_downloads:
+            while len(fake_reasons) < max_fake_downloads:
                 logger.debug("Trying to download: {}/{}".format(
-                    fake_downloads_count, max_fake_downloads))
-                sub_url = None
-                # Until we get a legit sub_url value.
-                while not sub_url:
-                    ticket = self._hamster.get_ticket(sub_id)
-                    post_data = _get_download_post_data(ticket, version_code)
-                    # Retrieve the result (the url to the subtitle)
-                    sub_url = self.requests_manager.perform_request(
-                        TOREC_PAGES.DOWNLOAD,
-                        data = post_data,
-                        more_headers = headers_to_add)
-
-                    if not sub_url.startswith("/ajax/sub/sdls.asp"):
-                        logger.debug("Got bad url: {!r}".format(sub_url))
-                        sub_url = None
-                        continue
-
-                    file_name, content = self.requests_manager.download_file(
-                        "http://{}/{}".format(
-                            TOREC_PAGES.DOMAIN, sub_url.lstrip("/")),
-                        more_headers = headers_to_add)
-                    file_size = len(content)
-                    # If it's not the fake one.
-                    if file_size > fake_file_size_limit:
+                    len(fake_reasons), max_fake_downloads))
+                ticket = self._hamster.get_ticket(sub_id)
+                post_data = _get_download_post_data(ticket, version_code)
+                # Retrieve the result (the url to the subtitle)
+                sub_url = self.requests_manager.perform_request(
+                    TOREC_PAGES.DOWNLOAD,
+                    data = post_data,
+                    more_headers = headers_to_add,
+                    priority = request_priority)
+                ticket_expired = ticket.is_expired
+
+                if not sub_url.startswith("/ajax/sub/sdls.asp"):
+                    logger.debug("Got bad url: {!r}".format(sub_url))
+                    response_reason = FakeReasons.REJECTED_DOWNLOAD
+                else:
+                    download_url = "http://{}/{}".format(
+                        TOREC_PAGES.DOMAIN, sub_url.lstrip("/"))
+                    try:
+                        file_name, content, response_reason = \
+                            _download_unless_fake(
+                                self.requests_manager.open_download(
+                                    download_url, 
+                                    more_headers = headers_to_add,
+                                    priority = download_priority),
+                                fake_file_size_limit, get_fakes_catalogue())
+                    except InvalidDownloadContent as eX:
+                        logger.debug("Got bad download: {}".format(eX))
+                        response_reason = FakeReasons.INVALID_CONTENT
+                    if not response_reason:
                         logger.debug('Received real subtitle from Torec!')
-                        self._hamster.remove_sub_id(sub_id)
+                        self._drop_prefetched_sub_id(sub_id)
                         return (file_name, content)
-                    # If it's a fake, increase the counter.
-                    else:
-                        logger.debug('Received fake subtitle from Torec!')
-                        fake_downloads_count = fake_downloads_count + 1
+
+                reason = _get_fake_reason(ticket_expired, response_reason)
+                logger.debug('Received fake subtitle from Torec: '
+                    '{}'.format(reason))
+                fake_reasons.append(reason)
+                # Each try takes the next ticket of the hamster. An expired 
+                # ticket means that our requests waited behind other requests,
+                # so the next ones go before them.
+                if reason == FakeReasons.EXPIRED_TICKET:
+                    request_priority = download_priority = \
+                        Priorities.INTERACTIVE
             return (None, None)
 
-        file_name, content = _try_download()
+        # Hold a reference to the sub_id while downloading, so the next ticket
+        # is ready if the download turns out to be a fake.
+        self._hamster.add_sub_id(sub_id)
+        try:
+            file_name, content = _try_download()
+        finally:
+            self._hamster.remove_sub_id(sub_id)
         if not (file_name and content):
-            logger.error("Failed downloading subtitle from Torec.")
+            logger.error("Failed downloading subtitle from Torec, the fakes "
+                "reasons: {}".format(fake_reasons))
         else:
             logger.debug("Downloaded file: {}".format(file_name))
         return (file_name, content)
@@ -258,3 +450,52 @@ def _get_download_post_data(ticket, version_code):
         # Code for the specific version
         'code'          : version_code
     }
+
+def _get_download_headers(sub_id):
+    return {
+        'Cookie'  : 'Torec%5FNC%5Fs=1600;',
+        'Referer' : TOREC_PAGES.SUB_PAGE.format(sub_id)
+    }
+
+def _get_fake_reason(ticket_expired, response_reason):
+    """
+    Returns the FakeReasons value that explains why the download didn't get the
+    subtitle. response_reason is the reason that was detected from the 
+    responses, unless the ticket had expired by the time the download request
+    was answered, which explains them.
+
+    >>> _get_fake_reason(False, FakeReasons.KNOWN_FAKE)
+    'known fake'
+    >>> _get_fake_reason(True, FakeReasons.KNOWN_FAKE)
+    'expired ticket'
+    """
+    if ticket_expired:
+        return FakeReasons.EXPIRED_TICKET
+    return response_reason
+
+def _download_unless_fake(download, fake_file_size_limit, fakes_catalogue):
+    """
+    Returns (file_name, content, None) of the download, or (None, '', reason)
+    if it's the fake subtitle, where reason is the FakeReasons value of the
+    way it was recognized. The fake is recognized before its body is 
+    transferred if the server reported a size that fits it, and by its first
+    bytes if they are in the fakes_catalogue (a FakesCatalogue instance). 
+    Otherwise, it's recognized by its size once it's read, and added to the 
+    catalogue.
+    """
+    with download:
+        content_length = download.content_length
+        if content_length is not None and \
+            content_length <= fake_file_size_limit:
+            logger.debug(
+                "Skipping download of {} bytes.".format(content_length))
+            return (None, '', FakeReasons.FAKE_SIZE)
+        head = download.peek(FINGERPRINT_BYTES)
+        if fakes_catalogue.is_known_fake(head):
+            logger.debug("Skipping download of a known fake.")
+            return (None, '', FakeReasons.KNOWN_FAKE)
+        content = download.read()
+        if len(content) <= fake_file_size_limit:
+            fakes_catalogue.add_fake(head)
+            return (None, '', FakeReasons.FAKE_SIZE)
+        return (download.file_name, content, None)
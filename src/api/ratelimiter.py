@@ -0,0 +1,271 @@
+import logging
+logger = logging.getLogger("subit.api.ratelimiter")
+import time
+import heapq
+import itertools
+from threading import Lock, Condition
+
+from exceptions import RequestCancelled
+from scheduling import Priorities, get_current_context
+
+
+__all__ = ['TokenBucket', 'AdmissionController']
+
+
+class TokenBucket(object):
+    """
+    A simple token bucket. Tokens are added to the bucket at a constant rate
+    (rate tokens per second), up to capacity tokens. Each request consumes a
+    single token, and if the bucket is empty, the caller sleeps until the token
+    it reserved is added.
+    """
+    def __init__(self, rate, capacity = None):
+        """
+        >>> TokenBucket(0)
+        Traceback (most recent call last):
+            ...
+        ValueError: rate must be positive.
+        >>> TokenBucket(0.5)
+        <TokenBucket rate=0.50, capacity=1.00>
+        >>> TokenBucket(4)
+        <TokenBucket rate=4.00, capacity=4.00>
+        """
+        if rate <= 0:
+            raise ValueError("rate must be positive.")
+        self.rate = float(rate)
+        # By default, we allow a burst of a single second.
+        self.capacity = float(capacity or max(1.0, self.rate))
+        self._tokens = self.capacity
+        self._last_time = time.time()
+        self._lock = Lock()
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        return ("<TokenBucket rate=%(rate).2f, capacity=%(capacity).2f>"
+            % self.__dict__)
+
+    def reserve(self):
+        """
+        Takes a token from the bucket, and returns the number of seconds that
+        the caller must wait before it's allowed to use it (0 if the token is
+        already available). The token count can go below zero, this way, the
+        waiting callers are served in the order they reserved their tokens.
+
+        >>> bucket = TokenBucket(1)
+        >>> bucket.reserve()
+        0
+        >>> 0 < bucket.reserve() <= 1
+        True
+        """
+        with self._lock:
+            now = time.time()
+            self._tokens = min(
+                self.capacity,
+                self._tokens + (now - self._last_time) * self.rate)
+            self._last_time = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def consume(self):
+        """ Takes a token from the bucket, sleeping until it's available. """
+        wait_secs = self.reserve()
+        if wait_secs:
+            logger.debug("Waiting %.2f secs for a token.", wait_secs)
+            time.sleep(wait_secs)
+
+
+class _Waiter(object):
+    """ A request that waits in the queue of the AdmissionController. """
+    def __init__(self, priority, context):
+        self.priority = priority
+        self.context = context
+
+
+class AdmissionController(object):
+    """
+    Decides when a request is allowed to be sent to a provider. A request is
+    admitted only when the number of requests in flight is lower than
+    max_in_flight, and after a token was taken from the bucket (if
+    requests_per_second was specified).
+
+    While there is no free slot, the requests wait in a queue that is ordered
+    by their priority class (see api.scheduling.Priorities), and in FIFO order
+    within each class. The priority and the cancellation of a request are taken
+    from the RequestContext of the calling thread, unless specified.
+
+    Usage:
+
+    controller = AdmissionController(requests_per_second = 2, max_in_flight = 3)
+    with controller:
+        send_the_request()
+    """
+    def __init__(self, requests_per_second = None, max_in_flight = 1):
+        """
+        >>> AdmissionController(2, 3)
+        <AdmissionController requests_per_second=2, max_in_flight=3, \
+        in_flight=0>
+        >>> AdmissionController(max_in_flight = 0)
+        Traceback (most recent call last):
+            ...
+        ValueError: max_in_flight must be at least 1.
+        """
+        self._condition = Condition(Lock())
+        self._in_flight = 0
+        # A heap of (priority, sequence, waiter), the sequence keeps the FIFO
+        # order within each priority.
+        self._queue = []
+        self._sequence = itertools.count()
+        self._peak_queue_depths = dict.fromkeys(Priorities.names, 0)
+        self.configure(requests_per_second, max_in_flight)
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        return ("<AdmissionController requests_per_second=%s, "
+            "max_in_flight=%s, in_flight=%d>" %
+            (self.requests_per_second, self.max_in_flight, self._in_flight))
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def configure(self, requests_per_second = None, max_in_flight = 1):
+        """
+        Replaces the limits of the controller. requests_per_second can be None,
+        in that case, only the max_in_flight limit is applied. Requests that
+        are already in flight are not affected.
+        """
+        if max_in_flight < 1:
+            raise ValueError("max_in_flight must be at least 1.")
+        with self._condition:
+            self.requests_per_second = requests_per_second
+            self.max_in_flight = max_in_flight
+            self._bucket = (
+                TokenBucket(requests_per_second)
+                if requests_per_second else None)
+            # The limit might got bigger, so let the waiters check again.
+            self._condition.notify_all()
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    @property
+    def queue_depths(self):
+        """
+        Returns a dictionary from the name of each priority class to the number
+        of requests of that class that are waiting for admission.
+
+        >>> AdmissionController().queue_depths["interactive"]
+        0
+        """
+        with self._condition:
+            return self._get_queue_depths()
+
+    def _get_queue_depths(self):
+        depths = dict.fromkeys(Priorities.names.values(), 0)
+        for priority, sequence, waiter in self._queue:
+            depths[Priorities.names[priority]] += 1
+        return depths
+
+    @property
+    def peak_queue_depths(self):
+        """ Like queue_depths, but the maximal depths since the creation. """
+        with self._condition:
+            return dict(
+                (Priorities.names[priority], depth)
+                for priority, depth in self._peak_queue_depths.iteritems())
+
+    def wake_waiters(self):
+        """ Lets the waiting requests check whether they were cancelled. """
+        with self._condition:
+            self._condition.notify_all()
+
+    def reprioritize(self, context):
+        """
+        Moves the waiting requests of the context to the context's priority, if
+        it's higher than the priority they were queued with. Their FIFO order
+        within the new class is kept by the time they were queued.
+        """
+        with self._condition:
+            for idx, (priority, sequence, waiter) in enumerate(self._queue):
+                if waiter.context is context and context.priority < priority:
+                    waiter.priority = context.priority
+                    self._queue[idx] = (context.priority, sequence, waiter)
+            heapq.heapify(self._queue)
+            self._condition.notify_all()
+
+    def acquire(self, priority = None, context = None):
+        """
+        Blocks until the request is allowed to be sent. Each call must be
+        followed by a call to release() once the response is received.
+
+        The request waits in the queue with the given priority (or with the 
+        priority of the context). If the context gets cancelled while the
+        request waits, RequestCancelled is raised.
+        """
+        context = context or get_current_context()
+        if priority is None:
+            priority = context.priority
+
+        with self._condition:
+            if context.cancelled:
+                raise RequestCancelled("The request was cancelled.")
+            if self._queue or self._in_flight >= self.max_in_flight:
+                self._wait_in_queue(priority, context)
+            self._in_flight += 1
+            bucket = self._bucket
+
+        if bucket:
+            bucket.consume()
+
+    def _wait_in_queue(self, priority, context):
+        """
+        Waits until the request is the first in the queue, and a slot is free.
+        Must be called while holding the condition.
+        """
+        # Once the controller is registered, raising the context's priority 
+        # reprioritizes the request, and until then, the raised priority is 
+        # read here.
+        context.register_controller(self)
+        priority = min(priority, context.priority) \
+            if context.priority_raised else priority
+        waiter = _Waiter(priority, context)
+        heapq.heappush(self._queue, (priority, next(self._sequence), waiter))
+        depth = sum(1 for e in self._queue if e[0] == priority)
+        self._peak_queue_depths[priority] = max(
+            self._peak_queue_depths[priority], depth)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Queued a %s request, queue depths: %s", 
+                Priorities.names[priority], self._get_queue_depths())
+
+        try:
+            # The entry of the waiter is replaced when it's reprioritized.
+            while not context.cancelled and not (
+                self._queue[0][2] is waiter and 
+                self._in_flight < self.max_in_flight):
+                self._condition.wait()
+        finally:
+            if self._queue[0][2] is waiter:
+                heapq.heappop(self._queue)
+            else:
+                self._queue = [e for e in self._queue if e[2] is not waiter]
+                heapq.heapify(self._queue)
+            context.unregister_controller(self)
+        # The next waiter might be admitted now (or the head was cancelled).
+        self._condition.notify_all()
+        if context.cancelled:
+            raise RequestCancelled("The request was cancelled.")
+
+    def release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
@@ -1,17 +1,114 @@
 import logging
-import utils
 logger = logging.getLogger("subit.api.requestsmanager")
+import time
+import socket
 
 from exceptions import InvalidProviderName
-
-
-__all__ = ['RequestsManager', 'get_manager_instance']
+from exceptions import RequestsManagerClosed
+from exceptions import ProviderUnavailable
+from exceptions import RequestCancelled
+from ratelimiter import AdmissionController
+from scheduling import Priorities, get_current_context
+from retrypolicy import RetryPolicy, RetryBudget, CircuitBreaker
+from retrypolicy import call_with_retries
+from singleflight import SingleFlight
+from metrics import MetricsRegistry, get_endpoint_class
+
+
+__all__ = [
+    'RequestsManager', 'get_manager_instance', 'configure_manager',
+    'close_all_managers', 'get_metrics', 'reset_metrics', 'dump_metrics'
+]
+
+# The number of per-host connection pools that each session keeps. Providers
+# usually talk with a single host, so a small number is enough.
+DEFAULT_POOL_CONNECTIONS = 4
+# The number of keep-alive connections that we keep open against a single host.
+DEFAULT_POOL_MAXSIZE = 4
+REQUEST_TIMEOUT_SECS = 10
+# Responses with these status codes mean that the server is in trouble (or that
+# we're sending too many requests), so the request is retried.
+RETRYABLE_STATUS_CODES = [429, 500, 502, 503, 504]
+# Subtitles (even zipped ones) are way smaller than that.
+DEFAULT_MAX_DOWNLOAD_BYTES = 10 * 1024 * 1024
+# Passed as the cache entry of a request when it wasn't loaded from the cache.
+_NOT_LOADED = object()
+
+# The settings that each manager uses unless specified otherwise (either in the
+# constructor or via configure_manager()). By default, only a single request is
+# in flight against each provider, and the rate is not limited. SubiT applies
+# the limits of each provider from its config at startup.
+DEFAULT_SETTINGS = {
+    'pool_connections'      : DEFAULT_POOL_CONNECTIONS,
+    'pool_maxsize'          : DEFAULT_POOL_MAXSIZE,
+    'requests_per_second'   : None,
+    'max_in_flight'         : 1,
+    # A ResponseCache instance (see api.responsecache), or None for no caching.
+    'cache'                 : None,
+    # Failed requests are retried with exponential backoff and jitter. Retries
+    # are limited to retry_budget_ratio of the requests (see RetryBudget).
+    'max_attempts'          : 3,
+    'backoff_base_secs'     : 1,
+    'backoff_max_secs'      : 8,
+    'retry_budget_ratio'    : 0.2,
+    # After failure_threshold consecutive failed requests, the provider is 
+    # considered unavailable for cooldown_secs (see CircuitBreaker).
+    'failure_threshold'     : 5,
+    'cooldown_secs'         : 60,
+    # Downloads that are bigger than this are aborted (see api.downloads).
+    'max_download_bytes'    : DEFAULT_MAX_DOWNLOAD_BYTES,
+    # A RecordTransport or a ReplayTransport (see api.transports), or None to
+    # send the requests to the network as usual.
+    'transport'             : None,
+}
+
+
+# The metrics of the requests of all the managers.
+_metrics = MetricsRegistry()
 
 
 class RequestsManager(object):
-    def __init__(self):
-        from threading import Lock
-        self._requests_mutex = Lock()
+    # The settings that the manager accepts, and their default values. 
+    # Subclasses may extend them with settings of their own.
+    default_settings = DEFAULT_SETTINGS
+
+    def __init__(self, provider_name = None, **settings):
+        """
+        Each manager owns a single requests Session, so the connections to the
+        provider's servers are kept alive and reused between the requests
+        (instead of paying for a new TCP connection on each request).
+
+        The settings are the keys of default_settings:
+        pool_connections is the number of hosts for which we cache a connection
+        pool, and pool_maxsize is the maximum number of connections that are
+        kept open against a single host. requests_per_second and max_in_flight
+        are the limits that are applied by the manager's AdmissionController.
+        cache is an optional ResponseCache that stores the responses on disk.
+        The retry settings control the retry policy and the circuit breaker of
+        the manager, and max_download_bytes is the size limit of downloads.
+        transport allows to record the requests into a fixture archive, or to
+        replay them from one.
+
+        The provider_name is used as the name of the manager in the metrics
+        (see get_metrics()).
+
+        >>> RequestsManager(no_such_setting = 1)
+        Traceback (most recent call last):
+            ...
+        TypeError: Unknown settings: ['no_such_setting']
+        """
+        self.provider_name = provider_name or type(self).__name__
+        self._metrics = _metrics
+        self._admission = AdmissionController()
+        # If the request in flight is cancelled, one of the requests that
+        # wait for it is sent instead.
+        self._single_flight = SingleFlight(unshared_errors = [RequestCancelled])
+        self._retry_policy = RetryPolicy(budget = RetryBudget())
+        self._circuit_breaker = CircuitBreaker()
+        self._closed = False
+        self._session = None
+        self.settings = dict(self.default_settings)
+        self.configure(**settings)
 
     def __str__(self):
         return repr(self)
@@ -19,142 +116,614 @@ class RequestsManager(object):
     def __repr__(self):
         return '<%s>' % type(self).__name__
 
-    def perform_request_text(self, url, data = '', more_headers = {}):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def pool_connections(self):
+        return self.settings['pool_connections']
+
+    @property
+    def pool_maxsize(self):
+        return self.settings['pool_maxsize']
+
+    @property
+    def admission_controller(self):
+        return self._admission
+
+    @property
+    def circuit_breaker(self):
+        return self._circuit_breaker
+
+    @property
+    def is_available(self):
+        """
+        False while the provider's circuit is open, i.e., after the provider
+        failed consistently, and requests to it fail fast without being sent.
+        """
+        return self._circuit_breaker.is_available
+
+    @property
+    def coalesced_requests(self):
+        """ The number of requests that were served by an identical request. """
+        return self._single_flight.coalesced
+
+    def configure(self, **settings):
+        """
+        Updates the given settings (the keys of default_settings), and leaves
+        the others as they are. If the pools sizes (or the transport) are 
+        changed, the session's connection pools are replaced with new ones (and
+        the connections of the previous pools are closed).
+        """
+        unknown_settings = set(settings).difference(self.default_settings)
+        if unknown_settings:
+            raise TypeError("Unknown settings: %s" % sorted(unknown_settings))
+
+        logger.debug("Configuring %s with: %s", self, settings)
+        pools_changed = any(
+            settings.get(key, self.settings[key]) != self.settings[key]
+            for key in ['pool_connections', 'pool_maxsize', 'transport'])
+        self.settings.update(settings)
+
+        self._admission.configure(
+            self.settings['requests_per_second'], 
+            self.settings['max_in_flight'])
+
+        self._retry_policy.max_attempts = self.settings['max_attempts']
+        self._retry_policy.base_delay_secs = self.settings['backoff_base_secs']
+        self._retry_policy.max_delay_secs = self.settings['backoff_max_secs']
+        self._retry_policy.budget.ratio = self.settings['retry_budget_ratio']
+        self._circuit_breaker.configure(
+            self.settings['failure_threshold'], 
+            self.settings['cooldown_secs'])
+
+        if pools_changed or not self._session:
+            self._mount_session()
+
+    def _mount_session(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        session = requests.Session()
+        transport = self.settings['transport']
+        for prefix in ['http://', 'https://']:
+            adapter = HTTPAdapter(
+                pool_connections = self.pool_connections, 
+                pool_maxsize = self.pool_maxsize)
+            if transport:
+                adapter = transport.get_adapter(adapter)
+            session.mount(prefix, adapter)
+
+        old_session, self._session = self._session, session
+        if old_session:
+            old_session.close()
+
+    def close(self):
+        """
+        Closes all the connections that are kept alive by the manager. After 
+        calling this method, any attempt to send a request with the manager will
+        raise RequestsManagerClosed. Calling close more than once is allowed.
+        """
+        logger.debug("Closing %s", self)
+        self._closed = True
+        if self._session:
+            self._session.close()
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def _ensure_not_closed(self):
+        if self._closed:
+            raise RequestsManagerClosed("The requests manager is closed.")
+
+    def perform_request_text(
+        self, url, data = '', more_headers = {}, priority = None):
         """
         A simple helper method. Executes perform_request, and than stripes away
         any white spaces (e.g., "\\r\\n\\t").
         """
         from api.utils import strip_white_spaces
-        response = self.perform_request(url, data, more_headers)
+        response = self.perform_request(
+            url, data, more_headers, priority = priority)
         return strip_white_spaces(response)
 
-    def perform_request(
-        self, url, data = '', more_headers = {}, response_headers = []):
+    def perform_request(self, url, data = '', more_headers = {}, 
+        response_headers = [], priority = None):
         """
-        Locks the requests mutex, and after that, sends the request. If the
-        mutex is already lock, the function will block until the mutex is
-        released, and we manage to lock it.
+        Waits until the manager's AdmissionController admits the request (i.e.,
+        until there is a free in-flight slot, and a token in the rate limiter),
+        and after that, sends the request. If the manager has a cache, and the
+        response is fresh in it, the response is returned right away without
+        waiting for admission. 
+        
+        If an identical GET request with the same priority is already in 
+        flight, the call waits for it and returns its response, instead of 
+        sending the request again.
+
+        If the provider's circuit is open, ProviderUnavailable is raised right
+        away, and so it is if the request still fails after all the attempts
+        that the manager's RetryPolicy allows.
+
+        While waiting for admission, the request is queued with the given 
+        priority (one of api.scheduling.Priorities), or with the priority of 
+        the current RequestContext if it's None. If the context is cancelled
+        while the request is queued, RequestCancelled is raised.
         """
         logger.debug("perform_request got called.")
-        with self._requests_mutex:
-            return self._perform_request(
-                url, data, more_headers, response_headers)
+        return self._admitted_request(
+            url, data, more_headers, response_headers, priority)
 
-    def perform_request_next(
-        self, url, data = '', more_headers = {}, response_headers = []):
+    def perform_request_next(self, url, data = '', more_headers = {}, 
+        response_headers = [], priority = Priorities.DOWNLOAD):
         """
-        Perform a request without locking the mutex.
+        Perform a request that is admitted in the same way as perform_request,
+        but by default, it is queued before the queries (and after the 
+        interactive ones), like a download.
         """
         logger.debug("perform_request_next got called.")
-        return self._perform_request(url, data, more_headers, response_headers)
+        return self._admitted_request(
+            url, data, more_headers, response_headers, priority)
+
+    def _admitted_request(self, url, data, more_headers, response_headers, 
+        priority = None, cacheable = True):
+
+        self._ensure_not_closed()
+        # The entry is loaded once, and reused for revalidating it if it's
+        # stale.
+        cache_entry = self._get_cache_entry(url, data) if cacheable else None
+        if self._is_cache_hit(url, cache_entry):
+            return _format_response(
+                cache_entry.content, cache_entry.headers, response_headers)
+
+        # Don't wait for admission if the request will fail anyway.
+        if not self._circuit_breaker.is_available:
+            raise ProviderUnavailable("%s is unavailable." % self)
+
+        # Identical GET requests that are sent at the same time are coalesced 
+        # into a single request. POST requests (tickets, downloads, xml-rpc) 
+        # are not idempotent, so each one of them is sent. Requests of 
+        # different priorities are not coalesced, so an interactive request 
+        # never waits for a prefetch that is queued behind other requests.
+        if cacheable and not data:
+            if priority is None:
+                priority = get_current_context().priority
+            key = (url, tuple(sorted(more_headers.items())), 
+                tuple(response_headers), priority)
+            response = self._single_flight.do(
+                key, self._admitted_perform_request, url, data, 
+                more_headers, response_headers, priority, cacheable, 
+                cache_entry)
+            return _copy_response(response)
+
+        return self._admitted_perform_request(
+            url, data, more_headers, response_headers, priority, cacheable, 
+            cache_entry)
+
+    def _admitted_perform_request(self, url, data, more_headers, 
+        response_headers, priority, cacheable, cache_entry = _NOT_LOADED):
+        self._acquire_admission(get_endpoint_class(url), priority)
+        try:
+            return self._perform_request(
+                url, data, more_headers, response_headers, cacheable, 
+                cache_entry)
+        finally:
+            self._admission.release()
+
+    def _acquire_admission(self, endpoint, priority = None):
+        """ Acquires the admission, and records the time we waited for it. """
+        start_time = time.time()
+        self._admission.acquire(priority)
+        self._metrics.record_queue_wait(
+            self.provider_name, endpoint, time.time() - start_time)
+
+    def _get_cache_entry(self, url, data):
+        """
+        Returns the cached entry for the request (which might be stale), or None
+        if it's missing or the manager has no cache.
+        """
+        cache = self.settings['cache']
+        return cache.get(url, data) if cache else None
+
+    def _is_cache_hit(self, url, entry):
+        """
+        Returns whether the cached entry is fresh, and records the hit in the
+        cache if it is.
+        """
+        if not entry or not entry.is_fresh:
+            return False
+        logger.debug("Found fresh response in the cache: %s", entry)
+        self.settings['cache'].record_hit(entry)
+        self._metrics.record_cache_hit(
+            self.provider_name, get_endpoint_class(url))
+        return True
 
     def _perform_request(
-        self, url, data = '', more_headers = {}, response_headers = []):
+        self, url, data = '', more_headers = {}, response_headers = [],
+        cacheable = True, cache_entry = _NOT_LOADED):
         """
         Performs a simple http requests. We are using fake user-agents. If the
         data arg is provided, a POST request will be sent instead of GET. Also,
         you can specify more headers by supplying a dict in the more_headers
         arg. 
 
-        The data is returned as-is using the requests module.
+        The request is sent through the manager's session, thus, reusing the
+        kept-alive connections. The data is returned as-is using the requests 
+        module.
+
+        If the manager has a cache and cacheable is True, a fresh response from
+        the cache is returned without sending the request. A stale response is
+        revalidated with the server (if the server sent ETag or Last-Modified
+        headers with it), and successful responses are stored in the cache. 
+        The caller can pass the cache_entry that it loaded already (or None if 
+        it's missing), so it's not loaded again.
+
+        Connection errors, timeouts and server errors are retried according to
+        the manager's RetryPolicy, and are recorded in its CircuitBreaker. If
+        they persist after all the attempts, ProviderUnavailable is raised. If
+        the request fails otherwise (e.g., with a client error), an empty 
+        content is returned.
         """
         logger.debug(
-            "_perform_request got called with: '%s', '%s', %s" %
-            (url, data, more_headers))
-        from useragents import get_agent
+            "_perform_request got called with: '%s', '%s', %s",
+            url, data, more_headers)
         import requests
+        from useragents import get_agent
 
+        cache = self.settings['cache'] if cacheable else None
+        if not cache:
+            cache_entry = None
+        elif cache_entry is _NOT_LOADED:
+            cache_entry = cache.get(url, data)
+            if self._is_cache_hit(url, cache_entry):
+                return _format_response(
+                    cache_entry.content, cache_entry.headers, response_headers)
+
+        headers = {'User-Agent': get_agent()}
+        # In case of specifying more headers, we add them
+        headers.update(more_headers)
+        # If we got a stale response, ask the server whether it changed.
+        if cache_entry:
+            headers.update(cache_entry.validation_headers)
+        logger.debug("Request headers: %s", headers)
+
+        endpoint = get_endpoint_class(url)
+        response_content = ''
+        all_headers = {}
+        start_time = time.time()
         try:
-            headers = {'User-Agent': get_agent()}
-            # In case of specifying more headers, we add them
-            headers.update(more_headers)
-
-            logger.debug("Request headers: %s" % headers)
-
-            response_content = ''
-            returned_headers = {}
-            # Try 3 times.
-            for error_count in range(1, 4):
-                try:
-                    logger.debug(
-                        "Sending request for the %d time." % error_count)
-                    if data:
-                        response = requests.post(url, headers=headers, data=data, timeout=10)
-                    else:
-                        response = requests.get(url, headers=headers, timeout=10)
-
-                    assert response.ok
-                    response_content = response.content
-
-                    # Iterate over the requested headers. This way, if no header
-                    # was specified, we perform nothing, instead of first 
-                    # iterating over the returned headers and checking whether
-                    # they're in the response_header.
-                    for header in response_headers:
-                        if header in response.headers:
-                            header_value = response.headers[header]
-                            logger.debug("Adding response header: %s=%s"
-                                % (header, header_value))
-                            returned_headers[header] = header_value
-                    # If we got the response, break the loop.
-                    break
-                except Exception as error:
-                    logger.debug("Request failed: %s" % error)
-                    # Sleep some time before we request it again.
-                    from time import sleep
-                    sleep(2)
+            response = self._send_request(url, data, headers)
+
+            if cache_entry and response.status_code == 304:
+                logger.debug("The cached response is still valid.")
+                cache.refresh(cache_entry)
+                cache.record_hit(cache_entry, revalidated = True)
+                self._metrics.record_cache_hit(self.provider_name, endpoint)
+                response_content = cache_entry.content
+                all_headers = cache_entry.headers
+            else:
+                # Client errors (e.g., 404) are not retried.
+                response.raise_for_status()
+                response_content = response.content
+                all_headers = response.headers
+                if cache:
+                    cache.record_miss()
+                    cache.put(url, data, response_content, all_headers)
+                    self._metrics.record_cache_miss(
+                        self.provider_name, endpoint)
+        except ProviderUnavailable:
+            raise
+        except (requests.ConnectionError, requests.Timeout, ServerError) as eX:
+            logger.error("Request failed after all the attempts: %s", eX)
+            self._metrics.record_error(self.provider_name, endpoint)
+            self._metrics.record_request(
+                self.provider_name, endpoint, time.time() - start_time,
+                0, _get_body_size(data))
+            raise ProviderUnavailable("%s is unavailable: %s" % (self, eX))
+        except Exception as eX:
+            logger.error("Request flow failed: %s", eX)
+            self._metrics.record_error(self.provider_name, endpoint)
+
+        self._metrics.record_request(
+            self.provider_name, endpoint, time.time() - start_time,
+            len(response_content), _get_body_size(data))
+        logger.debug("Response length is: %d", len(response_content))
+        return _format_response(response_content, all_headers, response_headers)
+
+    def _send_request(self, url, data, headers, stream = False):
+        """
+        Sends the request through the session, retrying according to the 
+        manager's RetryPolicy and CircuitBreaker. Returns the response, whose 
+        body is not read yet if stream is True.
+        """
+        import requests
+
+        def send_request():
+            if data:
+                response = self._session.post(
+                    url, headers=headers, data=data, stream=stream,
+                    timeout=REQUEST_TIMEOUT_SECS)
+            else:
+                response = self._session.get(
+                    url, headers=headers, stream=stream,
+                    timeout=REQUEST_TIMEOUT_SECS)
+            if response.status_code in RETRYABLE_STATUS_CODES:
+                response.close()
+                raise ServerError(
+                    "Server returned: %d" % response.status_code)
+            return response
+
+        return call_with_retries(
+            send_request, 
+            self._retry_policy, 
+            self._circuit_breaker,
+            (requests.ConnectionError, requests.Timeout, ServerError),
+            self._get_attempt_failed_recorder(get_endpoint_class(url)))
+
+    def _get_attempt_failed_recorder(self, endpoint):
+        """
+        Returns a callback for call_with_retries, that records the retries and
+        the timeouts in the metrics.
+        """
+        import requests
+        def on_attempt_failed(error, will_retry):
+            if isinstance(error, (requests.Timeout, socket.timeout)):
+                self._metrics.record_timeout(self.provider_name, endpoint)
+            if will_retry:
+                self._metrics.record_retry(self.provider_name, endpoint)
+        return on_attempt_failed
+
+    def open_download(self, url, data = '', more_headers = {}, 
+        priority = Priorities.DOWNLOAD):
+        """
+        Sends the download request, and returns a Download instance (see 
+        api.downloads) once the response headers are received. The body is not
+        transferred until the download is read, so the caller can look at the
+        download's content_length and decide to skip it. 
+
+        The request holds an in-flight slot of the manager's 
+        AdmissionController until the download is closed, so it should be used
+        as a context manager:
 
+        with manager.open_download(url) as download:
+            if download.content_length > 4096:
+                content = download.read()
+
+        Raises FailedDownloadingSubtitleBuffer if the request failed. The 
+        request is queued for admission with the given priority.
+        """
+        from useragents import get_agent
+        from downloads import Download
+        from exceptions import FailedDownloadingSubtitleBuffer
+        logger.debug("open_download got called with: '%s', '%s', %s",
+            url, data, more_headers)
+
+        self._ensure_not_closed()
+        if not self._circuit_breaker.is_available:
+            raise ProviderUnavailable("%s is unavailable." % self)
+
+        headers = {'User-Agent': get_agent()}
+        headers.update(more_headers)
+        endpoint = get_endpoint_class(url)
+        self._acquire_admission(endpoint, priority)
+        start_time = time.time()
+        try:
+            response = self._send_request(url, data, headers, stream = True)
+            if not response.ok:
+                response.close()
+                raise FailedDownloadingSubtitleBuffer(
+                    "Server returned: %d" % response.status_code)
+        except ProviderUnavailable:
+            self._admission.release()
+            raise
         except Exception as eX:
-            logger.error("Request flow failed: %s" % eX)
+            self._admission.release()
+            self._metrics.record_error(self.provider_name, endpoint)
+            raise FailedDownloadingSubtitleBuffer(
+                "Failed downloading %s: %s" % (url, eX))
 
-        logger.debug("Response length is: %d" % len(response_content))
+        latency_secs = time.time() - start_time
+        def on_close():
+            self._admission.release()
+            self._metrics.record_request(self.provider_name, endpoint, 
+                latency_secs, download.bytes_read, _get_body_size(data))
 
-        if not response_headers:
-            return response_content
-        else:
-            return (response_content, returned_headers)
+        download = Download(
+            url, response, self.settings['max_download_bytes'], on_close)
+        return download
 
-    def download_file(self, url, data = '', more_headers = {}):
+    def download_file(self, url, data = '', more_headers = {}, 
+        priority = Priorities.DOWNLOAD):
         """
         Downloads the file from the given URL. Returns the name for the 
         downloaded file, and the file buffer itself.
 
         Tries to extract the file name from the Content-Disposition header, 
         otherwise, the last portion of the URL is returned.
-        """
-        content, headers = self.perform_request_next(
-            url,
-            data,
-            more_headers,
-            response_headers = ["Content-Disposition"])
 
-        if not content:
-            from api.exceptions import FailedDownloadingSubtitleBuffer
-            raise FailedDownloadingSubtitleBuffer(
-                "Failed downloading: %s" % url)
-
-        # Extract the file name from the headers.
-        file_name = ""
-        if not "Content-Disposition" in headers or \
-            'filename' not in headers["Content-Disposition"]:
-            
-            logger.debug("Failed getting the file name for the download.")
-            splitted_url = url.rsplit('/', 1)
-            if len(splitted_url) == 2:
-                file_name = splitted_url[1]
-        else:
-            file_name = utils.take_first(utils.get_regex_results(
-                headers["Content-Disposition"],
-                "(?<=filename\=).*(?=$)"))
-            file_name = file_name.strip('"\'')
-
-        logger.debug("Downloaded file name is: %s" % file_name)
+        The body is streamed and checked as described in api.downloads, and 
+        FailedDownloadingSubtitleBuffer (or one of its subclasses) is raised if
+        the download failed.
+        """
+        # Downloads are never taken from the cache.
+        with self.open_download(
+            url, data, more_headers, priority) as download:
+            content = download.read()
+            file_name = download.file_name
 
+        logger.debug("Downloaded file name is: %s", file_name)
         return (file_name, content)
 
 
+class ServerError(Exception):
+    """ Raised when the server answers with a retryable status code. """
+    pass
+
+
+def _format_response(content, headers, response_headers):
+    """
+    Returns the content as-is if no response headers were requested, otherwise,
+    returns a tuple of (content, requested_headers). Only the requested headers
+    that are present in the headers are returned. The lookup is case 
+    insensitive.
+
+    >>> _format_response("content", {"Content-Length" : "7"}, [])
+    'content'
+    >>> _format_response(
+    ...     "content", {"content-length" : "7"}, ["Content-Length", "No-Such"])
+    ('content', {'Content-Length': '7'})
+    """
+    if not response_headers:
+        return content
+
+    from requests.structures import CaseInsensitiveDict
+    headers = CaseInsensitiveDict(headers)
+    returned_headers = {}
+    # Iterate over the requested headers. This way, if no header was specified,
+    # we perform nothing, instead of first iterating over the returned headers 
+    # and checking whether they're in the response_header.
+    for header in response_headers:
+        if header in headers:
+            logger.debug(
+                "Adding response header: %s=%s", header, headers[header])
+            returned_headers[header] = headers[header]
+    return (content, returned_headers)
+
+def _get_body_size(data):
+    """
+    Returns the size of the request's body.
+
+    >>> _get_body_size("abc")
+    3
+    >>> _get_body_size({"a" : "1"})
+    3
+    """
+    if isinstance(data, dict):
+        from urllib import urlencode
+        data = urlencode(data)
+    return len(data or '')
+
+def _copy_response(response):
+    """
+    The content of a coalesced response is an immutable string that is shared
+    between all the callers, but the headers dictionary is copied, so a caller
+    can't change the headers that other callers see.
+    """
+    if isinstance(response, tuple):
+        content, headers = response
+        return (content, dict(headers))
+    return response
+
+
+from threading import Lock
 _instances = {}
-def get_manager_instance(provider_name):
+# AsyncRequestsManager instances, each wraps the manager in _instances with the
+# same provider name.
+_async_instances = {}
+_instances_lock = Lock()
+# provider name => a lock that is held while the provider's manager is created
+# or configured, so creating the manager of one provider doesn't block the 
+# callers that ask for the managers of the others.
+_creation_locks = {}
+# The keyword arguments that will be passed to the manager of each provider 
+# when it gets created. Filled by configure_manager().
+_managers_settings = {}
+
+def configure_manager(provider_name, **settings):
+    """
+    Sets the settings (the RequestsManager's constructor keyword arguments) for
+    the manager of provider_name. If the manager was already created, the 
+    settings are applied to it right away, otherwise, they will be used once 
+    it gets created.
+
+    >>> configure_manager("configured_name", pool_maxsize = 2)
+    >>> get_manager_instance("configured_name").pool_maxsize
+    2
+    >>> configure_manager("configured_name", pool_maxsize = 3)
+    >>> get_manager_instance("configured_name").pool_maxsize
+    3
+    >>> configure_manager("configured_name", max_in_flight = 4)
+    >>> get_manager_instance("configured_name").admission_controller
+    <AdmissionController requests_per_second=None, max_in_flight=4, \
+    in_flight=0>
+    """
+    logger.debug("Configuring %s with: %s", provider_name, settings)
+    with _get_creation_lock(provider_name):
+        with _instances_lock:
+            _managers_settings.setdefault(provider_name, {}).update(settings)
+            manager = (_async_instances.get(provider_name) or 
+                _instances.get(provider_name))
+        if manager:
+            manager.configure(**settings)
+
+def close_all_managers():
+    """
+    Closes all the managers that were created by the factory, and forgets about
+    them, so the next call to get_manager_instance will create a new instance.
+    Should be called once the work against the providers is finished.
+
+    >>> a = get_manager_instance("a")
+    >>> close_all_managers()
+    >>> a.closed
+    True
+    >>> get_manager_instance("a") is a
+    False
+    """
+    with _instances_lock:
+        managers = _async_instances.values() + _instances.values()
+        _instances.clear()
+        _async_instances.clear()
+    for manager in managers:
+        manager.close()
+
+def get_metrics():
+    """
+    Returns the metrics of the requests that were sent by all the managers, as
+    a dictionary of provider name => endpoint class => metrics. The endpoint
+    class is the first component of the url's path (or the method name for 
+    xml-rpc calls). The metrics of each endpoint are:
+
+    requests, bytes_in, bytes_out, retries, timeouts, errors, cache_hits, 
+    cache_misses - Counters.
+    latency_secs, queue_wait_secs - Histograms (see api.metrics.Histogram) of 
+    the time it took to get the response (including the retries), and of the 
+    time the request waited for admission.
+
+    >>> reset_metrics()
+    >>> get_metrics()
+    {}
+    """
+    return _metrics.get_metrics()
+
+def reset_metrics():
+    """ Clears all the metrics that were recorded so far. """
+    _metrics.reset()
+
+def dump_metrics(file_path = None):
+    """
+    Returns the metrics as a JSON string, and writes it to file_path if it's 
+    specified.
+    """
+    return _metrics.dump_json(file_path)
+
+def _get_creation_lock(provider_name):
+    with _instances_lock:
+        return _creation_locks.setdefault(provider_name, Lock())
+
+def _create_manager(provider_name, settings):
+    from api.providers import ProvidersNames
+    if provider_name == ProvidersNames.OPEN_SUBTITLES.full_name:
+        from api.providers.opensubtitles import OpenSubtitlesRequestsManager
+        cls_type = OpenSubtitlesRequestsManager
+    else:
+        cls_type = RequestsManager
+    logger.debug("Creating request manager instance of type: %s", cls_type)
+    return cls_type(provider_name = provider_name, **settings)
+
+def get_manager_instance(provider_name, asynchronous = False):
     """
     A RequestsManager factory that given the same provider name will return
     the same RequestsManager instance.
@@ -162,10 +731,15 @@ def get_manager_instance(provider_name):
     If OpenSubtitles's provider is given, OpenSubtitles's request manager
     instances is returned, and not the default RequestManager.
 
-    This currently isn't a thread safe factory, so in case where to
-    different threads trying to receive a RequestsManager for a
-    provider_name that hasn't already been initialized, will get in to a
-    race condition, in which they might end up with different instances.
+    The factory is thread safe, different threads that ask for the same 
+    provider_name at the same time will receive the same instance (and thus, 
+    the same connections pool). The manager is created while holding a lock
+    of its provider only, so threads that ask for other providers don't wait
+    for it.
+
+    If asynchronous is True, an AsyncRequestsManager is returned instead (see
+    api.asyncrequestsmanager). It wraps the same manager that is returned for
+    the provider_name, so both share the provider's limits.
 
     >>> a = get_manager_instance("a")
     >>> b = get_manager_instance("a")
@@ -190,22 +764,37 @@ def get_manager_instance(provider_name):
     <OpenSubtitlesRequestsManager ...>
     >>> get_manager_instance("some_name")
     <RequestsManager>
+    >>> get_manager_instance("some_name", asynchronous = True)
+    <AsyncRequestsManager manager=<RequestsManager>, workers=1>
     """
-    logger.debug("Getting instance for: %s" % provider_name)
+    logger.debug("Getting instance for: %s", provider_name)
     if not provider_name:
         raise InvalidProviderName("provider_name can not be empty.")
     if not isinstance(provider_name, str):
         raise InvalidProviderName("provider_name must be a string.")
 
-    global _instances
-    if not provider_name in _instances:
-        logger.debug("Instance was yet to be created, creating one.")
-        from api.providers import ProvidersNames
-        if provider_name == ProvidersNames.OPEN_SUBTITLES.full_name:
-            from api.providers.opensubtitles import OpenSubtitlesRequestsManager
-            cls_type = OpenSubtitlesRequestsManager
-        else:
-            cls_type = RequestsManager
-        logger.debug("Creating request manager instance of type: %s" % cls_type)
-        _instances[provider_name] = cls_type()
-    return _instances[provider_name]
+    instances = _async_instances if asynchronous else _instances
+    with _instances_lock:
+        if provider_name in instances:
+            return instances[provider_name]
+
+    with _get_creation_lock(provider_name):
+        with _instances_lock:
+            manager = _instances.get(provider_name)
+            settings = dict(_managers_settings.get(provider_name, {}))
+        if not manager:
+            logger.debug("Instance was yet to be created, creating one.")
+            manager = _create_manager(provider_name, settings)
+            with _instances_lock:
+                _instances[provider_name] = manager
+        if not asynchronous:
+            return manager
+
+        with _instances_lock:
+            async_manager = _async_instances.get(provider_name)
+        if not async_manager:
+            from asyncrequestsmanager import AsyncRequestsManager
+            async_manager = AsyncRequestsManager(manager)
+            with _instances_lock:
+                _async_instances[provider_name] = async_manager
+        return async_manager
@@ -0,0 +1,298 @@
+import logging
+logger = logging.getLogger("subit.api.responsecache")
+import os
+import re
+import time
+from threading import Lock
+from collections import OrderedDict
+
+
+__all__ = ['ResponseCache', 'CacheEntry', 'DEFAULT_TTL_RULES']
+
+
+ONE_HOUR_SECS = 60 * 60
+ONE_DAY_SECS = 24 * ONE_HOUR_SECS
+DEFAULT_MAX_SIZE_BYTES = 50 * 1024 * 1024
+ENTRY_FILE_EXTENSION = ".entry"
+
+# A list of (url pattern, ttl in seconds). The first pattern that matches the
+# url decides the ttl, and a ttl of 0 means that the response is never cached.
+# Urls that are not matched by any pattern are not cached as well.
+DEFAULT_TTL_RULES = [
+    # Torec: tickets and downloads are valid only once.
+    (r"www\.torec\.net/ajax/", 0),
+    (r"www\.torec\.net/ssearch\.asp", ONE_HOUR_SECS),
+    (r"www\.torec\.net/sub\.asp", ONE_DAY_SECS),
+    # Subscenter
+    (r"/subtitle/download/", 0),
+    (r"/subtitle/search/", ONE_HOUR_SECS),
+    (r"/cinemast/data/", ONE_DAY_SECS),
+    (r"subscenter\.cinemast\.com/he/subtitle/", ONE_DAY_SECS),
+    # Addic7ed
+    (r"www\.addic7ed\.com/search\.php", ONE_HOUR_SECS),
+    (r"www\.addic7ed\.com/(serie|movie)/", ONE_DAY_SECS),
+]
+
+
+def get_cache_key(url, data = ''):
+    """
+    Returns the key of the request. The key is built from the method, the url
+    and the body of the request (the method is derived from the data, like in
+    the RequestsManager).
+
+    >>> get_cache_key("http://a.com/") == get_cache_key("http://a.com/")
+    True
+    >>> get_cache_key("http://a.com/") == get_cache_key("http://a.com/", "d")
+    False
+    >>> (get_cache_key("http://a.com/", {"a" : 1, "b" : 2}) ==
+    ...  get_cache_key("http://a.com/", {"b" : 2, "a" : 1}))
+    True
+    """
+    from hashlib import sha1
+    from urllib import urlencode
+    if isinstance(data, dict):
+        data = urlencode(sorted(data.items()))
+    method = "POST" if data else "GET"
+    return sha1("%s %s\n%s" % (method, url, data)).hexdigest()
+
+
+class CacheEntry(object):
+    """ A single response that is stored in the cache. """
+    def __init__(self, key, url, content, headers, ttl, stored_time = None):
+        self.key            = key
+        self.url            = url
+        self.content        = content
+        self.headers        = dict(headers)
+        self.ttl            = ttl
+        self.stored_time    = stored_time or time.time()
+
+    @property
+    def is_fresh(self):
+        return time.time() - self.stored_time < self.ttl
+
+    @property
+    def etag(self):
+        return _get_header(self.headers, "ETag")
+
+    @property
+    def last_modified(self):
+        return _get_header(self.headers, "Last-Modified")
+
+    @property
+    def validation_headers(self):
+        """
+        The headers that should be added to the request in order to revalidate
+        the entry with the server (an empty dict if the server didn't send any
+        validator).
+
+        >>> entry = CacheEntry("k", "u", "c", {"etag" : '"12"'}, 60)
+        >>> entry.validation_headers
+        {'If-None-Match': '"12"'}
+        """
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        return ("<CacheEntry url='%s', size=%d, ttl=%d, fresh=%s>" %
+            (self.url, len(self.content), self.ttl, self.is_fresh))
+
+
+class ResponseCache(object):
+    """
+    A persistent cache for http responses. Each response is stored in its own
+    file under the cache directory. The total size of the files is kept below
+    max_size bytes by evicting the least recently used entries.
+
+    The instance is thread safe, and can be shared between several managers.
+    """
+    def __init__(self, directory, max_size = DEFAULT_MAX_SIZE_BYTES,
+        ttl_rules = DEFAULT_TTL_RULES):
+
+        self.directory = directory
+        self.max_size = max_size
+        self.ttl_rules = [(re.compile(p), ttl) for p, ttl in ttl_rules]
+        self._lock = Lock()
+        # key => file size, ordered from the least recently used.
+        self._index = OrderedDict()
+        self._size = 0
+        self._stats = dict.fromkeys(
+            ['hits', 'misses', 'revalidations', 'bytes_saved', 'evictions'], 0)
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._load_index()
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        return ("<ResponseCache directory='%s', entries=%d, size=%d>" %
+            (self.directory, len(self._index), self._size))
+
+    def _load_index(self):
+        """ Builds the LRU index from the files in the cache directory. """
+        entries = []
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith(ENTRY_FILE_EXTENSION):
+                continue
+            stat = os.stat(os.path.join(self.directory, file_name))
+            key = file_name[:-len(ENTRY_FILE_EXTENSION)]
+            entries.append((stat.st_mtime, key, stat.st_size))
+
+        for mtime, key, size in sorted(entries):
+            self._index[key] = size
+            self._size += size
+        logger.debug("Loaded cache index: %s" % self)
+
+    def _get_path(self, key):
+        return os.path.join(self.directory, key + ENTRY_FILE_EXTENSION)
+
+    def get_ttl(self, url):
+        """
+        Returns the number of seconds that the response for the url should be
+        kept in the cache, 0 means that it shouldn't be cached at all.
+        """
+        for pattern, ttl in self.ttl_rules:
+            if pattern.search(url):
+                return ttl
+        return 0
+
+    def get(self, url, data = ''):
+        """
+        Returns the CacheEntry for the request, or None if it's missing. Note
+        that the returned entry might be stale.
+        """
+        if not self.get_ttl(url):
+            return None
+
+        key = get_cache_key(url, data)
+        with self._lock:
+            if key not in self._index:
+                return None
+            try:
+                import cPickle
+                with open(self._get_path(key), "rb") as entry_file:
+                    entry = cPickle.load(entry_file)
+                os.utime(self._get_path(key), None)
+            except Exception as eX:
+                logger.error("Failed loading cache entry %s: %s" % (key, eX))
+                self._remove(key)
+                return None
+            # Mark as the most recently used.
+            self._index[key] = self._index.pop(key)
+        return entry
+
+    def put(self, url, data, content, headers):
+        """
+        Stores the response for the request, if the url should be cached.
+        Returns the stored CacheEntry or None.
+        """
+        ttl = self.get_ttl(url)
+        if not ttl or not content:
+            return None
+
+        key = get_cache_key(url, data)
+        entry = CacheEntry(key, url, content, headers, ttl)
+        self._write(entry)
+        return entry
+
+    def refresh(self, entry):
+        """
+        Marks the entry as fresh again (after the server answered that the
+        entry was not modified).
+        """
+        entry.stored_time = time.time()
+        self._write(entry)
+
+    def _write(self, entry):
+        import cPickle
+        path = self._get_path(entry.key)
+        temp_path = path + ".tmp"
+        with self._lock:
+            try:
+                with open(temp_path, "wb") as entry_file:
+                    cPickle.dump(entry, entry_file, cPickle.HIGHEST_PROTOCOL)
+                if os.path.exists(path):
+                    os.remove(path)
+                os.rename(temp_path, path)
+            except Exception as eX:
+                logger.error("Failed storing cache entry: %s" % eX)
+                return
+
+            self._size -= self._index.pop(entry.key, 0)
+            self._index[entry.key] = os.path.getsize(path)
+            self._size += self._index[entry.key]
+            self._evict()
+
+    def _remove(self, key):
+        self._size -= self._index.pop(key, 0)
+        try:
+            os.remove(self._get_path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        """ Removes the least recently used entries until we fit max_size. """
+        while self._size > self.max_size and self._index:
+            key = next(iter(self._index))
+            logger.debug("Evicting cache entry: %s" % key)
+            self._remove(key)
+            self._stats['evictions'] += 1
+
+    def record_hit(self, entry, revalidated = False):
+        with self._lock:
+            self._stats['hits'] += 1
+            self._stats['bytes_saved'] += len(entry.content)
+            if revalidated:
+                self._stats['revalidations'] += 1
+
+    def record_miss(self):
+        with self._lock:
+            self._stats['misses'] += 1
+
+    @property
+    def stats(self):
+        """
+        Returns a dictionary with the counters of the cache: hits, misses,
+        revalidations (hits that required a conditional request), bytes_saved,
+        evictions, and also the current entries count and size (in bytes).
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._index)
+            stats['size'] = self._size
+        return stats
+
+    def reset_stats(self):
+        with self._lock:
+            for key in self._stats:
+                self._stats[key] = 0
+
+    def clear(self):
+        """ Removes all the entries from the cache. """
+        with self._lock:
+            for key in self._index.keys():
+                self._remove(key)
+
+
+def _get_header(headers, name):
+    """
+    Case insensitive lookup in the headers dictionary.
+
+    >>> _get_header({"content-length" : "12"}, "Content-Length")
+    '12'
+    >>> print _get_header({}, "Content-Length")
+    None
+    """
+    name = name.lower()
+    for key, value in headers.iteritems():
+        if key.lower() == name:
+            return value
+    return None
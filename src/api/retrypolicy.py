@@ -0,0 +1,276 @@
+import logging
+logger = logging.getLogger("subit.api.retrypolicy")
+import time
+import random
+from threading import Lock
+
+from exceptions import ProviderUnavailable
+
+
+__all__ = [
+    'RetryBudget', 'RetryPolicy', 'CircuitBreaker', 'CircuitStates',
+    'call_with_retries'
+]
+
+
+class RetryBudget(object):
+    """
+    Limits the number of retries to a ratio of the requests. Each request
+    deposits ratio tokens in the budget, and each retry withdraws a single
+    token. This way, when a provider fails most of its requests, we don't
+    multiply the load on it by the number of attempts. min_retries tokens are
+    always available, so a few retries are allowed even before any request was
+    sent.
+
+    >>> budget = RetryBudget(ratio = 0.5, min_retries = 1)
+    >>> budget.withdraw()
+    True
+    >>> budget.withdraw()
+    False
+    >>> budget.deposit()
+    >>> budget.deposit()
+    >>> budget.withdraw()
+    True
+    """
+    def __init__(self, ratio = 0.2, min_retries = 3):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self._balance = float(min_retries)
+        self._lock = Lock()
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        return ("<RetryBudget ratio=%.2f, min_retries=%d, balance=%.2f>" %
+            (self.ratio, self.min_retries, self._balance))
+
+    def deposit(self):
+        with self._lock:
+            # Don't let the budget grow infinitely while all is well.
+            self._balance = min(
+                self._balance + self.ratio,
+                self.min_retries + self.ratio * 100)
+
+    def withdraw(self):
+        with self._lock:
+            if self._balance < 1:
+                return False
+            self._balance -= 1
+            return True
+
+
+class RetryPolicy(object):
+    """
+    Exponential backoff with full jitter. The delay before attempt number n+1
+    is a random value between 0 and min(max_delay_secs, base_delay_secs * 2^n).
+    A retry is allowed only if we didn't reach max_attempts, and the budget
+    (if specified) has a token for it.
+
+    >>> policy = RetryPolicy(max_attempts = 3, base_delay_secs = 1)
+    >>> 0 <= policy.get_delay(1) <= 1
+    True
+    >>> 0 <= policy.get_delay(3) <= 4
+    True
+    >>> policy.can_retry(2)
+    True
+    >>> policy.can_retry(3)
+    False
+    """
+    def __init__(self, max_attempts = 3, base_delay_secs = 0.5,
+        max_delay_secs = 8, budget = None):
+
+        self.max_attempts       = max_attempts
+        self.base_delay_secs    = base_delay_secs
+        self.max_delay_secs     = max_delay_secs
+        self.budget             = budget
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        return ("<RetryPolicy max_attempts=%(max_attempts)d, "
+            "base_delay_secs=%(base_delay_secs)s, "
+            "max_delay_secs=%(max_delay_secs)s, budget=%(budget)s>"
+            % self.__dict__)
+
+    def get_delay(self, attempt):
+        """ The number of seconds to sleep after the attempt failed. """
+        max_delay = min(
+            self.max_delay_secs, self.base_delay_secs * (2 ** (attempt - 1)))
+        return random.uniform(0, max_delay)
+
+    def record_request(self):
+        if self.budget:
+            self.budget.deposit()
+
+    def can_retry(self, attempt):
+        if attempt >= self.max_attempts:
+            return False
+        if self.budget and not self.budget.withdraw():
+            logger.debug("The retry budget is exhausted.")
+            return False
+        return True
+
+
+class CircuitStates:
+    CLOSED      = "closed"
+    OPEN        = "open"
+    HALF_OPEN   = "half_open"
+
+
+class CircuitBreaker(object):
+    """
+    A circuit breaker for a single provider. After failure_threshold
+    consecutive failures the circuit opens, and requests fail fast for
+    cooldown_secs. After that, the circuit is half open, and a single request
+    is allowed as a probe. If it succeeds the circuit closes, otherwise, it
+    opens again for another cool-down.
+
+    >>> breaker = CircuitBreaker(failure_threshold = 2, cooldown_secs = 60)
+    >>> breaker.record_failure()
+    >>> breaker.state
+    'closed'
+    >>> breaker.record_failure()
+    >>> breaker.state
+    'open'
+    >>> breaker.allow_request()
+    False
+    """
+    def __init__(self, failure_threshold = 5, cooldown_secs = 60):
+        self.failure_threshold = failure_threshold
+        self.cooldown_secs = cooldown_secs
+        self._lock = Lock()
+        self._failures = 0
+        self._opened_time = None
+        self._probe_in_flight = False
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        return ("<CircuitBreaker state='%s', failures=%d>" %
+            (self.state, self._failures))
+
+    def configure(self, failure_threshold = 5, cooldown_secs = 60):
+        with self._lock:
+            self.failure_threshold = failure_threshold
+            self.cooldown_secs = cooldown_secs
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._get_state()
+
+    def _get_state(self):
+        if self._opened_time is None:
+            return CircuitStates.CLOSED
+        if time.time() - self._opened_time < self.cooldown_secs:
+            return CircuitStates.OPEN
+        return CircuitStates.HALF_OPEN
+
+    @property
+    def is_available(self):
+        """
+        False while the circuit is open, i.e., requests will surely fail fast.
+        """
+        return self.state != CircuitStates.OPEN
+
+    def allow_request(self):
+        """
+        Returns whether a request is allowed to be sent. In the half open state
+        only a single request (the probe) is allowed until its result is
+        recorded.
+        """
+        with self._lock:
+            state = self._get_state()
+            if state == CircuitStates.CLOSED:
+                return True
+            if state == CircuitStates.HALF_OPEN and not self._probe_in_flight:
+                logger.debug("Circuit is half open, sending a probe.")
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_time is not None:
+                logger.info("Circuit closed.")
+            self._failures = 0
+            self._opened_time = None
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if (self._probe_in_flight or
+                self._failures >= self.failure_threshold):
+                if self._get_state() == CircuitStates.CLOSED:
+                    logger.warning(
+                        "Circuit opened after %d failures." % self._failures)
+                self._opened_time = time.time()
+            self._probe_in_flight = False
+
+
+def call_with_retries(func, retry_policy, circuit_breaker = None,
+    retryable_exceptions = (Exception,), on_attempt_failed = None):
+    """
+    Calls func until it succeeds, or until the retry policy doesn't allow any
+    more attempts. Only exceptions of the retryable_exceptions types are
+    retried, others are raised immediately (and are not considered failures of
+    the provider). When the attempts are exhausted, the last exception is
+    raised.
+
+    If a circuit breaker is given and it doesn't allow the request,
+    ProviderUnavailable is raised without calling func.
+
+    on_attempt_failed, if given, is called with the exception of each failed
+    attempt (of the retryable types), and whether it's going to be retried.
+
+    >>> policy = RetryPolicy(max_attempts = 3, base_delay_secs = 0)
+    >>> attempts = []
+    >>> def func():
+    ...     attempts.append(1)
+    ...     if len(attempts) < 3: raise IOError("failed")
+    ...     return "result"
+    >>> call_with_retries(func, policy)
+    'result'
+    >>> len(attempts)
+    3
+    >>> breaker = CircuitBreaker(failure_threshold = 1)
+    >>> call_with_retries(func, policy, breaker, (ValueError,))
+    'result'
+    >>> breaker.record_failure()
+    >>> call_with_retries(func, policy, breaker)
+    Traceback (most recent call last):
+        ...
+    ProviderUnavailable: The circuit is open.
+    """
+    if circuit_breaker and not circuit_breaker.allow_request():
+        raise ProviderUnavailable("The circuit is open.")
+
+    retry_policy.record_request()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            result = func()
+        except retryable_exceptions as eX:
+            logger.debug("Attempt %d failed: %s", attempt, eX)
+            will_retry = retry_policy.can_retry(attempt)
+            if on_attempt_failed:
+                on_attempt_failed(eX, will_retry)
+            if not will_retry:
+                if circuit_breaker:
+                    circuit_breaker.record_failure()
+                raise
+            time.sleep(retry_policy.get_delay(attempt))
+        except Exception:
+            # The provider answered, it just didn't like our request.
+            if circuit_breaker:
+                circuit_breaker.record_success()
+            raise
+        else:
+            if circuit_breaker:
+                circuit_breaker.record_success()
+            return result
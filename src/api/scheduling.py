@@ -0,0 +1,148 @@
+import logging
+logger = logging.getLogger("subit.api.scheduling")
+from threading import Lock, local
+
+
+__all__ = ['Priorities', 'RequestContext', 'get_current_context']
+
+
+class Priorities:
+    """
+    The priority classes of the requests, a lower value is served first. When
+    a provider has more requests than in-flight slots, the requests wait in a
+    queue that is ordered by these classes, and in FIFO order within a class.
+    """
+    # A query that the user is waiting for.
+    INTERACTIVE = 0
+    # Downloading the version that was selected.
+    DOWNLOAD    = 1
+    # Batch processing, e.g., scanning a library.
+    BATCH       = 2
+    # Speculative requests, e.g., prefetching and refreshing tickets.
+    PREFETCH    = 3
+
+    names = {
+        INTERACTIVE : 'interactive',
+        DOWNLOAD    : 'download',
+        BATCH       : 'batch',
+        PREFETCH    : 'prefetch',
+    }
+
+
+class RequestContext(object):
+    """
+    Sets the priority of all the requests that are issued by the current thread
+    inside the with block (unless a request specifies its own priority), and
+    allows to cancel them together. Contexts can be nested, the innermost one
+    is used.
+
+    scan_context = RequestContext(Priorities.BATCH)
+    with scan_context:
+        scan_the_library()
+
+    # From another thread, the requests that still wait in the queues fail with
+    # RequestCancelled, and so are the requests that will be issued later.
+    scan_context.cancel()
+
+    >>> context = RequestContext(Priorities.BATCH)
+    >>> with context:
+    ...     get_current_context() is context
+    True
+    >>> get_current_context().priority == Priorities.INTERACTIVE
+    True
+    """
+    def __init__(self, priority = Priorities.INTERACTIVE):
+        self.priority = priority
+        self._priority_raised = False
+        self._cancelled = False
+        self._lock = Lock()
+        # The admission controllers in which requests of the context wait =>
+        # the number of those requests.
+        self._controllers = {}
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        return ("<RequestContext priority='%s', cancelled=%s>" %
+            (Priorities.names[self.priority], self._cancelled))
+
+    def __enter__(self):
+        _get_contexts_stack().append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _get_contexts_stack().pop()
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def cancel(self):
+        """
+        Cancels the requests of the context that are waiting for admission.
+        Requests that are already in flight are not affected.
+        """
+        logger.debug("Cancelling %s" % self)
+        with self._lock:
+            self._cancelled = True
+            controllers = list(self._controllers)
+        for controller in controllers:
+            controller.wake_waiters()
+
+    @property
+    def priority_raised(self):
+        return self._priority_raised
+
+    def raise_priority(self, priority):
+        """
+        Raises the priority of the context (if priority is higher than the 
+        current one), including the priority of its requests that are already
+        waiting for admission. Used when someone is blocked on a request that 
+        was issued with a low priority.
+        """
+        with self._lock:
+            if priority >= self.priority:
+                return
+            logger.debug("Raising the priority of %s to: %s" % 
+                (self, Priorities.names[priority]))
+            self.priority = priority
+            self._priority_raised = True
+            controllers = list(self._controllers)
+        for controller in controllers:
+            controller.reprioritize(self)
+
+    def register_controller(self, controller):
+        """ Called by a controller when a request of the context waits in it. """
+        with self._lock:
+            self._controllers[controller] = \
+                self._controllers.get(controller, 0) + 1
+
+    def unregister_controller(self, controller):
+        """
+        Called by the controller once a request of the context stopped waiting
+        in it, once for each register_controller call. The context forgets the
+        controller once none of its requests wait in it, so it doesn't keep 
+        the controller alive (the default context lives forever).
+        """
+        with self._lock:
+            count = self._controllers.pop(controller) - 1
+            if count:
+                self._controllers[controller] = count
+
+
+_local = local()
+_default_context = RequestContext()
+
+def _get_contexts_stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+def get_current_context():
+    """
+    Returns the innermost RequestContext of the current thread, or the default
+    context (with INTERACTIVE priority) if there is none.
+    """
+    stack = _get_contexts_stack()
+    return stack[-1] if stack else _default_context
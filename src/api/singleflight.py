@@ -0,0 +1,91 @@
+import logging
+logger = logging.getLogger("subit.api.singleflight")
+from threading import Lock, Event
+
+
+__all__ = ['SingleFlight']
+
+
+class _Call(object):
+    """ A single call that is in flight, and its result once it finishes. """
+    def __init__(self):
+        self.event  = Event()
+        self.result = None
+        self.error  = None
+
+
+class SingleFlight(object):
+    """
+    Makes sure that only a single call for each key is executed at any given
+    time. Callers that ask for a key that is already in flight wait for the
+    first call to finish, and receive its result (or its exception) instead of
+    executing the call again.
+
+    Exceptions of the types in unshared_errors (e.g., the first caller was
+    cancelled) are raised only to the caller that executed the call. Instead,
+    one of the waiting callers executes the call again, and the others wait
+    for it.
+
+    >>> group = SingleFlight()
+    >>> group.do("key", lambda: "result")
+    'result'
+    >>> group.coalesced
+    0
+    """
+    def __init__(self, unshared_errors = ()):
+        self.unshared_errors = tuple(unshared_errors)
+        self._lock = Lock()
+        self._calls = {}
+        self._coalesced = 0
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        return ("<SingleFlight in_flight=%d, coalesced=%d>" %
+            (len(self._calls), self._coalesced))
+
+    @property
+    def coalesced(self):
+        """ The number of calls that were served by another call's result. """
+        return self._coalesced
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Executes func(*args, **kwargs) if there is no call for the key in
+        flight, otherwise, waits for that call and returns its result.
+        """
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                is_leader = call is None
+                if is_leader:
+                    call = _Call()
+                    self._calls[key] = call
+                else:
+                    self._coalesced += 1
+
+            if is_leader:
+                break
+            logger.debug("Waiting for the call in flight: %s", key)
+            call.event.wait()
+            if isinstance(call.error, self.unshared_errors):
+                logger.debug("The call in flight failed with: %r, calling "
+                    "again: %s", call.error, key)
+                with self._lock:
+                    self._coalesced -= 1
+                continue
+            if call.error:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as eX:
+            call.error = eX
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
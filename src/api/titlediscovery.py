@@ -3,12 +3,16 @@ logger = logging.getLogger("subit.api.titlediscovery")
 import os
 
 from api.exceptions import FilePathDoesNotExists
+from api.discoverysession import get_discovery_session
 from api.providers import get_provider_instance
 from api.providers import ProvidersNames
 from api.languages import Languages
+from api.namenormalization import normalize_name_2nd_step
+from api.seriesutils import get_series_numbering
+from api.seriesutils import get_series_numbering_string
 
 
-__all__ = ['discover_title']
+__all__ = ['discover_title', 'discover_titles_from_file_paths']
 
 
 def discover_title(query):
@@ -62,9 +66,8 @@ def _get_os_provider():
         ProvidersNames.OPEN_SUBTITLES, [Languages.ENGLISH])
 
 def discover_title_from_file_path(file_path):
-    os_provider = _get_os_provider()
-    file_hash, file_size = os_provider.calculate_file_hash(file_path)
-    title = os_provider.get_title_by_hash(file_hash)
+    # The session's results are shared with the identifiers extraction.
+    title = get_discovery_session(file_path, _get_os_provider()).get_title()
     logger.debug("Title by hash is: %s" % title)
     if title:
         return title
@@ -80,6 +83,72 @@ def discover_title_from_file_path(file_path):
     logger.debug("Title by directory name is: %s" % title)
     return title
 
+def discover_titles_from_file_paths(file_paths):
+    """
+    Discovers the titles of many files at once (e.g., all the files in a
+    directory), with as few requests as possible: all the files are hashed, and
+    the hashes are resolved together (see get_titles_by_hashes). The files
+    whose hash is unknown fall back to their file name and then to their
+    directory name, just like discover_title_from_file_path. The queries are
+    sent once for each normalized query (see _normalize_query), so the 
+    releases of an episode (or a movie) share a single request.
+
+    Returns a dictionary of file path => Title, or None for the files whose
+    title was not discovered.
+    """
+    logger.debug("Discovering titles for %d files" % len(file_paths))
+    os_provider = _get_os_provider()
+    file_hashes = {}
+    for file_path in file_paths:
+        file_hash, file_size = os_provider.calculate_file_hash(file_path)
+        if file_hash:
+            file_hashes[file_path] = file_hash
+    titles_by_hash = os_provider.get_titles_by_hashes(file_hashes.values())
+
+    titles_by_query = {}
+    def discover_title_from_cached_query(query):
+        normalized_query = _normalize_query(query)
+        if normalized_query not in titles_by_query:
+            titles_by_query[normalized_query] = discover_title_from_query(query)
+        return titles_by_query[normalized_query]
+
+    titles = {}
+    for file_path in file_paths:
+        title = titles_by_hash.get(file_hashes.get(file_path))
+        if not title:
+            title = discover_title_from_cached_query(
+                os.path.splitext(os.path.basename(file_path))[0])
+        if not title:
+            title = discover_title_from_cached_query(
+                os.path.basename(os.path.dirname(file_path)))
+        logger.debug("Title for %s is: %s" % (file_path, title))
+        titles[file_path] = title
+    return titles
+
+def _normalize_query(query):
+    """
+    Returns the part of the query that identifies the title, normalized. For
+    episodes, whatever follows the numbering (the quality, the release group,
+    etc.) is dropped.
+
+    >>> _normalize_query("The.Big.Bang.Theory.S05E13.720p.HDTV.x264-ORENJI")
+    'the_big_bang_theory_s05e13'
+    >>> _normalize_query("the big bang theory s05e13 1080p WEB-DL")
+    'the_big_bang_theory_s05e13'
+    >>> _normalize_query("The.Matrix.1999.720p")
+    'the_matrix_1999_720p'
+    """
+    normalized_query = normalize_name_2nd_step(query)
+    numbering = get_series_numbering(normalized_query)
+    if numbering:
+        numbering_string = get_series_numbering_string(
+            normalized_query, *numbering)
+        if numbering_string:
+            normalized_query = normalized_query[:
+                normalized_query.index(numbering_string) + 
+                len(numbering_string)]
+    return normalized_query
+
 def discover_title_from_query(query):
     os_provider = _get_os_provider()
     title = os_provider.get_title_by_query(query)
@@ -116,6 +116,21 @@ class TitlesVersions(object):
                         all_versions.append(version)
             yield (title, all_versions)
 
+    def get_top_versions(self, count):
+        """
+        Returns a list of the count ProviderVersions instances with the highest
+        ranks, from the highest. Versions with the same rank are ordered by 
+        their provider_rank.
+        """
+        ranked_versions = []
+        for title, values in self:
+            for groups in values.itervalues():
+                for versions in groups.itervalues():
+                    ranked_versions.extend(versions)
+        # t[0] is the provider_rank.
+        ranked_versions.sort(key=lambda t: (-t[1].rank, t[0]))
+        return [version for rank, version in ranked_versions[:count]]
+
     def __iter__(self):
         return self.titles.iteritems()
 
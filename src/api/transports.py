@@ -0,0 +1,305 @@
+import logging
+logger = logging.getLogger("subit.api.transports")
+import os
+import time
+from threading import Lock
+from requests.adapters import BaseAdapter
+
+from exceptions import FixtureNotFound
+
+
+__all__ = ['FixtureArchive', 'FixtureRecord', 'RecordTransport',
+           'ReplayTransport']
+
+
+FIXTURE_ARCHIVE_VERSION = 1
+
+
+class FixtureRecord(object):
+    """
+    A single request/response exchange: the request's method, url, body and
+    headers, and the response's status, headers and content (after the
+    content-encoding was decoded), and the time it took to get the response.
+    """
+    def __init__(self, method, url, body, status, content,
+        request_headers = None, response_headers = None, latency_secs = 0):
+        self.method = method
+        self.url = url
+        self.body = body or ''
+        self.status = status
+        self.content = content
+        self.request_headers = dict(request_headers or {})
+        self.response_headers = dict(response_headers or {})
+        self.latency_secs = latency_secs
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        return "<FixtureRecord method=%s, url='%s', status=%s>" % (
+            self.method, self.url, self.status)
+
+    @property
+    def key(self):
+        return (self.method, self.url, self.body)
+
+    def to_dict(self):
+        from base64 import b64encode
+        return {
+            'method'            : self.method,
+            'url'               : self.url,
+            'body'              : b64encode(self.body),
+            'status'            : self.status,
+            'content'           : b64encode(self.content),
+            'request_headers'   : self.request_headers,
+            'response_headers'  : self.response_headers,
+            'latency_secs'      : self.latency_secs,
+        }
+
+    @classmethod
+    def from_dict(cls, record):
+        """
+        >>> record = FixtureRecord("GET", "http://a/b", "", 200, "content")
+        >>> FixtureRecord.from_dict(record.to_dict()).key == record.key
+        True
+        """
+        from base64 import b64decode
+        # The headers are stored as latin-1, just like httplib reads them.
+        def decode_headers(headers):
+            return dict(
+                (str(name), value.encode('latin-1'))
+                for name, value in headers.iteritems())
+        return cls(
+            str(record['method']),
+            str(record['url']),
+            b64decode(record['body']),
+            record['status'],
+            b64decode(record['content']),
+            decode_headers(record['request_headers']),
+            decode_headers(record['response_headers']),
+            record['latency_secs'])
+
+
+class FixtureArchive(object):
+    """
+    Stores the recorded exchanges in a single gzipped JSON file. The exchanges
+    are looked up by their method, url and body, and when the same request was
+    recorded several times, the responses are served in the order they were
+    recorded (the last one is repeated once they are exhausted).
+
+    The archive is loaded when created (if the file exists), and is written to
+    the file only by save(). The archive is thread safe.
+    """
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self._lock = Lock()
+        self._records = []
+        # key => list of records
+        self._records_by_key = {}
+        # key => the index of the next record to serve
+        self._cursors = {}
+        if os.path.exists(file_path):
+            self.load()
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        return "<FixtureArchive file_path='%s', records=%d>" % (
+            self.file_path, len(self))
+
+    def __len__(self):
+        return len(self._records)
+
+    def get_records(self):
+        """ Returns a list of the records, in the order they were recorded. """
+        with self._lock:
+            return list(self._records)
+
+    def add(self, record):
+        logger.debug("Recording %s", record)
+        with self._lock:
+            self._records.append(record)
+            self._records_by_key.setdefault(record.key, []).append(record)
+
+    def find(self, method, url, body):
+        """ Returns the next record of the request, or None if it is absent. """
+        key = (method, url, body or '')
+        with self._lock:
+            records = self._records_by_key.get(key)
+            if not records:
+                return None
+            index = self._cursors.get(key, 0)
+            self._cursors[key] = index + 1
+            return records[min(index, len(records) - 1)]
+
+    def rewind(self):
+        """ Serves the records from the start again. """
+        with self._lock:
+            self._cursors.clear()
+
+    def load(self):
+        import gzip
+        import json
+        logger.debug("Loading fixtures from: %s", self.file_path)
+        with gzip.open(self.file_path, 'rb') as archive_file:
+            archive = json.loads(archive_file.read())
+        if archive['version'] != FIXTURE_ARCHIVE_VERSION:
+            raise ValueError(
+                "Unsupported fixture archive version: %s" % archive['version'])
+        with self._lock:
+            self._records = []
+            self._records_by_key = {}
+            self._cursors = {}
+        for record in archive['records']:
+            self.add(FixtureRecord.from_dict(record))
+
+    def save(self):
+        import gzip
+        import json
+        logger.debug("Saving %d fixtures to: %s", len(self), self.file_path)
+        with self._lock:
+            records = [record.to_dict() for record in self._records]
+        dump = json.dumps(
+            {'version' : FIXTURE_ARCHIVE_VERSION, 'records' : records},
+            encoding = 'latin-1', separators = (',', ':'))
+        with gzip.open(self.file_path, 'wb') as archive_file:
+            archive_file.write(dump)
+
+
+class RecordTransport(object):
+    """
+    Sends the requests to the network, and records every exchange (including
+    the xml-rpc calls) in the archive. Set it as the transport setting of the
+    managers (before the managers send any request), and save the archive once
+    the run is over:
+
+    archive = FixtureArchive("torec.fixtures")
+    configure_manager(ProvidersNames.TOREC.full_name,
+                      transport = RecordTransport(archive))
+    run_the_flow()
+    archive.save()
+    """
+    def __init__(self, archive):
+        self.archive = archive
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        return "<RecordTransport archive=%s>" % self.archive
+
+    def get_adapter(self, adapter):
+        """ Returns the requests adapter to mount instead of adapter. """
+        return _RecordingAdapter(self.archive, adapter)
+
+
+class ReplayTransport(object):
+    """
+    Serves the responses from the archive, without touching the network. Each
+    response is delayed by latency_secs, or by the latency that was recorded
+    with it if latency_secs is None. A request that is missing from the archive
+    fails with FixtureNotFound.
+    """
+    def __init__(self, archive, latency_secs = 0):
+        self.archive = archive
+        self.latency_secs = latency_secs
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        return "<ReplayTransport archive=%s, latency_secs=%s>" % (
+            self.archive, self.latency_secs)
+
+    def get_adapter(self, adapter):
+        adapter.close()
+        return _ReplayAdapter(self)
+
+    def replay(self, method, url, body):
+        """ Returns the record of the request, after the simulated latency. """
+        record = self.archive.find(method, url, body)
+        if not record:
+            raise FixtureNotFound(
+                "No fixture for: %s %s %r" % (method, url, body))
+        latency_secs = self.latency_secs
+        if latency_secs is None:
+            latency_secs = record.latency_secs
+        if latency_secs:
+            time.sleep(latency_secs)
+        return record
+
+
+def _get_request_body(request):
+    """
+    Returns the body of a prepared request. Form fields are sorted, so the body
+    doesn't depend on the order of the data dictionary.
+
+    >>> from requests import Request
+    >>> _get_request_body(
+    ...     Request('POST', 'http://a/', data = {'b': '1', 'a': '2'}).prepare())
+    'a=2&b=1'
+    """
+    from urllib import urlencode
+    from urlparse import parse_qsl
+    body = request.body or ''
+    content_type = request.headers.get('Content-Type', '')
+    if content_type.startswith('application/x-www-form-urlencoded'):
+        body = urlencode(sorted(parse_qsl(body, keep_blank_values = True)))
+    return body
+
+
+class _RecordingAdapter(BaseAdapter):
+    def __init__(self, archive, adapter):
+        super(_RecordingAdapter, self).__init__()
+        self._archive = archive
+        self._adapter = adapter
+
+    def send(self, request, **kwargs):
+        start_time = time.time()
+        response = self._adapter.send(request, **kwargs)
+        # Reads the whole body, even if the response is streamed. Afterwards,
+        # the response serves the body from memory.
+        content = response.content
+        self._archive.add(FixtureRecord(
+            request.method,
+            request.url,
+            _get_request_body(request),
+            response.status_code,
+            content,
+            request.headers,
+            response.headers,
+            time.time() - start_time))
+        return response
+
+    def close(self):
+        self._adapter.close()
+
+
+class _ReplayAdapter(BaseAdapter):
+    def __init__(self, transport):
+        super(_ReplayAdapter, self).__init__()
+        self._transport = transport
+
+    def send(self, request, **kwargs):
+        from io import BytesIO
+        from requests.models import Response
+        from requests.structures import CaseInsensitiveDict
+        from requests.utils import get_encoding_from_headers
+
+        record = self._transport.replay(
+            request.method, request.url, _get_request_body(request))
+        response = Response()
+        response.status_code = record.status
+        response.headers = CaseInsensitiveDict(record.response_headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        # The recorded content is already decoded.
+        response.raw = BytesIO(record.content)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        pass
+
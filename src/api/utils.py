@@ -1,12 +1,21 @@
 import re
+import os
 
 
 __all__ = [
-    'get_regex_results', 'take_first', 'get_regex_match', 'strip_white_spaces'
+    'get_regex_results', 'take_first', 'get_regex_match', 'strip_white_spaces',
+    'get_user_data_path', 'create_parent_directory'
 ]
 
 WHITE_SPACES_RE = re.compile("[\r\t\n]")
 
+# The directory in which the data of the current user (tokens, caches) is kept.
+# Unlike the temp directory, it's not shared with the other users.
+if os.environ.get('APPDATA'):
+    USER_DATA_DIRECTORY = os.path.join(os.environ['APPDATA'], 'SubiT')
+else:
+    USER_DATA_DIRECTORY = os.path.join(os.path.expanduser('~'), '.subit')
+
 
 def strip_white_spaces(input_string):
     """
@@ -69,6 +78,31 @@ def get_regex_results(content, pattern, with_groups = False):
 
     return c_pattern.findall(content)
 
+def get_user_data_path(file_name):
+    """
+    Returns the path of file_name inside USER_DATA_DIRECTORY. The directory is
+    not created, see create_parent_directory.
+
+    >>> get_user_data_path("cache.sqlite") == \\
+    ...     os.path.join(USER_DATA_DIRECTORY, "cache.sqlite")
+    True
+    """
+    return os.path.join(USER_DATA_DIRECTORY, file_name)
+
+def create_parent_directory(file_path):
+    """
+    Creates the directory of file_path (and its parents) if it's missing. The
+    new directories can be accessed only by the current user.
+    """
+    directory = os.path.dirname(os.path.abspath(file_path))
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory, 0700)
+        except OSError:
+            # Another thread (or process) might have created it meanwhile.
+            if not os.path.isdir(directory):
+                raise
+
 def take_first(items):
     """
     Function to return the first item in a list (will try to convert the
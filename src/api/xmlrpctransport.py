@@ -0,0 +1,240 @@
+import logging
+logger = logging.getLogger("subit.api.xmlrpctransport")
+import re
+import xmlrpclib
+from threading import local, Lock
+
+
+__all__ = ['SessionTransport', 'CompactRow']
+
+
+XMLRPC_CHUNK_SIZE = 16 * 1024
+# The method name is at the start of the request body.
+_METHOD_NAME_PATTERN = re.compile(r"<methodName>([^<]+)</methodName>")
+
+
+class SessionTransport(xmlrpclib.Transport):
+    """
+    An xmlrpclib transport that sends the calls through a requests Session
+    instead of opening a new connection for each call. So the calls reuse the
+    kept-alive connections of the session's pool (and go through the adapters
+    that are mounted on it), have their own timeout instead of the process-wide
+    socket timeout, and ask for gzipped responses. The response is parsed while
+    it's streamed and decoded.
+
+    The number of bytes that were sent and received by the current thread are
+    returned (and reset) by pop_transferred().
+
+    If set_row_fields() was called for a method, the rows of its response (the
+    structs in the array of the response's struct, like the 'data' of 
+    SearchSubtitles) are parsed into CompactRow instances that hold only the 
+    given fields. The other fields are dropped as soon as their row is parsed,
+    so the whole response is never held in memory.
+
+    >>> SessionTransport(lambda: None, 10, "subit")
+    <SessionTransport scheme=http, timeout_secs=10>
+    """
+    def __init__(self, get_session, timeout_secs, user_agent, secure = False):
+        """
+        get_session is called for each call, and returns the session to use.
+        """
+        xmlrpclib.Transport.__init__(self)
+        self.get_session = get_session
+        self.timeout_secs = timeout_secs
+        self.user_agent = user_agent
+        self.scheme = "https" if secure else "http"
+        self._local = local()
+        self._row_fields_lock = Lock()
+        # method name => field name => index in the CompactRow's values.
+        self._row_fields = {}
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        return "<SessionTransport scheme=%s, timeout_secs=%s>" % (
+            self.scheme, self.timeout_secs)
+
+    def pop_transferred(self):
+        """
+        Returns the (bytes_in, bytes_out) of the calls of the current thread
+        since the last call to this method.
+        """
+        transferred = getattr(self._local, 'transferred', (0, 0))
+        self._local.transferred = (0, 0)
+        return transferred
+
+    def _add_transferred(self, bytes_in, bytes_out):
+        total_in, total_out = getattr(self._local, 'transferred', (0, 0))
+        self._local.transferred = (total_in + bytes_in, total_out + bytes_out)
+
+    def set_row_fields(self, method_name, fields):
+        """
+        Adds the fields to the fields that are kept in the rows of the method's
+        responses. Rows that were already parsed are not affected.
+
+        >>> transport = SessionTransport(lambda: None, 10, "subit")
+        >>> transport.set_row_fields("SearchSubtitles", ["MovieName"])
+        >>> transport.set_row_fields("SearchSubtitles", ["IDMovieImdb"])
+        >>> transport.get_row_fields("SearchSubtitles")
+        ['IDMovieImdb', 'MovieName']
+        """
+        with self._row_fields_lock:
+            fields = set(fields).union(self._row_fields.get(method_name, []))
+            # The index is replaced (and never changed), because the rows that
+            # were already parsed keep using the previous one.
+            self._row_fields[method_name] = dict(
+                (field, idx) for idx, field in enumerate(sorted(fields)))
+
+    def get_row_fields(self, method_name):
+        """ The fields that are kept in the rows, or None to keep them all. """
+        fields_index = self._row_fields.get(method_name)
+        return sorted(fields_index) if fields_index else None
+
+    def _get_parser(self, request_body):
+        """ Returns the parser and the unmarshaller for the request. """
+        match = _METHOD_NAME_PATTERN.search(request_body, 0, 1024)
+        fields_index = match and self._row_fields.get(match.group(1))
+        if not fields_index:
+            return self.getparser()
+        unmarshaller = _CompactRowsUnmarshaller(fields_index)
+        return xmlrpclib.ExpatParser(unmarshaller), unmarshaller
+
+    def request(self, host, handler, request_body, verbose = 0):
+        url = "%s://%s%s" % (self.scheme, host, handler)
+        headers = {
+            'Content-Type'      : 'text/xml',
+            'User-Agent'        : self.user_agent,
+            'Accept-Encoding'   : 'gzip',
+        }
+        response = self.get_session().post(
+            url, data = request_body, headers = headers, stream = True,
+            timeout = self.timeout_secs)
+        try:
+            if response.status_code != 200:
+                raise xmlrpclib.ProtocolError(
+                    url, response.status_code, response.reason,
+                    response.headers)
+            parser, unmarshaller = self._get_parser(request_body)
+            # iter_content decodes the gzipped body while it's streamed.
+            for chunk in response.iter_content(XMLRPC_CHUNK_SIZE):
+                parser.feed(chunk)
+            parser.close()
+            return unmarshaller.close()
+        finally:
+            self._add_transferred(
+                _get_bytes_read(response), len(request_body))
+            response.close()
+
+
+_MISSING = object()
+
+class CompactRow(object):
+    """
+    A read-only dictionary of a row, that stores only the values (the names of
+    the fields are shared by all the rows of the same fields). Fields that were
+    not kept (or are missing from the row) behave like missing keys.
+
+    >>> row = CompactRow({'MovieName' : 0, 'MovieYear' : 1}, ('Alien', None))
+    >>> row['MovieName'], row.get('MovieYear'), 'MovieYear' in row
+    ('Alien', None, False)
+    >>> row == {'MovieName' : 'Alien'}
+    True
+    """
+    __slots__ = ('_fields_index', '_values')
+
+    def __init__(self, fields_index, values):
+        """
+        fields_index is a dict of field => index in values, values is a tuple
+        that holds a value (or None if the field is missing) for each field.
+        """
+        self._fields_index = fields_index
+        self._values = tuple(
+            _MISSING if value is None else value for value in values)
+
+    def __getitem__(self, key):
+        value = self._values[self._fields_index[key]]
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default = None):
+        idx = self._fields_index.get(key)
+        if idx is None or self._values[idx] is _MISSING:
+            return default
+        return self._values[idx]
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    has_key = __contains__
+
+    def keys(self):
+        return [key for key in sorted(self._fields_index) if key in self]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        try:
+            return dict(self.items()) == dict(other.items())
+        except AttributeError:
+            return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __str__(self):
+        return repr(self)
+
+    def __repr__(self):
+        return "<CompactRow %s>" % dict(self.items())
+
+
+class _CompactRowsUnmarshaller(xmlrpclib.Unmarshaller):
+    """
+    Unmarshals the response like xmlrpclib does, except for the rows: the
+    structs in the array of the response's struct, which become CompactRows.
+    """
+    # The number of containers that hold a row (including the row itself).
+    ROW_DEPTH = 3
+
+    def __init__(self, fields_index):
+        xmlrpclib.Unmarshaller.__init__(self)
+        self._fields_index = fields_index
+
+    def end_struct(self, data):
+        # The containers are tracked by their marks, so the depth is known
+        # without handling the start of each element.
+        if len(self._marks) != self.ROW_DEPTH:
+            return xmlrpclib.Unmarshaller.end_struct(self, data)
+
+        mark = self._marks.pop()
+        items = self._stack[mark:]
+        values = [None] * len(self._fields_index)
+        for idx in range(0, len(items), 2):
+            field_idx = self._fields_index.get(items[idx])
+            if field_idx is not None:
+                values[field_idx] = items[idx + 1]
+        self._stack[mark:] = [CompactRow(self._fields_index, values)]
+        self._value = 0
+
+    dispatch = dict(xmlrpclib.Unmarshaller.dispatch)
+    dispatch["struct"] = end_struct
+
+
+def _get_bytes_read(response):
+    """ The number of bytes that were received, before they were decoded. """
+    try:
+        return response.raw.tell()
+    except Exception:
+        return 0
@@ -0,0 +1,83 @@
+"""
+Compares the time it takes to hash the movie files in a directory with the
+original implementation (8 bytes at a time), and with api.filehash.
+
+Usage: python benchmark_filehash.py [directory] [repeats]
+
+The directory defaults to 'Tears of Steel'. Files that are too small to be
+hashed are skipped, and if none of the files can be hashed, a few large 
+(sparse) files are created in a temporary directory instead.
+"""
+import sys
+sys.path.append("..\\..\\src")
+sys.path.append("../../src")
+import os
+import time
+import shutil
+import tempfile
+
+from api.filehash import calculate_file_hash, HASH_BLOCK_SIZE
+from api.filehash import configure_file_hash_cache
+from test_filehash import reference_file_hash
+
+DEFAULT_DIRECTORY = os.path.join(os.path.dirname(__file__), "Tears of Steel")
+GENERATED_FILES = 8
+GENERATED_FILE_SIZE = 700 * 1024 * 1024
+
+
+def get_movie_files(directory):
+    file_paths = [
+        os.path.join(directory, file_name)
+        for file_name in sorted(os.listdir(directory))]
+    return [
+        file_path for file_path in file_paths 
+        if os.path.isfile(file_path) and 
+        os.path.getsize(file_path) >= HASH_BLOCK_SIZE * 2]
+
+def generate_movie_files(directory):
+    file_paths = []
+    for idx in range(GENERATED_FILES):
+        file_path = os.path.join(directory, "movie%d.mkv" % idx)
+        with open(file_path, "wb") as movie_file:
+            movie_file.write(os.urandom(HASH_BLOCK_SIZE))
+            movie_file.seek(GENERATED_FILE_SIZE - HASH_BLOCK_SIZE)
+            movie_file.write(os.urandom(HASH_BLOCK_SIZE))
+        file_paths.append(file_path)
+    return file_paths
+
+def measure(hash_func, file_paths, repeats):
+    start_time = time.time()
+    for idx in range(repeats):
+        hashes = map(hash_func, file_paths)
+    return (time.time() - start_time) / repeats, hashes
+
+def main(directory = DEFAULT_DIRECTORY, repeats = 5):
+    # We measure the calculation itself, so the hashes must not be cached.
+    configure_file_hash_cache(None)
+    generated_directory = None
+    file_paths = get_movie_files(directory)
+    if not file_paths:
+        print "No movie files in %s, generating some." % directory
+        generated_directory = tempfile.mkdtemp()
+        file_paths = generate_movie_files(generated_directory)
+    try:
+        reference_secs, reference_hashes = measure(
+            reference_file_hash, file_paths, repeats)
+        secs, hashes = measure(calculate_file_hash, file_paths, repeats)
+    finally:
+        if generated_directory:
+            shutil.rmtree(generated_directory)
+
+    if hashes != reference_hashes:
+        raise AssertionError("The hashes are different!")
+    print "Files:     %d" % len(file_paths)
+    print "Reference: %.2f ms per file" % (
+        reference_secs * 1000 / len(file_paths))
+    print "Current:   %.2f ms per file" % (secs * 1000 / len(file_paths))
+    print "Speed-up:  %.1fx" % (reference_secs / secs)
+
+
+if __name__ == "__main__":
+    directory = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_DIRECTORY
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    main(directory, repeats)
@@ -0,0 +1,200 @@
+"""
+Compares parsing large SearchSubtitles responses with xmlrpclib (a dict with
+all the fields for each row), and with the SessionTransport's compact rows
+(only the fields that the OpenSubtitles provider declares). Measures the
+parse time, the peak memory of the process while parsing, and the memory that
+is retained by the parsed rows.
+
+Each mode runs in a subprocess of its own, so the peak memory (the growth of
+resource.getrusage's ru_maxrss over the process's peak before the parse) of
+one mode doesn't hide the other's. The responses are passed to the subprocesses
+in a temporary file, so generating or loading them doesn't raise the peak 
+before the parse. The peak is not measured where the resource module is 
+missing (i.e., on Windows).
+
+Usage: python benchmark_xmlrpcrows.py [fixtures archive] [repeats]
+
+The responses are taken from the SearchSubtitles calls in the fixtures archive
+(see api.transports.RecordTransport). Without an archive, a response with 500
+rows of 60 fields (the maximum that the server returns) is generated.
+"""
+import sys
+sys.path.append("..\\..\\src")
+sys.path.append("../../src")
+import os
+import json
+import time
+import marshal
+import tempfile
+import xmlrpclib
+import subprocess
+
+from api.xmlrpctransport import SessionTransport
+from api.providers.opensubtitles.provider import OpenSubtitlesProvider
+from api.providers.opensubtitles.searchbatcher import ROW_FIELDS
+
+MODES = ["full", "compact"]
+GENERATED_ROWS = 500
+GENERATED_FIELDS = 60
+CHUNK_SIZE = 16 * 1024
+SEARCH_REQUEST_BODY = xmlrpclib.dumps(("token", []), "SearchSubtitles")
+
+
+def generate_response():
+    rows = []
+    for row_idx in range(GENERATED_ROWS):
+        row = dict(
+            ("Field%d" % idx, "value of field %d in row %d" % (idx, row_idx))
+            for idx in range(GENERATED_FIELDS))
+        row.update({
+            "IDMovieImdb" : "133093", "MovieName" : "The Matrix",
+            "MovieYear" : "1999", "MovieKind" : "movie",
+            "MovieReleaseName" : "The.Matrix.1999.720p.BluRay-GRP%d" % row_idx,
+            "SubActualCD" : "1", "SubLanguageID" : "eng",
+            "ZipDownloadLink" : "http://dl.opensubtitles.org/%d" % row_idx,
+            "QueryNumber" : "0", "QueryParameters" : {"query" : "matrix"}})
+        rows.append(row)
+    return xmlrpclib.dumps(
+        ({"status" : "200 OK", "data" : rows, "seconds" : 0.5},),
+        methodresponse = True)
+
+def load_responses(archive_path):
+    from api.transports import FixtureArchive
+    archive = FixtureArchive(archive_path)
+    return [record.content for record in archive.get_records()
+            if "<methodName>SearchSubtitles</methodName>" in record.body
+            and record.status == 200]
+
+def get_peak_memory():
+    """ The peak resident memory of the process so far in KB, or None. """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # It's in bytes on OS X, and in KB elsewhere.
+    return peak / 1024 if sys.platform == "darwin" else peak
+
+def get_deep_size(value, seen = None):
+    """ The memory that is retained by the value and everything it holds. """
+    seen = seen if seen is not None else set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(get_deep_size(key, seen) + get_deep_size(item, seen)
+                    for key, item in value.iteritems())
+    elif isinstance(value, (list, tuple)):
+        size += sum(get_deep_size(item, seen) for item in value)
+    elif hasattr(value, '_values'):
+        # The fields index is shared by all the rows, so it's counted once.
+        size += get_deep_size(value._fields_index, seen)
+        size += get_deep_size(value._values, seen)
+    return size
+
+def parse(transport, content):
+    parser, unmarshaller = transport._get_parser(SEARCH_REQUEST_BODY)
+    for idx in range(0, len(content), CHUNK_SIZE):
+        parser.feed(content[idx:idx + CHUNK_SIZE])
+    parser.close()
+    return unmarshaller.close()[0]
+
+def get_transport(mode):
+    transport = SessionTransport(lambda: None, 10, "benchmark")
+    if mode == "compact":
+        transport.set_row_fields(
+            "SearchSubtitles",
+            OpenSubtitlesProvider.search_subtitles_fields + ROW_FIELDS)
+    return transport
+
+def measure(mode, responses, repeats):
+    """
+    Returns a dict of the parse time, the peak memory growth (or None) and the
+    retained size of the parsed rows of the mode.
+    """
+    transport = get_transport(mode)
+    peak_before = get_peak_memory()
+    start_time = time.time()
+    for idx in range(repeats):
+        parsed = None
+        parsed = [parse(transport, content) for content in responses]
+    secs = (time.time() - start_time) / repeats
+    peak_after = get_peak_memory()
+    seen = set()
+    size = sum(get_deep_size(response['data'], seen) for response in parsed)
+    return {
+        "secs" : secs,
+        "peak_kb" : 
+            None if peak_before is None else peak_after - peak_before,
+        "retained_kb" : size / 1024}
+
+def measure_in_subprocess(mode, responses_path, repeats):
+    output = subprocess.check_output([
+        sys.executable, os.path.abspath(__file__), "--measure", mode,
+        responses_path, str(repeats)])
+    return json.loads(output)
+
+def check_rows(responses):
+    """ Makes sure that the compact rows have the values of the full ones. """
+    full_transport, compact_transport = map(get_transport, MODES)
+    for content in responses:
+        full = parse(full_transport, content)
+        compact = parse(compact_transport, content)
+        for full_row, compact_row in zip(full['data'], compact['data']):
+            for field, value in compact_row.items():
+                if full_row[field] != value:
+                    raise AssertionError("The rows are different!")
+    return sum(len(parse(full_transport, content)['data']) 
+               for content in responses)
+
+def format_peak(result):
+    if result["peak_kb"] is None:
+        return "unknown peak"
+    return "%d KB peak" % result["peak_kb"]
+
+def main(archive_path = None, repeats = 5):
+    if archive_path:
+        responses = load_responses(archive_path)
+    else:
+        responses = [generate_response()]
+    if not responses:
+        print "No SearchSubtitles responses in %s." % archive_path
+        return
+
+    file_descriptor, responses_path = tempfile.mkstemp()
+    try:
+        with os.fdopen(file_descriptor, "wb") as responses_file:
+            marshal.dump(responses, responses_file)
+        results = dict(
+            (mode, measure_in_subprocess(mode, responses_path, repeats))
+            for mode in MODES)
+    finally:
+        os.remove(responses_path)
+    rows = check_rows(responses)
+
+    print "Responses: %d (%d rows, %d KB)" % (
+        len(responses), rows, sum(map(len, responses)) / 1024)
+    for mode in MODES:
+        print "%-10s %.1f ms, %s, %d KB of rows retained" % (
+            mode.capitalize() + ":", results[mode]["secs"] * 1000, 
+            format_peak(results[mode]), results[mode]["retained_kb"])
+    full, compact = results["full"], results["compact"]
+    if full["peak_kb"] and compact["peak_kb"]:
+        print "Peak:      %.1fx smaller" % (
+            float(full["peak_kb"]) / compact["peak_kb"])
+    print "Retained:  %.1fx smaller" % (
+        float(full["retained_kb"]) / compact["retained_kb"])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--measure":
+        # A subprocess of main, that measures a single mode.
+        mode, responses_path, repeats = sys.argv[2:5]
+        with open(responses_path, "rb") as responses_file:
+            responses = marshal.load(responses_file)
+        print json.dumps(measure(mode, responses, int(repeats)))
+    else:
+        archive_path = sys.argv[1] if len(sys.argv) > 1 else None
+        repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+        main(archive_path, repeats)
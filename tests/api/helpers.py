@@ -14,4 +14,125 @@ class MockedProvider(IProvider):
     def __str__(self):
         return repr(self)
     def __repr__(self):
-        return "<Provider MockedProvider>"
\ No newline at end of file
+        return "<Provider MockedProvider>"
+
+class FakeOpenSubtitlesManager(object):
+    """
+    Stands for the OpenSubtitlesRequestsManager without network. Answers
+    CheckMovieHash2 with the hashes dictionary (hash => imdb id in 
+    OpenSubtitles's format), GetIMDBMovieDetails with the details dictionary 
+    (imdb id => the details data), and search_subtitles with the queries 
+    dictionary (query or movie hash => rows). The names of the called methods
+    are stored in the calls list. The titles are cached in title_cache (if
+    it's not None).
+    """
+    def __init__(self, hashes = {}, details = {}, queries = {},
+        title_cache = None):
+        self.hashes = hashes
+        self.details = details
+        self.queries = queries
+        self.title_cache = title_cache
+        self.calls = []
+
+    def get_title_cache(self):
+        return self.title_cache
+
+    def declare_search_subtitles_fields(self, fields):
+        pass
+
+    def CheckMovieHash2(self, file_hashes):
+        self.calls.append(("CheckMovieHash2", file_hashes))
+        data = dict(
+            (file_hash, [{"MovieImdbID" : self.hashes[file_hash]}])
+            for file_hash in file_hashes if file_hash in self.hashes)
+        return {"status" : "200 OK", "data" : data or []}
+
+    def GetIMDBMovieDetails(self, imdb_id):
+        self.calls.append(("GetIMDBMovieDetails", imdb_id))
+        if imdb_id not in self.details:
+            return None
+        return {"status" : "200 OK", "data" : self.details[imdb_id]}
+
+    def search_subtitles(self, query_params):
+        self.calls.append(("SearchSubtitles", query_params))
+        return self.queries.get(
+            query_params.get("query") or query_params.get("moviehash"), [])
+
+class LocalHTTPServer(object):
+    """
+    A small HTTP server that runs in a background thread and serves canned 
+    responses, so the requests managers can be tested without network. 
+
+    Responses are registered by path with add_response(). Every request that 
+    reaches the server is stored in the requests list as a tuple of 
+    (method, path, body, client_port), the port allows the tests to tell how
+    many connections were actually opened. If a response has an ETag header,
+    requests with a matching If-None-Match header are answered with 304.
+    """
+    def __init__(self):
+        import threading
+        from SocketServer import ThreadingMixIn
+        from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+        server = self
+        self.responses = {}
+        self.requests = []
+        self.delay_secs = 0
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _handle(self, method):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else ''
+                server.requests.append(
+                    (method, self.path, body, self.client_address[1]))
+                if server.delay_secs:
+                    import time
+                    time.sleep(server.delay_secs)
+                status, headers, content = server.responses.get(
+                    self.path, (404, {}, "not found"))
+                etag = headers.get("ETag")
+                if etag and self.headers.get("If-None-Match") == etag:
+                    status, content = 304, ""
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                if method != "HEAD":
+                    self.wfile.write(content)
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+            def do_HEAD(self):
+                self._handle("HEAD")
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self._server = Server(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def add_response(self, path, content, status = 200, headers = None):
+        self.responses[path] = (status, headers or {}, content)
+
+    def url(self, path):
+        return "http://127.0.0.1:%d%s" % (self._server.server_address[1], path)
+
+    @property
+    def connections_count(self):
+        return len(set(r[3] for r in self.requests))
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
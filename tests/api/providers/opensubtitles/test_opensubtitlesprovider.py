@@ -3,12 +3,14 @@ sys.path.append("..\\..")
 import os
 from api.providers.opensubtitles import provider as opensubtitlesprovider
 from api.providers.opensubtitles import OpenSubtitlesRequestsManager
+from api.providers.opensubtitles.titlecache import TitleCache
 OpenSubtitlesProvider = opensubtitlesprovider.OpenSubtitlesProvider
 from api.languages import Languages
 from api.title import MovieTitle
 from api.title import SeriesTitle
 from api.version import ProviderVersion
 from api.version import Version
+from helpers import FakeOpenSubtitlesManager
 
 import unittest
 import doctest
@@ -210,6 +212,89 @@ class TestOpenSubtitlesProvider(unittest.TestCase):
 
 
 
+MATRIX_DETAILS = {
+    "kind" : "movie", "title" : "The Matrix", "year" : "1999", 
+    "id" : "0133093"}
+ALIEN_DETAILS = {
+    "kind" : "movie", "title" : "Alien", "year" : "1979", "id" : "0078748"}
+
+class TestOpenSubtitlesProviderHashes(unittest.TestCase):
+    def setUp(self):
+        self.manager = FakeOpenSubtitlesManager(
+            hashes = {"aa" : "133093", "bb" : "133093", "cc" : "78748"},
+            details = {"133093" : MATRIX_DETAILS, "78748" : ALIEN_DETAILS})
+        self.provider = OpenSubtitlesProvider(
+            [Languages.ENGLISH], self.manager)
+
+    def _get_calls(self, method_name):
+        return [args for name, args in self.manager.calls 
+                if name == method_name]
+
+    def test_get_titles_by_hashes(self):
+        titles = self.provider.get_titles_by_hashes(["aa", "bb", "cc", "dd"])
+        self.assertEquals(sorted(titles), ["aa", "bb", "cc"])
+        self.assertEquals(titles["aa"].name, "The Matrix")
+        self.assertEquals(titles["cc"].imdb_id, "tt0078748")
+        self.assertEquals(len(self._get_calls("CheckMovieHash2")), 1)
+        # The details of each distinct imdb id are queried once.
+        self.assertEquals(
+            sorted(self._get_calls("GetIMDBMovieDetails")), 
+            ["133093", "78748"])
+
+    def test_hashes_are_split_by_the_server_limit(self):
+        original_limit = opensubtitlesprovider.MAX_HASHES_PER_CALL
+        opensubtitlesprovider.MAX_HASHES_PER_CALL = 2
+        try:
+            titles = self.provider.get_titles_by_hashes(["aa", "bb", "cc"])
+        finally:
+            opensubtitlesprovider.MAX_HASHES_PER_CALL = original_limit
+        self.assertEquals(len(titles), 3)
+        self.assertEquals(
+            self._get_calls("CheckMovieHash2"), [["aa", "bb"], ["cc"]])
+
+    def test_get_title_by_hash(self):
+        self.assertEquals(self.provider.get_title_by_hash("cc").name, "Alien")
+        self.assertIsNone(self.provider.get_title_by_hash("dd"))
+
+class TestOpenSubtitlesProviderTitleCache(unittest.TestCase):
+    def setUp(self):
+        self.manager = FakeOpenSubtitlesManager(
+            details = {"133093" : MATRIX_DETAILS, "78748" : ALIEN_DETAILS},
+            title_cache = TitleCache(":memory:"))
+        self.provider = OpenSubtitlesProvider(
+            [Languages.ENGLISH], self.manager)
+
+    def _get_details_calls(self):
+        return [args for name, args in self.manager.calls
+                if name == "GetIMDBMovieDetails"]
+
+    def test_titles_are_cached(self):
+        title = self.provider.get_title_by_imdb_id("tt0133093")
+        self.assertEquals(
+            self.provider.get_title_by_imdb_id("tt0133093"), title)
+        self.assertEquals(self._get_details_calls(), ["133093"])
+
+    def test_failures_are_not_cached(self):
+        self.assertIsNone(self.provider.get_title_by_imdb_id("tt0000001"))
+        self.assertIsNone(self.provider.get_title_by_imdb_id("tt0000001"))
+        self.assertEquals(self._get_details_calls(), ["1", "1"])
+
+    def test_warm_up_title_cache(self):
+        self.provider.get_title_by_imdb_id("tt0133093")
+        self.assertEquals(
+            self.provider.warm_up_title_cache(["tt0133093", "tt0078748"]), 1)
+        self.assertEquals(
+            self.provider.get_title_by_imdb_id("tt0078748").name, "Alien")
+        self.assertEquals(self._get_details_calls(), ["133093", "78748"])
+
+    def test_without_a_cache(self):
+        self.manager.title_cache = None
+        self.assertEquals(self.provider.warm_up_title_cache(["tt0133093"]), 0)
+        self.provider.get_title_by_imdb_id("tt0133093")
+        self.provider.get_title_by_imdb_id("tt0133093")
+        self.assertEquals(self._get_details_calls(), ["133093", "133093"])
+
+
 def run_tests():
     test_runner = unittest.TextTestRunner(verbosity=0)
     tests = doctest.DocTestSuite(
@@ -218,4 +303,10 @@ def run_tests():
     tests.addTests(
         unittest.defaultTestLoader.loadTestsFromTestCase(
             TestOpenSubtitlesProvider))
+    tests.addTests(
+        unittest.defaultTestLoader.loadTestsFromTestCase(
+            TestOpenSubtitlesProviderHashes))
+    tests.addTests(
+        unittest.defaultTestLoader.loadTestsFromTestCase(
+            TestOpenSubtitlesProviderTitleCache))
     test_runner.run(tests)
\ No newline at end of file
@@ -0,0 +1,187 @@
+from api.providers.opensubtitles import requestsmanager
+from api.providers.opensubtitles import OpenSubtitlesRequestsManager
+
+import os
+import json
+import time
+import doctest
+import tempfile
+import unittest
+import threading
+
+
+class FakeOpenSubtitlesServer(object):
+    """ An xml-rpc server with the methods of OpenSubtitles that we need. """
+    def __init__(self):
+        from SimpleXMLRPCServer import SimpleXMLRPCServer
+        self.logins = 0
+        self.calls = []
+        self.expired_tokens = set()
+        self._server = SimpleXMLRPCServer(
+            ("127.0.0.1", 0), logRequests = False, allow_none = True)
+        self._server.register_instance(self)
+        thread = threading.Thread(target = self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:%d/RPC2" % self._server.server_address[1]
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _response(self, token, **values):
+        if token in self.expired_tokens:
+            return {'status' : '406 No session'}
+        return dict(values, status = '200 OK')
+
+    def LogIn(self, username, password, language, user_agent):
+        self.logins += 1
+        return {'status' : '200 OK', 'token' : 'token%d' % self.logins}
+
+    def NoOperation(self, token):
+        self.calls.append(('NoOperation', token))
+        return self._response(token)
+
+    def Echo(self, token, value):
+        self.calls.append(('Echo', token))
+        return self._response(token, data = value)
+
+    def SearchSubtitles(self, token, queries):
+        self.calls.append(('SearchSubtitles', token))
+        return self._response(token, data = [
+            {'QueryNumber' : str(idx), 'MovieName' : query['query'],
+             'MovieYear' : '1999', 'SubFileName' : 'movie.srt'}
+            for idx, query in enumerate(queries)])
+
+
+class TestOpenSubtitlesRequestsManagerToken(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeOpenSubtitlesServer()
+        self.token_file_path = tempfile.mktemp()
+        self.managers = []
+
+    def tearDown(self):
+        for manager in self.managers:
+            manager.close()
+        self.server.stop()
+        if os.path.exists(self.token_file_path):
+            os.remove(self.token_file_path)
+
+    def _create_manager(self, **settings):
+        settings.setdefault('token_file_path', self.token_file_path)
+        manager = OpenSubtitlesRequestsManager(
+            api_url = self.server.url, **settings)
+        self.managers.append(manager)
+        return manager
+
+    def test_login_is_lazy(self):
+        manager = self._create_manager()
+        self.assertEquals(self.server.logins, 0)
+        self.assertEquals(manager.Echo("value")['data'], "value")
+        manager.Echo("value")
+        self.assertEquals(self.server.logins, 1)
+        self.assertEquals(
+            self.server.calls, [('Echo', 'token1'), ('Echo', 'token1')])
+
+    def test_token_is_persisted(self):
+        self._create_manager().Echo("value")
+        self._create_manager().Echo("value")
+        self.assertEquals(self.server.logins, 1)
+        with open(self.token_file_path) as token_file:
+            self.assertEquals(json.load(token_file)['token'], 'token1')
+
+    def test_token_file_is_private(self):
+        import shutil
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        token_file_path = os.path.join(directory, "subit", "token")
+        self._create_manager(token_file_path = token_file_path).Echo("value")
+        self.assertEquals(os.stat(token_file_path).st_mode & 0777, 0600)
+        self.assertEquals(
+            os.stat(os.path.dirname(token_file_path)).st_mode & 0777, 0700)
+        self.assertEquals(os.listdir(os.path.dirname(token_file_path)), 
+            ["token"])
+
+    @unittest.skipUnless(hasattr(os, 'symlink'), "Requires symlinks.")
+    def test_token_does_not_follow_links(self):
+        target_path = tempfile.mktemp()
+        self.addCleanup(os.remove, target_path)
+        with open(target_path, "w") as target_file:
+            target_file.write("target")
+        os.symlink(target_path, self.token_file_path)
+        self._create_manager().Echo("value")
+        self.assertFalse(os.path.islink(self.token_file_path))
+        with open(target_path) as target_file:
+            self.assertEquals(target_file.read(), "target")
+
+    def test_expired_persisted_token_is_ignored(self):
+        with open(self.token_file_path, "w") as token_file:
+            json.dump({
+                'api_url' : self.server.url, 
+                'token' : 'old', 
+                'expiry' : time.time() - 1}, token_file)
+        self._create_manager().Echo("value")
+        self.assertEquals(self.server.calls, [('Echo', 'token1')])
+
+    def test_expired_token_is_refreshed(self):
+        manager = self._create_manager()
+        manager.Echo("value")
+        self.server.expired_tokens.add('token1')
+        self.assertEquals(manager.Echo("value")['data'], "value")
+        self.assertEquals(self.server.logins, 2)
+        self.assertEquals(self.server.calls[-1], ('Echo', 'token2'))
+
+    def test_keepalive(self):
+        manager = self._create_manager(keepalive_secs = 0.1)
+        manager.Echo("value")
+        time.sleep(0.35)
+        self.assertIn(('NoOperation', 'token1'), self.server.calls)
+
+    def test_token_is_not_persisted_with_transport(self):
+        from api.transports import FixtureArchive, RecordTransport
+        archive = FixtureArchive(tempfile.mktemp())
+        manager = self._create_manager(transport = RecordTransport(archive))
+        manager.Echo("value")
+        self.assertFalse(os.path.exists(self.token_file_path))
+
+    def test_calls_are_recorded_and_replayed(self):
+        from api.transports import FixtureArchive
+        from api.transports import RecordTransport, ReplayTransport
+        archive = FixtureArchive(tempfile.mktemp())
+        self._create_manager(transport = RecordTransport(archive)).Echo("a")
+        self.server.stop()
+        manager = self._create_manager(transport = ReplayTransport(archive))
+        self.assertEquals(manager.Echo("a")['data'], "a")
+
+    def test_metrics(self):
+        from api.requestsmanager import get_metrics, reset_metrics
+        reset_metrics()
+        self._create_manager(provider_name = "os_metrics").Echo("value")
+        metrics = get_metrics()["os_metrics"]["Echo"]
+        self.assertEquals(metrics['requests'], 1)
+        self.assertGreater(metrics['bytes_in'], 0)
+        self.assertGreater(metrics['bytes_out'], 0)
+
+    def test_search_rows_hold_the_declared_fields(self):
+        from api.transports import FixtureArchive
+        from api.transports import RecordTransport, ReplayTransport
+        archive = FixtureArchive(tempfile.mktemp())
+        managers = [
+            self._create_manager(),
+            self._create_manager(transport = RecordTransport(archive)),
+            self._create_manager(transport = ReplayTransport(archive))]
+        for manager in managers:
+            manager.declare_search_subtitles_fields(['MovieName', 'MovieYear'])
+            rows = manager.search_subtitles({'query' : 'matrix'})
+            self.assertEquals(
+                sorted(rows[0].items()), [
+                    ('MovieName', 'matrix'), ('MovieYear', '1999'),
+                    ('QueryNumber', '0')])
+
+
+def run_tests():
+    test_runner = unittest.TextTestRunner(verbosity=0)
+    tests = doctest.DocTestSuite(requestsmanager)
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestOpenSubtitlesRequestsManagerToken))
+    test_runner.run(tests)
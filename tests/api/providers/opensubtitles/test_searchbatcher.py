@@ -0,0 +1,145 @@
+from api.providers.opensubtitles import searchbatcher
+from api.providers.opensubtitles.searchbatcher import SearchSubtitlesBatcher
+from api.providers.opensubtitles.provider import OpenSubtitlesProvider
+from api.languages import Languages
+
+import doctest
+import unittest
+from threading import Lock
+from multiprocessing.dummy import Pool as ThreadPool
+
+# query => rows, in the format of SearchSubtitles's results.
+ROWS = {
+    "matrix" : [{
+        "IDMovieImdb" : "133093", "MovieName" : "The Matrix", 
+        "MovieYear" : "1999", "MovieKind" : "movie", 
+        "MovieReleaseName" : "The.Matrix.1999.720p.BluRay-GRP",
+        "SubActualCD" : "1", "ZipDownloadLink" : "http://dl/1",
+        "SubLanguageID" : "eng"}],
+    "alien" : [{
+        "IDMovieImdb" : "78748", "MovieName" : "Alien", 
+        "MovieYear" : "1979", "MovieKind" : "movie", 
+        "MovieReleaseName" : "Alien.1979.DVDRip-GRP",
+        "SubActualCD" : "1", "ZipDownloadLink" : "http://dl/2",
+        "SubLanguageID" : "eng"}],
+}
+
+
+class FakeSearchSubtitles(object):
+    """ Stands for the SearchSubtitles method, and records the calls. """
+    def __init__(self, with_query_number = True):
+        self.with_query_number = with_query_number
+        self.calls = []
+        self._lock = Lock()
+
+    def __call__(self, queries):
+        with self._lock:
+            self.calls.append(queries)
+        data = []
+        for idx, query in enumerate(queries):
+            key = query.get("query") or query.get("moviehash")
+            for row in ROWS.get(key, []):
+                row = dict(row, QueryParameters = query)
+                if self.with_query_number:
+                    row["QueryNumber"] = str(idx)
+                data.append(row)
+        return {"status" : "200 OK", "data" : data or False}
+
+
+class FakeRequestsManager(object):
+    def __init__(self, batcher):
+        self.batcher = batcher
+
+    def declare_search_subtitles_fields(self, fields):
+        pass
+
+    def search_subtitles(self, query_params):
+        return self.batcher.search(query_params)
+
+
+class TestSearchSubtitlesBatcher(unittest.TestCase):
+    def setUp(self):
+        self.search_func = FakeSearchSubtitles()
+        self.batcher = SearchSubtitlesBatcher(
+            self.search_func, linger_secs = 0.2)
+        self.pool = ThreadPool(4)
+
+    def tearDown(self):
+        self.pool.close()
+
+    def _search_concurrently(self, queries):
+        return self.pool.map(self.batcher.search, queries)
+
+    def test_concurrent_queries_are_sent_together(self):
+        results = self._search_concurrently(
+            [{"query" : "matrix"}, {"query" : "alien"}, {"query" : "none"}])
+        self.assertEquals(len(self.search_func.calls), 1)
+        self.assertEquals(
+            [[row["MovieName"] for row in rows] for rows in results],
+            [["The Matrix"], ["Alien"], []])
+
+    def test_rows_are_matched_without_query_number(self):
+        self.search_func.with_query_number = False
+        results = self._search_concurrently(
+            [{"query" : "matrix"}, {"query" : "alien"}])
+        self.assertEquals(
+            [[row["MovieName"] for row in rows] for rows in results],
+            [["The Matrix"], ["Alien"]])
+
+    def test_identical_queries_are_sent_once(self):
+        results = self._search_concurrently([{"query" : "matrix"}] * 3)
+        self.assertEquals(self.search_func.calls, [[{"query" : "matrix"}]])
+        self.assertEquals(results[0], results[2])
+
+    def test_batch_size_is_limited(self):
+        self.batcher.max_queries = 2
+        self._search_concurrently(
+            [{"query" : "matrix"}, {"query" : "alien"}, {"query" : "none"}])
+        self.assertEquals(
+            sorted(len(queries) for queries in self.search_func.calls), [1, 2])
+
+    def test_failed_call(self):
+        batcher = SearchSubtitlesBatcher(lambda queries: None)
+        self.assertIsNone(batcher.search({"query" : "matrix"}))
+
+    def test_errors_are_raised_to_all_callers(self):
+        def search_func(queries):
+            raise ValueError("failed")
+        batcher = SearchSubtitlesBatcher(search_func)
+        with self.assertRaises(ValueError):
+            batcher.search({"query" : "matrix"})
+
+    def test_truncated_batch_is_split(self):
+        original_limit = searchbatcher.MAX_ROWS_PER_CALL
+        searchbatcher.MAX_ROWS_PER_CALL = 2
+        try:
+            results = self._search_concurrently(
+                [{"query" : "matrix"}, {"query" : "alien"}])
+        finally:
+            searchbatcher.MAX_ROWS_PER_CALL = original_limit
+        self.assertEquals(len(self.search_func.calls), 3)
+        self.assertEquals(
+            [len(rows) for rows in results], [1, 1])
+
+    def test_provider_gets_the_same_results(self):
+        provider = OpenSubtitlesProvider(
+            [Languages.ENGLISH], FakeRequestsManager(self.batcher))
+        get_release_name = lambda file_hash: \
+            provider.get_release_name_by_hash(file_hash, 1024)
+
+        single_results = map(get_release_name, ["matrix", "alien"])
+        self.search_func.calls = []
+        batched_results = self.pool.map(get_release_name, ["matrix", "alien"])
+        self.assertEquals(len(self.search_func.calls), 1)
+        self.assertEquals(batched_results, single_results)
+        self.assertEquals(
+            batched_results, 
+            ["the.matrix.1999.720p.bluray-grp", "alien.1979.dvdrip-grp"])
+
+
+def run_tests():
+    test_runner = unittest.TextTestRunner(verbosity=0)
+    tests = doctest.DocTestSuite(searchbatcher)
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestSearchSubtitlesBatcher))
+    test_runner.run(tests)
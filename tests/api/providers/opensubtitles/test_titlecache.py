@@ -0,0 +1,80 @@
+from api.providers.opensubtitles import titlecache
+from api.providers.opensubtitles.titlecache import TitleCache
+from api.title import MovieTitle
+from api.title import SeriesTitle
+
+import doctest
+import unittest
+
+
+class TestTitleCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = TitleCache(":memory:")
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_cache_directory_is_created(self):
+        import os
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        db_path = os.path.join(directory, "subit", "titles.sqlite")
+        cache = TitleCache(db_path)
+        cache.put("tt0133093", MovieTitle("The Matrix", 1999, "tt0133093"))
+        cache.close()
+        self.assertEquals(TitleCache(db_path).get("tt0133093").year, 1999)
+        self.assertEquals(
+            os.stat(os.path.dirname(db_path)).st_mode & 0777, 0700)
+
+    def test_movie(self):
+        title = MovieTitle("The Matrix", 1999, "tt0133093")
+        self.cache.put("tt0133093", title)
+        self.assertEquals(self.cache.get("tt133093"), title)
+        self.assertEquals(self.cache.hits, 1)
+
+    def test_episode(self):
+        title = SeriesTitle(
+            "Lost", 1, 1, "tt0636289", "Pilot", 2004, "tt0411008")
+        self.cache.put("tt0636289", title)
+        cached_title = self.cache.get("tt0636289")
+        self.assertIsInstance(cached_title, SeriesTitle)
+        self.assertEquals(cached_title.name, "Lost")
+        self.assertEquals(cached_title.imdb_id, "tt0411008")
+        self.assertEquals(cached_title.episode_imdb_id, "tt0636289")
+        self.assertEquals(cached_title.episode_name, "Pilot")
+        self.assertEquals(
+            (cached_title.season_number, cached_title.episode_number), (1, 1))
+        self.assertEquals(cached_title.year, 2004)
+
+    def test_series_is_stored_once(self):
+        self.cache.put("tt0636289", SeriesTitle(
+            "Lost", 1, 1, "tt0636289", "Pilot", 2004, "tt0411008"))
+        self.cache.put("tt0636290", SeriesTitle(
+            "LOST", 1, 2, "tt0636290", "Tabula Rasa", 2004, "tt0411008"))
+        connection = self.cache._get_connection()
+        self.assertEquals(
+            connection.execute("SELECT COUNT(*) FROM series").fetchone()[0], 1)
+        # Both episodes share the series data.
+        self.assertEquals(self.cache.get("tt0636289").name, "LOST")
+
+    def test_expired_titles_are_missing(self):
+        self.cache.put("tt0133093", MovieTitle("The Matrix", 1999, "tt0133093"))
+        self.cache.ttl_secs = -1
+        self.assertIsNone(self.cache.get("tt0133093"))
+        self.assertEquals(self.cache.misses, 1)
+
+    def test_get_missing(self):
+        self.cache.put("tt0133093", MovieTitle("The Matrix", 1999, "tt0133093"))
+        self.assertEquals(
+            self.cache.get_missing(["tt0078748", "tt0133093", "tt0078748"]),
+            ["tt0078748"])
+
+
+def run_tests():
+    test_runner = unittest.TextTestRunner(verbosity=0)
+    tests = doctest.DocTestSuite(titlecache)
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestTitleCache))
+    test_runner.run(tests)
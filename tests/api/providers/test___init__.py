@@ -2,6 +2,8 @@ import sys
 sys.path.append("..")
 from helpers import MockedProvider
 from api.providers import get_provider_instance
+from api.providers import prefetch_versions
+from api.providers import select_version
 from api.providers.providersnames import ProvidersNames
 from api.languages import Languages
 import unittest
@@ -38,7 +40,49 @@ class TestProvidersFactory(unittest.TestCase):
             MOCKED_PROVIDER_NAME, languages, lambda t: None, providers)
         self.assertEqual(provider.provider_name, MOCKED_PROVIDER_NAME)
 
+class PrefetchRecordingProvider(HebrewOnlyProvider):
+    def __init__(self, languages=None, requests_manager=None):
+        self.prefetched = None
+        self.selected = None
+    def prefetch_versions(self, provider_versions):
+        self.prefetched = provider_versions
+    def version_selected(self, provider_version):
+        self.selected = provider_version
+
+class TestPrefetchVersions(unittest.TestCase):
+    def setUp(self):
+        from api.title import MovieTitle
+        from api.titlesversions import TitlesVersions
+        from api.version import ProviderVersion
+        self.first = PrefetchRecordingProvider()
+        self.second = PrefetchRecordingProvider()
+        title = MovieTitle("The Matrix", 1999)
+        self.versions = [
+            ProviderVersion([], title, Languages.HEBREW, provider, rank=rank)
+            for provider, rank in [(self.first, 30), (self.second, 90),
+                                   (self.first, 80), (self.first, 60)]]
+        self.titles_versions = TitlesVersions(self.versions)
+
+    def test_top_versions_are_prefetched(self):
+        prefetch_versions(self.titles_versions, 3)
+        self.assertEqual(self.first.prefetched,
+            [self.versions[2], self.versions[3]])
+        self.assertEqual(self.second.prefetched, [self.versions[1]])
+
+    def test_providers_without_top_versions_get_none(self):
+        prefetch_versions(self.titles_versions, 1)
+        self.assertEqual(self.first.prefetched, [])
+        self.assertEqual(self.second.prefetched, [self.versions[1]])
+
+    def test_selected_version_is_told_to_all_providers(self):
+        select_version(self.titles_versions, self.versions[2])
+        self.assertIs(self.first.selected, self.versions[2])
+        self.assertIs(self.second.selected, self.versions[2])
+
 def run_tests():
     unittest.TextTestRunner(verbosity=0).run(
         unittest.defaultTestLoader.loadTestsFromTestCase(
-            TestProvidersFactory))
\ No newline at end of file
+            TestProvidersFactory))
+    unittest.TextTestRunner(verbosity=0).run(
+        unittest.defaultTestLoader.loadTestsFromTestCase(
+            TestPrefetchVersions))
\ No newline at end of file
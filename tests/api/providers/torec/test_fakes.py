@@ -0,0 +1,39 @@
+import sys
+sys.path.append("..\\..")
+from api.providers.torec import fakes
+from api.providers.torec.fakes import FakesCatalogue, FINGERPRINT_BYTES
+
+import unittest
+import doctest
+
+FAKE_HEAD = "PK\x03\x04" + "fake" * 100
+
+
+class TestFakesCatalogue(unittest.TestCase):
+    def test_only_the_fingerprint_bytes_count(self):
+        catalogue = FakesCatalogue()
+        catalogue.add_fake(FAKE_HEAD)
+        self.assertTrue(
+            catalogue.is_known_fake(FAKE_HEAD[:FINGERPRINT_BYTES] + "other"))
+        self.assertFalse(catalogue.is_known_fake(FAKE_HEAD[:-300]))
+
+    def test_least_recently_seen_is_forgotten(self):
+        catalogue = FakesCatalogue(max_fakes = 2)
+        catalogue.add_fake("first")
+        catalogue.add_fake("second")
+        self.assertTrue(catalogue.is_known_fake("first"))
+        catalogue.add_fake("third")
+        self.assertTrue(catalogue.is_known_fake("first"))
+        self.assertFalse(catalogue.is_known_fake("second"))
+        self.assertTrue(catalogue.is_known_fake("third"))
+
+
+def run_tests():
+    test_runner = unittest.TextTestRunner(verbosity=0)
+    tests = doctest.DocTestSuite(
+        fakes,
+        optionflags=doctest.NORMALIZE_WHITESPACE | doctest.ELLIPSIS)
+    tests.addTests(
+        unittest.defaultTestLoader.loadTestsFromTestCase(
+            TestFakesCatalogue))
+    test_runner.run(tests)
@@ -2,22 +2,41 @@ import sys
 sys.path.append("..\\..")
 import os
 import time
+import gc
+import threading
+from threading import Thread, Lock
+from api.providers.torec import hamster
 from api.providers.torec.hamster import TorecHashCodesHamster
+from api.exceptions import ProviderUnavailable
 from api.requestsmanager import RequestsManager
+from api.providers.torec.provider import TOREC_PAGES
+from api.scheduling import RequestContext, Priorities
+from helpers import LocalHTTPServer
 
 import unittest
 
 class TestTorecHashCodeHamster(unittest.TestCase):
     def setUp(self):
-        self.hamster = TorecHashCodesHamster(RequestsManager())
+        self._constants = (hamster.MAX_TICKET_SECS, hamster.TICKET_RETRY_SECS,
+                           hamster.MAX_TIME_FOR_SUB_ID_SECS)
+        hamster.MAX_TICKET_SECS = 0.1
+        hamster.TICKET_RETRY_SECS = 0.05
+        hamster.MAX_TIME_FOR_SUB_ID_SECS = 0.5
+        self.hamster = TorecHashCodesHamster(FakeTicketsRequestsManager())
+
+    def tearDown(self):
+        self.hamster.stop()
+        (hamster.MAX_TICKET_SECS, hamster.TICKET_RETRY_SECS,
+         hamster.MAX_TIME_FOR_SUB_ID_SECS) = self._constants
 
     def test_remove_after_max_time_passed(self):
         self.hamster.add_sub_id("23703")
         self.hamster.add_sub_id("2638")
         self.assertEquals(len(self.hamster._records), 2)
-        time.sleep(10)
+        time.sleep(0.2)
         self.assertEquals(len(self.hamster._records), 2)
-        time.sleep(120)
+        # The records are removed once their next ticket is due.
+        time.sleep(0.6)
         self.assertEquals(len(self.hamster._records), 0)
 
     def test_remove_after_after_request(self):
@@ -28,9 +47,267 @@ class TestTorecHashCodeHamster(unittest.TestCase):
         self.assertEquals(len(self.hamster._records), 1)
         self.assertEquals(self.hamster._records.keys()[0], "23703")
 
+    def test_sub_id_is_removed_with_its_last_reference(self):
+        self.hamster.add_sub_id("23703")
+        self.hamster.add_sub_id("23703")
+        self.hamster.remove_sub_id("23703")
+        self.assertEquals(self.hamster._records.keys(), ["23703"])
+        self.hamster.remove_sub_id("23703")
+        self.assertEquals(self.hamster._records, {})
+        self.hamster.remove_sub_id("23703")
+        self.assertEquals(self.hamster._records, {})
+
+
+class FakeTicketsRequestsManager(object):
+    """ Returns the guest codes, and then "guest" for every ticket request. """
+    def __init__(self, guest_codes = ()):
+        self.guest_codes = list(guest_codes)
+        self.requests = []
+        self._lock = Lock()
+
+    def perform_request_next(self, url, data = '', more_headers = {},
+        response_headers = [], priority = None):
+        with self._lock:
+            self.requests.append((time.time(), data["sub_id"]))
+            return self.guest_codes.pop(0) if self.guest_codes else "guest"
+
+
+class SlowTicketsRequestsManager(FakeTicketsRequestsManager):
+    """ Takes a while to return each ticket, and counts the requests. """
+    def __init__(self):
+        super(SlowTicketsRequestsManager, self).__init__()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def perform_request_next(self, *args, **kwargs):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(0.1)
+        with self._lock:
+            self.in_flight -= 1
+        return super(SlowTicketsRequestsManager, self).perform_request_next(
+            *args, **kwargs)
+
+
+class LocalTicketsRequestsManager(RequestsManager):
+    """ Sends the ticket requests to the local server. """
+    def __init__(self, server, **settings):
+        super(LocalTicketsRequestsManager, self).__init__(**settings)
+        self.server = server
+
+    def perform_request_next(self, url, *args, **kwargs):
+        if url == TOREC_PAGES.TICKET:
+            url = self.server.url("/ticket")
+        return super(LocalTicketsRequestsManager, self).perform_request_next(
+            url, *args, **kwargs)
+
+
+class TestTorecHashCodesHamsterScheduling(unittest.TestCase):
+    def setUp(self):
+        self._constants = (hamster.MAX_TICKET_SECS, hamster.TICKET_RETRY_SECS,
+                           hamster.MAX_TIME_FOR_SUB_ID_SECS)
+        hamster.MAX_TICKET_SECS = 0.3
+        hamster.TICKET_RETRY_SECS = 0.05
+        self.requests_manager = FakeTicketsRequestsManager()
+        self.hamster = TorecHashCodesHamster(self.requests_manager)
+
+    def tearDown(self):
+        self.hamster.stop()
+        (hamster.MAX_TICKET_SECS, hamster.TICKET_RETRY_SECS,
+         hamster.MAX_TIME_FOR_SUB_ID_SECS) = self._constants
+
+    def test_records_have_their_own_tickets(self):
+        self.hamster.add_sub_id("100")
+        self.hamster.add_sub_id("200")
+        self.hamster.get_ticket("100")
+        self.assertIsNot(
+            self.hamster._records["100"].tickets,
+            self.hamster._records["200"].tickets)
+
+    def test_get_ticket_waits_only_the_ticket_time(self):
+        start_time = time.time()
+        ticket = self.hamster.get_ticket("100")
+        time_waited = time.time() - start_time
+        self.assertEqual(ticket.sub_id, "100")
+        self.assertEqual(ticket.guest_code, "guest")
+        self.assertGreaterEqual(time_waited, hamster.MAX_TICKET_SECS)
+        self.assertLess(time_waited, hamster.MAX_TICKET_SECS + 0.15)
+
+    def test_next_ticket_is_requested_when_the_ticket_expires(self):
+        self.hamster.add_sub_id("100")
+        time.sleep(hamster.MAX_TICKET_SECS * 2.5)
+        requests_times = [t for t, _ in self.requests_manager.requests]
+        self.assertEqual(len(requests_times), 3)
+        for first, second in zip(requests_times, requests_times[1:]):
+            self.assertAlmostEqual(
+                second - first, hamster.MAX_TICKET_SECS, delta = 0.05)
+
+    def test_taken_ticket_is_replaced_immediately(self):
+        self.hamster.get_ticket("100")
+        start_time = time.time()
+        self.hamster.get_ticket("100")
+        self.assertLess(
+            time.time() - start_time, hamster.MAX_TICKET_SECS + 0.15)
+
+    def test_failed_ticket_is_retried(self):
+        self.requests_manager.guest_codes = ["error", ""]
+        ticket = self.hamster.get_ticket("100")
+        self.assertEqual(ticket.guest_code, "guest")
+        # The taken ticket might have been replaced while waiting for it.
+        self.assertEqual(self.requests_manager.guest_codes, [])
+        self.assertGreaterEqual(len(self.requests_manager.requests), 3)
+
+    def test_sub_id_is_removed_after_max_time(self):
+        hamster.MAX_TIME_FOR_SUB_ID_SECS = 0.4
+        self.hamster.add_sub_id("100")
+        time.sleep(1)
+        self.assertEqual(self.hamster._records, {})
+        self.assertEqual(len(self.requests_manager.requests), 2)
+
+    def test_due_requests_go_by_rank(self):
+        self.hamster.stop()
+        requests_manager = SlowTicketsRequestsManager()
+        self.hamster = TorecHashCodesHamster(requests_manager, max_workers = 1)
+        self.hamster.add_sub_id("busy")
+        time.sleep(0.05)
+        for sub_id, rank in [("low", 10), ("none", 0), ("high", 90)]:
+            self.hamster.add_sub_id(sub_id, rank)
+        time.sleep(0.5)
+        self.assertEqual(
+            [sub_id for _, sub_id in requests_manager.requests][:4],
+            ["busy", "high", "low", "none"])
+
+    def test_stop_releases_waiters(self):
+        self.requests_manager.guest_codes = ["error"] * 100
+        errors = []
+        def _get_ticket():
+            try:
+                self.hamster.get_ticket("100")
+            except ProviderUnavailable as eX:
+                errors.append(eX)
+        waiter = Thread(target = _get_ticket)
+        waiter.start()
+        time.sleep(0.1)
+        self.hamster.stop()
+        waiter.join(1)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(len(errors), 1)
+
+    def test_waited_ticket_goes_before_batch_requests(self):
+        server = LocalHTTPServer()
+        self.addCleanup(server.stop)
+        server.delay_secs = 0.6
+        for path in ["/first", "/scan", "/ticket"]:
+            server.add_response(path, path)
+        requests_manager = LocalTicketsRequestsManager(server)
+        self.addCleanup(requests_manager.close)
+        self.hamster.stop()
+        self.hamster = TorecHashCodesHamster(requests_manager)
+
+        def _scan():
+            with RequestContext(Priorities.BATCH):
+                requests_manager.perform_request(server.url("/scan"))
+        threads = [Thread(target = requests_manager.perform_request, 
+                          args = (server.url("/first"),)),
+                   Thread(target = _scan)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+            time.sleep(0.05)
+        # The prefetched ticket is queued after the scan, until we wait for it.
+        self.hamster.add_sub_id("100")
+        time.sleep(0.05)
+        self.assertEqual(
+            requests_manager.admission_controller.queue_depths["prefetch"], 1)
+        ticket = self.hamster.get_ticket("100")
+        self.assertEqual(ticket.guest_code, "/ticket")
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(
+            [request[1] for request in server.requests][:3],
+            ["/first", "/ticket", "/scan"])
+
+
+class TestSharedHamster(unittest.TestCase):
+    def setUp(self):
+        self.requests_manager = FakeTicketsRequestsManager()
+
+    def tearDown(self):
+        hamster.stop_all_hamsters()
+
+    def test_references_share_the_hamster(self):
+        first = hamster.get_shared_hamster(self.requests_manager)
+        second = hamster.get_shared_hamster(self.requests_manager)
+        other = hamster.get_shared_hamster(FakeTicketsRequestsManager())
+        self.assertIs(first.hamster, second.hamster)
+        self.assertIsNot(first.hamster, other.hamster)
+        first.add_sub_id("100")
+        self.assertEqual(second.hamster._records.keys(), ["100"])
+
+    def test_last_release_stops_the_hamster(self):
+        first = hamster.get_shared_hamster(self.requests_manager)
+        second = hamster.get_shared_hamster(self.requests_manager)
+        shared_hamster = first.hamster
+        first.release()
+        first.release()
+        self.assertFalse(shared_hamster.is_stopped)
+        second.release()
+        self.assertTrue(shared_hamster.is_stopped)
+        third = hamster.get_shared_hamster(self.requests_manager)
+        self.assertIsNot(third.hamster, shared_hamster)
+
+    def test_constant_threads_count(self):
+        threads = set(threading.enumerate())
+        references = [hamster.get_shared_hamster(self.requests_manager)
+                      for idx in range(100)]
+        new_threads = set(threading.enumerate()) - threads
+        self.assertEqual(
+            len(new_threads), hamster.MAX_CONCURRENT_TICKET_REQUESTS)
+        for idx in range(1000):
+            reference = hamster.get_shared_hamster(self.requests_manager)
+            reference.add_sub_id(str(idx % 10))
+        self.assertEqual(set(threading.enumerate()) - threads, new_threads)
+
+    def test_destroyed_references_are_released(self):
+        reference = hamster.get_shared_hamster(self.requests_manager)
+        shared_hamster = reference.hamster
+        del reference
+        gc.collect()
+        self.assertTrue(shared_hamster.is_stopped)
+        for worker in shared_hamster._workers:
+            worker.join(1)
+            self.assertFalse(worker.is_alive())
+
+    def test_concurrent_requests_are_bounded(self):
+        requests_manager = SlowTicketsRequestsManager()
+        reference = hamster.get_shared_hamster(requests_manager)
+        for idx in range(6):
+            reference.add_sub_id(str(idx))
+        time.sleep(0.5)
+        self.assertEqual(len(requests_manager.requests), 6)
+        self.assertEqual(requests_manager.max_in_flight,
+            hamster.MAX_CONCURRENT_TICKET_REQUESTS)
+
+    def test_stop_all_hamsters(self):
+        reference = hamster.get_shared_hamster(self.requests_manager)
+        shared_hamster = reference.hamster
+        hamster.stop_all_hamsters()
+        self.assertTrue(shared_hamster.is_stopped)
+        reference.release()
+        self.assertIsNot(
+            hamster.get_shared_hamster(self.requests_manager).hamster,
+            shared_hamster)
+
 
 def run_tests():
     test_runner = unittest.TextTestRunner(verbosity=0)
     tests = unittest.defaultTestLoader.loadTestsFromTestCase(
         TestTorecHashCodeHamster)
+    test_runner.run(tests)
+    tests = unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestTorecHashCodesHamsterScheduling)
+    test_runner.run(tests)
+    tests = unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestSharedHamster)
     test_runner.run(tests)
\ No newline at end of file
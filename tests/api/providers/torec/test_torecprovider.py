@@ -1,8 +1,11 @@
 import sys
 sys.path.append("..\\..")
 import os
+import time
+from threading import Lock
 from api.providers.torec import provider as torecprovider
 TorecProvider = torecprovider.TorecProvider
+from api import requestsmanager
 from api.requestsmanager import RequestsManager
 from api.languages import Languages
 from api.title import MovieTitle
@@ -14,6 +17,17 @@ import unittest
 import doctest
 
 
+class FakeTicketsRequestsManager(object):
+    """ Answers the ticket requests, and records their sub_ids. """
+    def __init__(self):
+        self.sub_ids = []
+
+    def perform_request_next(self, url, data = '', more_headers = {},
+        response_headers = [], priority = None):
+        self.sub_ids.append(data["sub_id"])
+        return "guest"
+
+
 class TestTorecProvider(unittest.TestCase):
     def setUp(self):
         self.provider = TorecProvider(
@@ -119,6 +133,302 @@ class TestTorecProvider(unittest.TestCase):
         self.assertGreater(len(buffer), 4096)
 
 
+class TestTorecProviderPrefetch(unittest.TestCase):
+    def setUp(self):
+        self.requests_manager = FakeTicketsRequestsManager()
+        self.provider = TorecProvider([Languages.HEBREW], self.requests_manager)
+        self.hamster = self.provider._hamster.hamster
+        title = MovieTitle("The Matrix", 1999)
+        self.versions = [
+            ProviderVersion([], title, Languages.HEBREW, self.provider,
+                attributes = {'sub_id' : sub_id, 'version_code' : 'code'})
+            for sub_id in [300, 100, 300, 200]]
+
+    def tearDown(self):
+        self.provider._hamster.release()
+
+    def test_tickets_are_prefetched_in_versions_order(self):
+        self.provider.prefetch_versions(self.versions[:3])
+        self.assertEqual(self.provider._prefetched_sub_ids, [300, 100])
+        self.assertEqual(sorted(self.hamster._records.keys()), [100, 300])
+        self.hamster._get_valid_ticket(100)
+        self.assertEqual(self.requests_manager.sub_ids[:2], [300, 100])
+
+    def test_prefetch_drops_other_sub_ids(self):
+        self.provider.prefetch_versions(self.versions[:2])
+        self.provider.prefetch_versions(self.versions[3:])
+        self.assertEqual(self.hamster._records.keys(), [200])
+
+    def test_selection_drops_other_sub_ids(self):
+        self.provider.prefetch_versions(self.versions)
+        self.provider.version_selected(self.versions[1])
+        self.assertEqual(self.hamster._records.keys(), [100])
+
+    def test_selection_of_other_provider_drops_all(self):
+        from helpers import MockedProvider
+        self.provider.prefetch_versions(self.versions)
+        other_version = ProviderVersion([], MovieTitle("The Matrix", 1999),
+            Languages.HEBREW, MockedProvider())
+        self.provider.version_selected(other_version)
+        self.assertEqual(self.hamster._records, {})
+
+    def test_providers_keep_their_own_prefetches(self):
+        other_provider = TorecProvider(
+            [Languages.HEBREW], self.requests_manager)
+        self.addCleanup(other_provider._hamster.release)
+        self.assertIs(other_provider._hamster.hamster, self.hamster)
+        self.provider.prefetch_versions(self.versions[:2])
+        other_provider.prefetch_versions(self.versions[1:2])
+        self.provider.version_selected(self.versions[0])
+        self.assertEqual(sorted(self.hamster._records.keys()), [100, 300])
+        other_provider.version_selected(self.versions[3])
+        self.assertEqual(self.hamster._records.keys(), [300])
+
+
+SEARCH_PAGE = "".join(
+    '<table><tr><td class="newd_table_titleLeft_BG">'
+    '<a href="/sub.asp?sub_id={}">The Matrix</a></td></tr></table>'.format(
+        sub_id) for sub_id in [1, 2, 3, 4, 5])
+
+SUB_PAGE = """
+<bdo>The Matrix</bdo>
+<a id="sub_imdb_link" href="http://www.imdb.com/title/tt0133093/">IMDB</a>
+<select id="download_version"><option value="code{sub_id}">-</option></select>
+<p id="version_list"><span>{version_string}</span></p>
+"""
+
+class FakeTorecRequestsManager(FakeTicketsRequestsManager):
+    """
+    Answers the search with the sub_ids 1 to 5, and the sub pages with a
+    single version each. The page of sub_id N takes (6 - N) / 20 secs, so they
+    arrive in reversed order.
+    """
+    def __init__(self, max_in_flight, version_strings = {}):
+        super(FakeTorecRequestsManager, self).__init__()
+        self.settings = {'max_in_flight' : max_in_flight}
+        self.version_strings = version_strings
+        self.sub_pages = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.closed = False
+        self._lock = Lock()
+
+    def close(self):
+        self.closed = True
+
+    def perform_request(self, url, data = '', more_headers = {},
+        response_headers = [], priority = None):
+        if url == torecprovider.TOREC_PAGES.SEARCH:
+            return SEARCH_PAGE
+        sub_id = int(url.rsplit("=", 1)[1])
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep((6 - sub_id) / 20.0)
+        with self._lock:
+            self.in_flight -= 1
+            self.sub_pages.append(sub_id)
+        return SUB_PAGE.format(sub_id = sub_id, version_string =
+            self.version_strings.get(sub_id, "The.Matrix.720p.HDTV-GRP"))
+
+
+class TestTorecProviderSubPages(unittest.TestCase):
+    def setUp(self):
+        self.title = MovieTitle("The Matrix", 1999, "tt0133093")
+        self.version = Version(["1080p", "bluray", "dts", "esir"], self.title)
+
+    def tearDown(self):
+        requestsmanager.close_all_managers()
+
+    def _register(self, requests_manager):
+        """ Makes requests_manager the factory's manager of Torec. """
+        requestsmanager._instances[
+            TorecProvider.provider_name.full_name] = requests_manager
+
+    def _get_versions(self, requests_manager, early_stop_rank = None):
+        self._register(requests_manager)
+        provider = TorecProvider([Languages.HEBREW], requests_manager)
+        provider.early_stop_rank = early_stop_rank
+        try:
+            titles_versions = provider.get_title_versions(
+                self.title, self.version)
+        finally:
+            provider._hamster.release()
+        return [version.attributes['sub_id']
+                for version in titles_versions.iter_versions()]
+
+    def test_pages_are_fetched_concurrently(self):
+        requests_manager = FakeTorecRequestsManager(3)
+        start_time = time.time()
+        sub_ids = self._get_versions(requests_manager)
+        self.assertLess(time.time() - start_time, 0.6)
+        self.assertEqual(requests_manager.max_in_flight, 3)
+        self.assertEqual(sub_ids, [1, 2, 3, 4, 5])
+
+    def test_pages_are_fetched_one_at_a_time_without_factory(self):
+        requests_manager = FakeTorecRequestsManager(3)
+        provider = TorecProvider([Languages.HEBREW], requests_manager)
+        self.addCleanup(provider._hamster.release)
+        provider.get_title_versions(self.title, self.version)
+        self.assertEqual(requests_manager.max_in_flight, 1)
+        self.assertEqual(requests_manager.sub_pages, [1, 2, 3, 4, 5])
+
+    def test_single_in_flight(self):
+        requests_manager = FakeTorecRequestsManager(1)
+        self.assertEqual(self._get_versions(requests_manager), [1, 2, 3, 4, 5])
+        self.assertEqual(requests_manager.max_in_flight, 1)
+        self.assertEqual(requests_manager.sub_pages, [1, 2, 3, 4, 5])
+
+    def test_early_stop(self):
+        requests_manager = FakeTorecRequestsManager(
+            1, {2 : "The.Matrix.1080p.BluRay.DTS-ESiR"})
+        self.assertEqual(self._get_versions(requests_manager, 100), [1, 2])
+        time.sleep(0.3)
+        # The page that was in flight when the version was found is fetched.
+        self.assertIn(requests_manager.sub_pages, ([1, 2], [1, 2, 3]))
+
+    def test_no_early_stop_below_rank(self):
+        requests_manager = FakeTorecRequestsManager(1)
+        self.assertEqual(
+            self._get_versions(requests_manager, 100), [1, 2, 3, 4, 5])
+
+    def test_best_versions_are_prefetched(self):
+        requests_manager = FakeTorecRequestsManager(3, {
+            4 : "The.Matrix.1080p.BluRay.DTS-ESiR",
+            2 : "The.Matrix.1080p.BluRay-GRP"})
+        self._register(requests_manager)
+        provider = TorecProvider([Languages.HEBREW], requests_manager)
+        self.addCleanup(provider._hamster.release)
+        provider.get_title_versions(self.title, self.version)
+        self.assertEqual(provider._prefetched_sub_ids[:2], [4, 2])
+        self.assertEqual(
+            len(provider._prefetched_sub_ids), torecprovider.PREFETCH_VERSIONS)
+        records = provider._hamster.hamster._records
+        self.assertGreater(records[4].rank, records[2].rank)
+
+
+class FakeResponse(object):
+    """ A download response that counts the chunks that were read. """
+    def __init__(self, content, headers = None):
+        self.content = content
+        self.headers = headers or {}
+        self.chunks_read = 0
+
+    def iter_content(self, chunk_size):
+        for idx in range(0, len(self.content), 100):
+            self.chunks_read += 1
+            yield self.content[idx:idx + 100]
+
+    def close(self):
+        pass
+
+
+class TestDownloadUnlessFake(unittest.TestCase):
+    FAKE = "PK\x03\x04" + "fake" * 750
+    REAL = "PK\x03\x04" + "real" * 2000
+
+    def setUp(self):
+        from api.providers.torec.fakes import FakesCatalogue
+        self.catalogue = FakesCatalogue()
+
+    def _download(self, response):
+        from api.downloads import Download
+        return torecprovider._download_unless_fake(
+            Download("http://a.com/b.zip", response, 100000),
+            4096, self.catalogue)
+
+    def test_fake_by_content_length(self):
+        response = FakeResponse(self.FAKE, {"Content-Length" : "3004"})
+        self.assertEquals(self._download(response), (None, '', 'fake size'))
+        self.assertEquals(response.chunks_read, 0)
+
+    def test_fake_is_learned(self):
+        response = FakeResponse(self.FAKE)
+        self.assertEquals(self._download(response), (None, '', 'fake size'))
+        self.assertEquals(response.chunks_read, 31)
+        response = FakeResponse(self.FAKE)
+        self.assertEquals(self._download(response), (None, '', 'known fake'))
+        self.assertEquals(response.chunks_read, 3)
+
+    def test_real_download(self):
+        self._download(FakeResponse(self.FAKE))
+        self.assertEquals(
+            self._download(FakeResponse(self.REAL)), 
+            ("b.zip", self.REAL, None))
+
+
+class FakeTicketsHamster(object):
+    """ Returns tickets that were got ticket_age secs ago right away. """
+    def __init__(self, ticket_age):
+        self.ticket_age = ticket_age
+
+    def add_sub_id(self, sub_id, rank = 0):
+        pass
+
+    def remove_sub_id(self, sub_id):
+        pass
+
+    def get_ticket(self, sub_id):
+        from api.providers.torec.hamster import TorecTicket
+        return TorecTicket(sub_id, time.time() - self.ticket_age, "guest")
+
+
+class FakeDownloadRequestsManager(object):
+    """
+    Answers the download requests with the sub_urls, and then with "error".
+    The downloads are the responses, and the priorities of the requests are
+    recorded.
+    """
+    def __init__(self, sub_urls = (), responses = ()):
+        self.sub_urls = list(sub_urls)
+        self.responses = list(responses)
+        self.priorities = []
+
+    def perform_request(self, url, data = '', more_headers = {},
+        response_headers = [], priority = None):
+        self.priorities.append(priority)
+        return self.sub_urls.pop(0) if self.sub_urls else "error"
+
+    def open_download(self, url, data = '', more_headers = {}, 
+        priority = None):
+        from api.downloads import Download
+        self.priorities.append(priority)
+        return Download(url, self.responses.pop(0), 100000)
+
+
+class TestTorecProviderDownload(unittest.TestCase):
+    SUB_URL = "/ajax/sub/sdls.asp?id=1"
+
+    def _download(self, requests_manager, ticket_age = 10):
+        provider = TorecProvider([Languages.HEBREW], requests_manager)
+        provider._hamster.release()
+        provider._hamster = FakeTicketsHamster(ticket_age)
+        provider_version = ProviderVersion([], MovieTitle("The Matrix", 1999),
+            Languages.HEBREW, provider,
+            attributes = {'sub_id' : 100, 'version_code' : 'code'})
+        return provider.download_subtitle_buffer(provider_version)
+
+    def test_rejected_downloads_are_counted(self):
+        requests_manager = FakeDownloadRequestsManager()
+        self.assertEqual(self._download(requests_manager), (None, None))
+        self.assertEqual(requests_manager.priorities, [None] * 5)
+
+    def test_real_download_after_fake(self):
+        requests_manager = FakeDownloadRequestsManager(
+            ["error", self.SUB_URL, self.SUB_URL], 
+            [FakeResponse(TestDownloadUnlessFake.FAKE),
+             FakeResponse(TestDownloadUnlessFake.REAL, 
+                {"Content-Disposition" : 'filename="matrix.zip"'})])
+        self.assertEqual(self._download(requests_manager), 
+            ("matrix.zip", TestDownloadUnlessFake.REAL))
+
+    def test_expired_ticket_raises_priority(self):
+        requests_manager = FakeDownloadRequestsManager()
+        self.assertEqual(
+            self._download(requests_manager, ticket_age = 20), (None, None))
+        self.assertEqual(requests_manager.priorities, [None, 0, 0, 0, 0])
+
+
 def run_tests():
     test_runner = unittest.TextTestRunner(verbosity=0)
     tests = doctest.DocTestSuite(
@@ -127,5 +437,17 @@ def run_tests():
     tests.addTests(
         unittest.defaultTestLoader.loadTestsFromTestCase(
             TestTorecProvider))
+    tests.addTests(
+        unittest.defaultTestLoader.loadTestsFromTestCase(
+            TestTorecProviderPrefetch))
+    tests.addTests(
+        unittest.defaultTestLoader.loadTestsFromTestCase(
+            TestDownloadUnlessFake))
+    tests.addTests(
+        unittest.defaultTestLoader.loadTestsFromTestCase(
+            TestTorecProviderSubPages))
+    tests.addTests(
+        unittest.defaultTestLoader.loadTestsFromTestCase(
+            TestTorecProviderDownload))
 
     test_runner.run(tests)
\ No newline at end of file
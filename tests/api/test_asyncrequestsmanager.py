@@ -0,0 +1,142 @@
+from api import asyncrequestsmanager
+from api import requestsmanager
+from api.asyncrequestsmanager import AsyncRequestsManager
+from api.exceptions import RequestsManagerClosed
+from helpers import LocalHTTPServer
+
+import doctest
+import unittest
+from threading import Lock
+
+NUMBER_OF_REQUESTS = 50
+SRT_CONTENT = "1\r\n00:00:01,000 --> 00:00:02,000\r\nHello\r\n"
+
+
+class CountingRequestsManager(requestsmanager.RequestsManager):
+    """
+    Records the maximal number of requests that were in flight at once, and
+    exposes a method that stands for an xml-rpc method.
+    """
+    def __init__(self, **settings):
+        requestsmanager.RequestsManager.__init__(self, **settings)
+        self._counter_lock = Lock()
+        self.current = 0
+        self.maximum = 0
+
+    def _perform_request(self, *args, **kwargs):
+        with self._counter_lock:
+            self.current += 1
+            self.maximum = max(self.maximum, self.current)
+        try:
+            return requestsmanager.RequestsManager._perform_request(
+                self, *args, **kwargs)
+        finally:
+            with self._counter_lock:
+                self.current -= 1
+
+    def Echo(self, value):
+        return {'status' : '200 OK', 'data' : value}
+
+
+class TestAsyncRequestsManager(unittest.TestCase):
+    def setUp(self):
+        self.server = LocalHTTPServer()
+        self.server.delay_secs = 0.05
+        for idx in range(NUMBER_OF_REQUESTS):
+            self.server.add_response("/%d" % idx, str(idx))
+        self.server.add_response("/sub.srt", SRT_CONTENT)
+        self.manager = AsyncRequestsManager(
+            CountingRequestsManager(max_in_flight = 3, pool_maxsize = 3))
+
+    def tearDown(self):
+        self.manager.close()
+        self.server.stop()
+
+    def test_requests_from_single_thread(self):
+        results = [
+            self.manager.perform_request(self.server.url("/%d" % idx))
+            for idx in range(NUMBER_OF_REQUESTS)]
+        self.assertEquals(
+            [result.get() for result in results],
+            [str(idx) for idx in range(NUMBER_OF_REQUESTS)])
+        self.assertEquals(self.manager.requests_manager.maximum, 3)
+
+    def test_limits_are_shared_with_blocking_callers(self):
+        results = [
+            self.manager.perform_request_text(self.server.url("/%d" % idx))
+            for idx in range(10)]
+        self.manager.requests_manager.perform_request(self.server.url("/10"))
+        for result in results:
+            result.wait()
+        self.assertEquals(self.manager.requests_manager.maximum, 3)
+
+    def test_callback(self):
+        responses = []
+        self.manager.perform_request(
+            self.server.url("/1"), callback = responses.append).wait()
+        self.assertEquals(responses, ["1"])
+
+    def test_download_file(self):
+        result = self.manager.download_file(self.server.url("/sub.srt"))
+        self.assertEquals(result.get(), ("sub.srt", SRT_CONTENT))
+
+    def test_download_failure_is_raised_by_get(self):
+        from api.exceptions import FailedDownloadingSubtitleBuffer
+        result = self.manager.download_file(self.server.url("/missing.srt"))
+        with self.assertRaises(FailedDownloadingSubtitleBuffer):
+            result.get()
+
+    def test_method_proxy(self):
+        self.assertEquals(self.manager.Echo("value").get()['data'], "value")
+        self.assertTrue(self.manager.is_available)
+
+    def test_configure_grows_pool(self):
+        self.manager.configure(max_in_flight = 5)
+        self.assertTrue(repr(self.manager).endswith("workers=5>"))
+
+    def test_caller_context_is_used(self):
+        from api.scheduling import RequestContext
+        from api.exceptions import RequestCancelled
+        context = RequestContext()
+        context.cancel()
+        with context:
+            result = self.manager.perform_request(self.server.url("/1"))
+        with self.assertRaises(RequestCancelled):
+            result.get()
+
+    def test_closed_manager_raises(self):
+        self.manager.close()
+        with self.assertRaises(RequestsManagerClosed):
+            self.manager.perform_request(self.server.url("/1"))
+
+
+class TestAsyncManagerFactory(unittest.TestCase):
+    def tearDown(self):
+        requestsmanager.close_all_managers()
+
+    def test_async_manager_wraps_the_same_manager(self):
+        async_manager = requestsmanager.get_manager_instance(
+            "async_provider", asynchronous = True)
+        self.assertIs(
+            async_manager.requests_manager,
+            requestsmanager.get_manager_instance("async_provider"))
+        self.assertIs(
+            async_manager,
+            requestsmanager.get_manager_instance(
+                "async_provider", asynchronous = True))
+
+    def test_close_all_managers_closes_async(self):
+        async_manager = requestsmanager.get_manager_instance(
+            "async_provider", asynchronous = True)
+        requestsmanager.close_all_managers()
+        self.assertTrue(async_manager.closed)
+
+
+def run_tests():
+    test_runner = unittest.TextTestRunner(verbosity=0)
+    tests = doctest.DocTestSuite(asyncrequestsmanager)
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestAsyncRequestsManager))
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestAsyncManagerFactory))
+    test_runner.run(tests)
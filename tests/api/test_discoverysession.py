@@ -0,0 +1,115 @@
+from api import discoverysession
+from api import identifiersextractor
+from api import titlediscovery
+from api.discoverysession import get_discovery_session
+from api.providers.opensubtitles import OpenSubtitlesProvider
+from api.languages import Languages
+from api.title import MovieTitle
+from api.title import SeriesTitle
+from helpers import FakeOpenSubtitlesManager
+
+import doctest
+import unittest
+import os
+
+MATRIX_ROWS = [
+    {"IDMovieImdb" : "133093", "MovieName" : "The Matrix",
+     "MovieYear" : "1999", "MovieKind" : "movie",
+     "MovieReleaseName" : "The.Matrix.1999.720p.BluRay-GRP"},
+    {"IDMovieImdb" : "133093", "MovieName" : "The Matrix",
+     "MovieYear" : "1999", "MovieKind" : "movie",
+     "MovieReleaseName" : "the.matrix.1999.720p.bluray-grp "},
+    {"IDMovieImdb" : "234215", "MovieName" : "The Matrix Reloaded",
+     "MovieYear" : "2003", "MovieKind" : "movie",
+     "MovieReleaseName" : "The.Matrix.Reloaded.2003.DVDRip-GRP"},
+]
+LOST_ROWS = [
+    {"IDMovieImdb" : "636294", "MovieName" : '"Lost" Tabula Rasa',
+     "MovieYear" : "2004", "MovieKind" : "episode", "SeriesSeason" : "1",
+     "SeriesEpisode" : "3", "SeriesIMDBParent" : "411008",
+     "MovieReleaseName" : "Lost.S01E03.HDTV.XviD-GRP"},
+]
+
+
+class TestDiscoverySession(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.directory, "movie.avi")
+        with open(self.file_path, "wb") as movie_file:
+            movie_file.write("a" * 200000)
+        self.manager = FakeOpenSubtitlesManager(details = {
+            "133093" : {
+                "kind" : "movie", "title" : "The Matrix", "year" : "1999",
+                "id" : "0133093"}})
+        self.provider = OpenSubtitlesProvider(
+            [Languages.ENGLISH], self.manager)
+        self.file_hash, file_size = \
+            self.provider.calculate_file_hash(self.file_path)
+        self._original_get_os_providers = (
+            titlediscovery._get_os_provider,
+            identifiersextractor._get_os_provider)
+        titlediscovery._get_os_provider = lambda: self.provider
+        identifiersextractor._get_os_provider = lambda: self.provider
+
+    def tearDown(self):
+        import shutil
+        (titlediscovery._get_os_provider,
+         identifiersextractor._get_os_provider) = \
+            self._original_get_os_providers
+        shutil.rmtree(self.directory)
+
+    def _get_calls(self):
+        return [name for name, args in self.manager.calls]
+
+    def test_title_and_release_name_share_a_single_search(self):
+        self.manager.queries = {self.file_hash : MATRIX_ROWS}
+        title = titlediscovery.discover_title_from_file_path(self.file_path)
+        self.assertEquals(title, MovieTitle("The Matrix", 1999, "tt0133093"))
+        self.assertEquals(
+            identifiersextractor._get_release_name_using_opensubtitles_hash(
+                [self.file_path]),
+            "the.matrix.1999.720p.bluray-grp")
+        self.assertEquals(self._get_calls(), ["SearchSubtitles"])
+
+    def test_series_title_from_the_search(self):
+        self.manager.queries = {self.file_hash : LOST_ROWS}
+        title = get_discovery_session(self.file_path, self.provider).get_title()
+        self.assertIsInstance(title, SeriesTitle)
+        self.assertEquals(title.name, "Lost")
+        self.assertEquals(title.imdb_id, "tt0411008")
+        self.assertEquals(title.episode_imdb_id, "tt0636294")
+        self.assertEquals(
+            (title.season_number, title.episode_number), (1, 3))
+
+    def test_falls_back_to_the_hash_lookup(self):
+        self.manager.hashes = {self.file_hash : "133093"}
+        session = get_discovery_session(self.file_path, self.provider)
+        self.assertEquals(session.get_title().name, "The Matrix")
+        self.assertIsNone(session.get_release_name())
+        self.assertEquals(
+            self._get_calls(),
+            ["SearchSubtitles", "CheckMovieHash2", "GetIMDBMovieDetails"])
+
+    def test_session_is_shared_until_the_file_changes(self):
+        session = get_discovery_session(self.file_path, self.provider)
+        self.assertIs(
+            get_discovery_session(self.file_path, self.provider), session)
+        os.utime(self.file_path, (0, 0))
+        self.assertIsNot(
+            get_discovery_session(self.file_path, self.provider), session)
+
+    def test_session_is_not_shared_between_managers(self):
+        session = get_discovery_session(self.file_path, self.provider)
+        other_provider = OpenSubtitlesProvider(
+            [Languages.ENGLISH], FakeOpenSubtitlesManager())
+        self.assertIsNot(
+            get_discovery_session(self.file_path, other_provider), session)
+
+
+def run_tests():
+    test_runner = unittest.TextTestRunner(verbosity=0)
+    tests = doctest.DocTestSuite(discoverysession)
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestDiscoverySession))
+    test_runner.run(tests)
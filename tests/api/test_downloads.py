@@ -0,0 +1,131 @@
+from api import downloads
+from api.downloads import Download, sniff_file_type
+from api.exceptions import InvalidDownloadContent, DownloadTooLarge
+
+import doctest
+import unittest
+
+SRT_CONTENT = "1\r\n00:00:01,000 --> 00:00:02,000\r\nHello\r\n" * 100
+
+
+class FakeResponse(object):
+    """ A response that returns its content in chunks of the given size. """
+    def __init__(self, content, headers = None, chunk_size = 10):
+        self.content = content
+        self.headers = headers or {}
+        self.chunk_size = chunk_size
+        self.chunks_read = 0
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for idx in range(0, len(self.content), self.chunk_size):
+            self.chunks_read += 1
+            yield self.content[idx:idx + self.chunk_size]
+
+    def close(self):
+        self.closed = True
+
+
+class TestSniffFileType(unittest.TestCase):
+    def test_archives(self):
+        self.assertEquals(sniff_file_type("Rar!\x1a\x07\x00"), "rar")
+        self.assertEquals(sniff_file_type("\x1f\x8b\x08"), "gzip")
+
+    def test_text_subtitles(self):
+        self.assertEquals(sniff_file_type("\xef\xbb\xbf" + SRT_CONTENT), "srt")
+        self.assertEquals(sniff_file_type("[Script Info]\r\n"), "ssa")
+        self.assertEquals(sniff_file_type("{1}{50}Hello"), "sub")
+        self.assertEquals(sniff_file_type("\xef\xbb\xbfWEBVTT\n"), "vtt")
+
+    def test_utf16_subtitles(self):
+        content = u"\ufeff" + SRT_CONTENT.decode("ascii")
+        for encoding in ["utf-16-le", "utf-16-be"]:
+            head = content.encode(encoding)[:downloads.SNIFF_BYTES]
+            self.assertEquals(sniff_file_type(head), "srt")
+            self.assertEquals(sniff_file_type(head[:-1]), "srt")
+
+    def test_unknown_content_is_kept(self):
+        self.assertEquals(sniff_file_type("Hello\r\n"), "unknown")
+        self.assertEquals(sniff_file_type("\x00\x01\x02"), "unknown")
+
+    def test_error_pages(self):
+        self.assertIsNone(sniff_file_type(""))
+        self.assertIsNone(sniff_file_type("  <html><body>Error</body>"))
+        self.assertIsNone(sniff_file_type("<!doctype html>"))
+        self.assertIsNone(sniff_file_type("\xef\xbb\xbf<HEAD><TITLE>"))
+        self.assertIsNone(sniff_file_type('{"error": "Limit reached"}'))
+
+
+class TestDownload(unittest.TestCase):
+    def test_read(self):
+        response = FakeResponse(SRT_CONTENT)
+        with Download("http://a.com/b.srt", response, 10000) as download:
+            self.assertEquals(download.read(), SRT_CONTENT)
+            self.assertEquals(download.file_type, "srt")
+            self.assertEquals(download.file_name, "b.srt")
+        self.assertTrue(response.closed)
+
+    def test_read_utf16_srt(self):
+        content = (u"\ufeff" + SRT_CONTENT.decode("ascii")).encode("utf-16-le")
+        with Download("http://a.com/b.srt", FakeResponse(content), 
+            10000) as download:
+            self.assertEquals(download.read(), content)
+            self.assertEquals(download.file_type, "srt")
+
+    def test_read_short_content(self):
+        download = Download("http://a.com/", FakeResponse("PK\x03\x04"), 100)
+        self.assertEquals(download.read(), "PK\x03\x04")
+
+    def test_invalid_content_is_aborted_early(self):
+        response = FakeResponse("<html>" * 1000)
+        download = Download("http://a.com/", response, 10000)
+        with self.assertRaises(InvalidDownloadContent):
+            download.read()
+        self.assertLess(response.chunks_read, 10)
+
+    def test_too_large_by_content_length(self):
+        response = FakeResponse(SRT_CONTENT, {"content-length" : "20000"})
+        download = Download("http://a.com/", response, 10000)
+        self.assertEquals(download.content_length, 20000)
+        with self.assertRaises(DownloadTooLarge):
+            download.read()
+        self.assertEquals(response.chunks_read, 0)
+
+    def test_too_large_while_streaming(self):
+        response = FakeResponse(SRT_CONTENT)
+        download = Download("http://a.com/", response, 100)
+        with self.assertRaises(DownloadTooLarge):
+            download.read()
+        self.assertEquals(response.chunks_read, 11)
+
+    def test_peek_does_not_consume(self):
+        response = FakeResponse(SRT_CONTENT)
+        download = Download("http://a.com/", response, 10000)
+        self.assertEquals(download.peek(25), SRT_CONTENT[:25])
+        self.assertEquals(response.chunks_read, 3)
+        self.assertEquals(download.peek(5), SRT_CONTENT[:5])
+        self.assertEquals(response.chunks_read, 3)
+        self.assertEquals(download.read(), SRT_CONTENT)
+
+    def test_peek_short_content(self):
+        download = Download("http://a.com/", FakeResponse("PK\x03\x04"), 100)
+        self.assertEquals(download.peek(), "PK\x03\x04")
+        self.assertEquals(download.read(), "PK\x03\x04")
+
+    def test_close_calls_on_close_once(self):
+        calls = []
+        download = Download(
+            "http://a.com/", FakeResponse(""), 100, lambda: calls.append(1))
+        download.close()
+        download.close()
+        self.assertEquals(calls, [1])
+
+
+def run_tests():
+    test_runner = unittest.TextTestRunner(verbosity=0)
+    tests = doctest.DocTestSuite(downloads)
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestSniffFileType))
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestDownload))
+    test_runner.run(tests)
@@ -0,0 +1,214 @@
+from api import filehash
+
+import os
+import struct
+import doctest
+import tempfile
+import unittest
+
+
+def reference_file_hash(file_path):
+    """ The original implementation, that reads 8 bytes at a time. """
+    longlongformat = 'q'
+    bytesize = struct.calcsize(longlongformat)
+    filesize = os.path.getsize(file_path)
+    hash = filesize
+    with open(file_path, "rb") as f:
+        for x in range(65536/bytesize):
+            (l_value,) = struct.unpack(longlongformat, f.read(bytesize))
+            hash += l_value
+            hash = hash & 0xFFFFFFFFFFFFFFFF
+        f.seek(max(0, filesize - 65536), 0)
+        for x in range(65536/bytesize):
+            (l_value,) = struct.unpack(longlongformat, f.read(bytesize))
+            hash += l_value
+            hash = hash & 0xFFFFFFFFFFFFFFFF
+    return ("%016x" % hash, filesize)
+
+
+class TestCalculateFileHash(unittest.TestCase):
+    def setUp(self):
+        self.file_paths = []
+
+    def tearDown(self):
+        for file_path in self.file_paths:
+            os.remove(file_path)
+
+    def _create_file(self, content):
+        file_descriptor, file_path = tempfile.mkstemp()
+        with os.fdopen(file_descriptor, "wb") as movie_file:
+            movie_file.write(content)
+        self.file_paths.append(file_path)
+        return file_path
+
+    def test_identical_to_reference(self):
+        for size in [65536 * 2, 65536 * 2 + 3, 1024 * 1024 + 17]:
+            file_path = self._create_file(os.urandom(size))
+            self.assertEquals(
+                filehash.calculate_file_hash(file_path),
+                reference_file_hash(file_path))
+
+    def test_overflow(self):
+        file_path = self._create_file("\xff" * 65536 * 3)
+        self.assertEquals(
+            filehash.calculate_file_hash(file_path),
+            reference_file_hash(file_path))
+
+    def test_small_file(self):
+        file_path = self._create_file("\x00" * (65536 * 2 - 1))
+        with self.assertRaises(BufferError):
+            filehash.calculate_file_hash(file_path)
+
+
+class TestFileHashCache(unittest.TestCase):
+    def setUp(self):
+        import time
+        self.directory = tempfile.mkdtemp()
+        filehash.configure_file_hash_cache(
+            os.path.join(self.directory, "hashes.sqlite"))
+        self.cache = filehash.get_file_hash_cache()
+        self.file_path = os.path.join(self.directory, "movie.mkv")
+        self._write_file("a", time.time() - 60)
+
+    def tearDown(self):
+        import shutil
+        filehash.configure_file_hash_cache(filehash.DEFAULT_CACHE_PATH)
+        shutil.rmtree(self.directory)
+
+    def _write_file(self, content, mtime):
+        with open(self.file_path, "wb") as movie_file:
+            movie_file.write(content * 65536 * 3)
+        os.utime(self.file_path, (mtime, mtime))
+
+    def test_unchanged_file_is_not_read(self):
+        file_hash = filehash.calculate_file_hash(self.file_path)
+        original_sum_block = filehash._sum_block
+        def fail(block):
+            raise AssertionError("The file was read.")
+        filehash._sum_block = fail
+        try:
+            self.assertEquals(
+                filehash.calculate_file_hash(self.file_path), file_hash)
+        finally:
+            filehash._sum_block = original_sum_block
+        self.assertEquals(self.cache.hits, 1)
+
+    def test_changed_file_is_hashed_again(self):
+        import time
+        filehash.calculate_file_hash(self.file_path)
+        self._write_file("b", time.time() - 30)
+        self.assertEquals(
+            filehash.calculate_file_hash(self.file_path),
+            reference_file_hash(self.file_path))
+        self.assertEquals(self.cache.hits, 0)
+
+    def test_subsecond_mtime_change_is_detected(self):
+        import time
+        mtime = int(time.time()) - 60 + 0.25
+        self._write_file("a", mtime)
+        filehash.calculate_file_hash(self.file_path)
+        os.utime(self.file_path, (mtime + 0.5, mtime + 0.5))
+        self.assertIsNone(self.cache.get(self.file_path))
+
+    def test_older_schema_is_replaced(self):
+        import sqlite3
+        db_path = os.path.join(self.directory, "old.sqlite")
+        connection = sqlite3.connect(db_path)
+        connection.execute("CREATE TABLE file_hashes (file_id TEXT "
+            "PRIMARY KEY, size INTEGER, mtime_ns INTEGER, hash TEXT)")
+        connection.commit()
+        connection.close()
+        cache = filehash.FileHashCache(db_path)
+        cache.put(self.file_path, "0123456789abcdef")
+        self.assertEquals(cache.get(self.file_path), "0123456789abcdef")
+        cache.close()
+
+    def test_recently_modified_file_is_not_cached(self):
+        import time
+        self._write_file("a", time.time())
+        filehash.calculate_file_hash(self.file_path)
+        self.assertIsNone(self.cache.get(self.file_path))
+
+    def test_cache_is_persistent(self):
+        file_hash, file_size = filehash.calculate_file_hash(self.file_path)
+        cache = filehash.FileHashCache(self.cache.db_path)
+        self.assertEquals(cache.get(self.file_path), file_hash)
+        cache.close()
+
+    def test_cache_directory_is_created(self):
+        db_path = os.path.join(self.directory, "subit", "hashes.sqlite")
+        cache = filehash.FileHashCache(db_path)
+        cache.put(self.file_path, "0123456789abcdef")
+        cache.close()
+        self.assertTrue(os.path.exists(db_path))
+        self.assertEquals(
+            os.stat(os.path.dirname(db_path)).st_mode & 0777, 0700)
+
+    def test_default_cache_is_not_shared(self):
+        self.assertFalse(filehash.DEFAULT_CACHE_PATH.startswith(
+            tempfile.gettempdir()))
+
+
+class TestPrehashFiles(unittest.TestCase):
+    def setUp(self):
+        import time
+        self.directory = tempfile.mkdtemp()
+        filehash.configure_file_hash_cache(
+            os.path.join(self.directory, "hashes.sqlite"))
+        self.file_paths = []
+        for sub_directory, name in [("b", "a.mkv"), ("a", "b.mkv"),
+                                    ("a", "a.mkv"), ("a.mkv", "a.mkv")]:
+            directory = os.path.join(self.directory, sub_directory)
+            if not os.path.isdir(directory):
+                os.mkdir(directory)
+            file_path = os.path.join(directory, name)
+            with open(file_path, "wb") as movie_file:
+                movie_file.write(os.urandom(65536 * 3))
+            os.utime(file_path, (time.time() - 60, time.time() - 60))
+            self.file_paths.append(file_path)
+
+    def tearDown(self):
+        import shutil
+        filehash.configure_file_hash_cache(filehash.DEFAULT_CACHE_PATH)
+        shutil.rmtree(self.directory)
+
+    def test_files_are_hashed_by_directory(self):
+        results = filehash.prehash_files(self.file_paths, 2).get(10)
+        self.assertEquals(
+            [os.path.relpath(path, self.directory) for path, _ in results],
+            [os.path.join("a", "a.mkv"), os.path.join("a", "b.mkv"),
+             os.path.join("a.mkv", "a.mkv"), os.path.join("b", "a.mkv")])
+        for file_path, file_hash in results:
+            self.assertEquals(file_hash, reference_file_hash(file_path)[0])
+
+    def test_hashes_are_cached(self):
+        filehash.prehash_files(self.file_paths).get(10)
+        for file_path in self.file_paths:
+            filehash.calculate_file_hash(file_path)
+        self.assertEquals(
+            filehash.get_file_hash_cache().hits, len(self.file_paths))
+
+    def test_failed_files_are_skipped(self):
+        small_file_path = os.path.join(self.directory, "small.mkv")
+        with open(small_file_path, "wb") as movie_file:
+            movie_file.write("small")
+        results = dict(filehash.prehash_files(
+            [small_file_path, self.file_paths[0]]).get(10))
+        self.assertIsNone(results[small_file_path])
+        self.assertIsNotNone(results[self.file_paths[0]])
+
+    def test_nothing_is_hashed_without_a_cache(self):
+        filehash.configure_file_hash_cache(None)
+        self.assertIsNone(filehash.prehash_files(self.file_paths))
+
+
+def run_tests():
+    test_runner = unittest.TextTestRunner(verbosity=0)
+    tests = doctest.DocTestSuite(filehash)
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestCalculateFileHash))
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestFileHashCache))
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestPrehashFiles))
+    test_runner.run(tests)
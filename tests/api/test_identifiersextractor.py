@@ -18,6 +18,9 @@ class MockedOpenSubtitlesProvider(IProvider):
     def get_release_name_by_hash(self, file_hash, file_size):
         return self._release_name
 
+    def get_title_and_release_name_by_hash(self, file_hash, file_size):
+        return (None, self._release_name)
+
     def get_title_versions(self, input):
         pass
     def download_subtitle_buffer(self, provider_version):
@@ -0,0 +1,78 @@
+from api import metrics
+from api.metrics import MetricsRegistry, Histogram
+
+import json
+import doctest
+import unittest
+
+
+class TestHistogram(unittest.TestCase):
+    def test_buckets_bounds_are_inclusive(self):
+        histogram = Histogram([1, 2])
+        histogram.observe(1)
+        histogram.observe(2)
+        self.assertEquals(histogram.counts, [1, 1, 0])
+
+    def test_summary(self):
+        histogram = Histogram([1])
+        histogram.observe(0.5)
+        histogram.observe(1.5)
+        summary = histogram.to_dict()
+        self.assertEquals(summary['count'], 2)
+        self.assertEquals(summary['mean'], 1.0)
+        self.assertEquals(summary['max'], 1.5)
+
+
+class TestMetricsRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_metrics_are_kept_per_endpoint(self):
+        self.registry.record_request("a", "/search", 0.1, 10, 5)
+        self.registry.record_request("a", "/search", 0.2, 10, 5)
+        self.registry.record_request("a", "/download", 1, 100)
+        self.registry.record_retry("b", "/search")
+        all_metrics = self.registry.get_metrics()
+        self.assertEquals(all_metrics["a"]["/search"]["requests"], 2)
+        self.assertEquals(all_metrics["a"]["/search"]["bytes_out"], 10)
+        self.assertEquals(all_metrics["a"]["/download"]["bytes_in"], 100)
+        self.assertEquals(
+            all_metrics["a"]["/search"]["latency_secs"]["count"], 2)
+        self.assertEquals(all_metrics["b"]["/search"]["retries"], 1)
+        self.assertEquals(all_metrics["b"]["/search"]["requests"], 0)
+
+    def test_queue_wait(self):
+        self.registry.record_queue_wait("a", "/search", 0.3)
+        self.assertEquals(
+            self.registry.get_metrics()["a"]["/search"]["queue_wait_secs"]
+                ["total"], 
+            0.3)
+
+    def test_reset(self):
+        self.registry.record_timeout("a", "/search")
+        self.registry.reset()
+        self.assertEquals(self.registry.get_metrics(), {})
+
+    def test_dump_json(self):
+        import os
+        import tempfile
+        self.registry.record_cache_miss("a", "/search")
+        file_descriptor, file_path = tempfile.mkstemp()
+        os.close(file_descriptor)
+        try:
+            dump = self.registry.dump_json(file_path)
+            with open(file_path) as metrics_file:
+                self.assertEquals(metrics_file.read(), dump)
+        finally:
+            os.remove(file_path)
+        self.assertEquals(json.loads(dump)["a"]["/search"]["cache_misses"], 1)
+
+
+def run_tests():
+    test_runner = unittest.TextTestRunner(verbosity=0)
+    tests = doctest.DocTestSuite(metrics)
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestHistogram))
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestMetricsRegistry))
+    test_runner.run(tests)
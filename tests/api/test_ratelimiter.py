@@ -0,0 +1,168 @@
+from api import ratelimiter
+from api.ratelimiter import TokenBucket, AdmissionController
+from api.scheduling import Priorities, RequestContext
+from api.exceptions import RequestCancelled
+
+import time
+import doctest
+import unittest
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_burst_is_not_delayed(self):
+        bucket = TokenBucket(10)
+        start_time = time.time()
+        for idx in range(10):
+            bucket.consume()
+        self.assertLess(time.time() - start_time, 0.5)
+
+    def test_rate_after_burst(self):
+        bucket = TokenBucket(4, capacity = 1)
+        start_time = time.time()
+        for idx in range(5):
+            bucket.consume()
+        # The first token is in the bucket, the other 4 take 0.25 secs each.
+        self.assertGreaterEqual(time.time() - start_time, 0.95)
+
+class TestAdmissionController(unittest.TestCase):
+    def test_in_flight_count(self):
+        controller = AdmissionController(max_in_flight = 2)
+        controller.acquire()
+        controller.acquire()
+        self.assertEquals(controller.in_flight, 2)
+        controller.release()
+        self.assertEquals(controller.in_flight, 1)
+        controller.release()
+
+    def test_blocks_until_released(self):
+        from threading import Thread
+        controller = AdmissionController(max_in_flight = 1)
+        controller.acquire()
+        thread = Thread(target=controller.acquire)
+        thread.daemon = True
+        thread.start()
+        thread.join(0.5)
+        self.assertTrue(thread.is_alive())
+        controller.release()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+
+    def test_configure_wakes_waiters(self):
+        from threading import Thread
+        controller = AdmissionController(max_in_flight = 1)
+        controller.acquire()
+        thread = Thread(target=controller.acquire)
+        thread.daemon = True
+        thread.start()
+        thread.join(0.5)
+        controller.configure(max_in_flight = 2)
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertEquals(controller.in_flight, 2)
+
+class TestAdmissionControllerPriorities(unittest.TestCase):
+    def setUp(self):
+        self.controller = AdmissionController(max_in_flight = 1)
+        self.controller.acquire()
+        self.admitted = []
+        self.threads = []
+
+    def _queue(self, name, priority, context = None):
+        """ Queues a request in its own thread, and waits until it's queued. """
+        from threading import Thread
+        def request():
+            try:
+                self.controller.acquire(priority, context)
+            except RequestCancelled:
+                self.admitted.append("cancelled " + name)
+                return
+            self.admitted.append(name)
+            self.controller.release()
+        thread = Thread(target=request)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+        time.sleep(0.1)
+
+    def _release_and_join(self):
+        self.controller.release()
+        for thread in self.threads:
+            thread.join(1)
+
+    def test_priority_order(self):
+        self._queue("prefetch", Priorities.PREFETCH)
+        self._queue("batch", Priorities.BATCH)
+        self._queue("download", Priorities.DOWNLOAD)
+        self._queue("interactive", Priorities.INTERACTIVE)
+        self._release_and_join()
+        self.assertEquals(
+            self.admitted, ["interactive", "download", "batch", "prefetch"])
+
+    def test_fifo_within_priority(self):
+        for idx in range(4):
+            self._queue(str(idx), Priorities.BATCH)
+        self._release_and_join()
+        self.assertEquals(self.admitted, ["0", "1", "2", "3"])
+
+    def test_queue_depths(self):
+        self._queue("batch", Priorities.BATCH)
+        self._queue("batch", Priorities.BATCH)
+        self._queue("prefetch", Priorities.PREFETCH)
+        depths = self.controller.queue_depths
+        self.assertEquals(depths["batch"], 2)
+        self.assertEquals(depths["prefetch"], 1)
+        self.assertEquals(depths["interactive"], 0)
+        self._release_and_join()
+        self.assertEquals(self.controller.queue_depths["batch"], 0)
+        self.assertEquals(self.controller.peak_queue_depths["batch"], 2)
+
+    def test_raised_context_is_reprioritized(self):
+        context = RequestContext(Priorities.PREFETCH)
+        self._queue("prefetch", None, context)
+        self._queue("batch", Priorities.BATCH)
+        context.raise_priority(Priorities.DOWNLOAD)
+        self.assertEquals(self.controller.queue_depths["download"], 1)
+        self._release_and_join()
+        self.assertEquals(self.admitted, ["prefetch", "batch"])
+
+    def test_context_forgets_the_controller(self):
+        context = RequestContext(Priorities.BATCH)
+        self._queue("first", None, context)
+        self._queue("second", None, context)
+        self.assertEquals(context._controllers, {self.controller : 2})
+        self._release_and_join()
+        self.assertEquals(self.admitted, ["first", "second"])
+        self.assertEquals(context._controllers, {})
+
+    def test_cancel_queued_requests(self):
+        context = RequestContext(Priorities.BATCH)
+        self._queue("scan", None, context)
+        self._queue("interactive", Priorities.INTERACTIVE)
+        context.cancel()
+        self.threads[0].join(1)
+        self.assertEquals(self.admitted, ["cancelled scan"])
+        self.assertEquals(self.controller.queue_depths["batch"], 0)
+        self._release_and_join()
+        self.assertEquals(self.admitted, ["cancelled scan", "interactive"])
+
+    def test_cancelled_context_is_not_admitted(self):
+        context = RequestContext()
+        context.cancel()
+        self.controller.release()
+        with self.assertRaises(RequestCancelled):
+            self.controller.acquire(context = context)
+        self.assertEquals(self.controller.in_flight, 0)
+
+
+def run_tests():
+    test_runner = unittest.TextTestRunner(verbosity=0)
+    tests = doctest.DocTestSuite(
+        ratelimiter, 
+        optionflags=doctest.NORMALIZE_WHITESPACE|doctest.ELLIPSIS)
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestTokenBucket))
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestAdmissionController))
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestAdmissionControllerPriorities))
+    test_runner.run(tests)
@@ -1,4 +1,7 @@
 from api import requestsmanager
+from api.exceptions import RequestsManagerClosed
+from api.exceptions import ProviderUnavailable
+from helpers import LocalHTTPServer
 
 import time
 import doctest
@@ -6,6 +9,8 @@ import unittest
 
 SECONDS_BETWEEN_REQEUESTS = 2
 NUMBER_OF_THREADS = 2
+SRT_CONTENT = "1\r\n00:00:01,000 --> 00:00:02,000\r\nHello\r\n"
+ZIP_CONTENT = "PK\x03\x04" + "\x00" * 100
 
 
 class TimeDiffCheckerRequestsManager(requestsmanager.RequestsManager):
@@ -22,6 +27,23 @@ class NoTimeDiffCheckerRequestsManager(requestsmanager.RequestsManager):
     def _perform_request(self, *args, **kwargs):
         pass
 
+class ConcurrencyCounterRequestsManager(requestsmanager.RequestsManager):
+    """ Records the maximal number of requests that were in flight at once. """
+    def __init__(self, **settings):
+        requestsmanager.RequestsManager.__init__(self, **settings)
+        from threading import Lock
+        self._counter_lock = Lock()
+        self.current = 0
+        self.maximum = 0
+
+    def _perform_request(self, *args, **kwargs):
+        with self._counter_lock:
+            self.current += 1
+            self.maximum = max(self.maximum, self.current)
+        time.sleep(SECONDS_BETWEEN_REQEUESTS / 2.0)
+        with self._counter_lock:
+            self.current -= 1
+
 class TestRequestsManagerAsyncOp(unittest.TestCase):
     def setUp(self):
         from multiprocessing.dummy import Pool
@@ -50,6 +72,65 @@ class TestRequestsManagerAsyncOp(unittest.TestCase):
             end_time - start_time,
             SECONDS_BETWEEN_REQEUESTS * NUMBER_OF_THREADS)
 
+    def test_multithreaded_perform_request_next_is_limited(self):
+        start_time = time.time()
+        requests_manager = TimeDiffCheckerRequestsManager()
+        requests_manager.test_case = self
+        self.threads_pool.map(
+            lambda idx: requests_manager.perform_request_next("a", "a"),
+            range(NUMBER_OF_THREADS))
+        end_time = time.time()
+        self.assertGreaterEqual(
+            end_time - start_time,
+            SECONDS_BETWEEN_REQEUESTS * NUMBER_OF_THREADS)
+
+    def test_max_in_flight(self):
+        from multiprocessing.dummy import Pool
+        requests_manager = ConcurrencyCounterRequestsManager(max_in_flight = 3)
+        start_time = time.time()
+        Pool(6).map(
+            lambda idx: requests_manager.perform_request("a%d" % idx), 
+            range(6))
+        end_time = time.time()
+        self.assertEquals(requests_manager.maximum, 3)
+        # Two rounds of 3 requests each.
+        self.assertLess(end_time - start_time, SECONDS_BETWEEN_REQEUESTS * 1.5)
+
+    def test_max_in_flight_applies_to_both_paths(self):
+        from multiprocessing.dummy import Pool
+        requests_manager = ConcurrencyCounterRequestsManager(max_in_flight = 2)
+        Pool(6).map(
+            lambda idx: (requests_manager.perform_request("a%d" % idx) 
+                if idx % 2 
+                else requests_manager.perform_request_next("a%d" % idx)),
+            range(6))
+        self.assertEquals(requests_manager.maximum, 2)
+
+    def test_requests_per_second(self):
+        from multiprocessing.dummy import Pool
+        requests_manager = NoTimeDiffCheckerRequestsManager(
+            requests_per_second = 2, max_in_flight = 6)
+        start_time = time.time()
+        Pool(6).map(
+            lambda idx: requests_manager.perform_request("a%d" % idx), 
+            range(6))
+        end_time = time.time()
+        # The first two are sent as a burst, the other four are spaced by
+        # half a second from each other.
+        self.assertGreaterEqual(end_time - start_time, 1.9)
+        self.assertLess(end_time - start_time, 3)
+
+    def test_configure_manager_changes_limits(self):
+        requestsmanager.configure_manager(
+            "limited_manager", requests_per_second = 5, max_in_flight = 3)
+        try:
+            controller = requestsmanager.get_manager_instance(
+                "limited_manager").admission_controller
+            self.assertEquals(controller.max_in_flight, 3)
+            self.assertEquals(controller.requests_per_second, 5)
+        finally:
+            requestsmanager.close_all_managers()
+
 class TestPerformRequestContent(unittest.TestCase):
     def setUp(self):
         self.manager = requestsmanager.get_manager_instance("test_manager")
@@ -123,6 +204,458 @@ class TestPerformRequestContent(unittest.TestCase):
             sha1(buff).digest(), 
             "694eedfb35fa572da0cb4f2c2abd61d873d76735".decode("hex"))
 
+class TestRequestsManagerSession(unittest.TestCase):
+    def setUp(self):
+        self.server = LocalHTTPServer()
+        self.server.add_response("/page", "content")
+        self.manager = requestsmanager.RequestsManager()
+
+    def tearDown(self):
+        self.manager.close()
+        self.server.stop()
+
+    def test_connection_is_kept_alive(self):
+        for idx in range(5):
+            self.assertEquals(
+                self.manager.perform_request(self.server.url("/page")), 
+                "content")
+        self.assertEquals(len(self.server.requests), 5)
+        self.assertEquals(self.server.connections_count, 1)
+
+    def test_closed_manager_raises(self):
+        self.manager.close()
+        self.assertTrue(self.manager.closed)
+        with self.assertRaises(RequestsManagerClosed):
+            self.manager.perform_request(self.server.url("/page"))
+        with self.assertRaises(RequestsManagerClosed):
+            self.manager.perform_request_next(self.server.url("/page"))
+
+    def test_context_manager_closes(self):
+        with requestsmanager.RequestsManager(pool_maxsize = 2) as manager:
+            self.assertEquals(manager.pool_maxsize, 2)
+            manager.perform_request(self.server.url("/page"))
+        self.assertTrue(manager.closed)
+
+class TestRequestsManagerCoalescing(unittest.TestCase):
+    def setUp(self):
+        from multiprocessing.dummy import Pool
+        self.threads_pool = Pool(4)
+        self.server = LocalHTTPServer()
+        self.server.delay_secs = 0.5
+        self.server.add_response("/page", "\tcontent\r\n")
+        self.manager = requestsmanager.RequestsManager(max_in_flight = 4)
+
+    def tearDown(self):
+        self.manager.close()
+        self.server.stop()
+
+    def test_identical_requests_are_coalesced(self):
+        url = self.server.url("/page")
+        responses = self.threads_pool.map(
+            lambda idx: self.manager.perform_request(url), range(4))
+        self.assertEquals(responses, ["\tcontent\r\n"] * 4)
+        self.assertEquals(len(self.server.requests), 1)
+        self.assertEquals(self.manager.coalesced_requests, 3)
+
+    def test_text_requests_are_coalesced(self):
+        url = self.server.url("/page")
+        responses = self.threads_pool.map(
+            lambda idx: self.manager.perform_request_text(url), range(4))
+        self.assertEquals(responses, ["content"] * 4)
+        self.assertEquals(len(self.server.requests), 1)
+
+    def test_headers_are_not_shared(self):
+        url = self.server.url("/page")
+        responses = self.threads_pool.map(
+            lambda idx: self.manager.perform_request(
+                url, response_headers = ["Content-Length"]), 
+            range(2))
+        self.assertEquals(len(self.server.requests), 1)
+        self.assertEquals(responses[0], responses[1])
+        self.assertIsNot(responses[0][1], responses[1][1])
+
+    def test_different_requests_are_not_coalesced(self):
+        self.threads_pool.map(
+            lambda idx: self.manager.perform_request(
+                self.server.url("/page"), 
+                more_headers = {"Referer" : str(idx)}),
+            range(4))
+        self.assertEquals(len(self.server.requests), 4)
+
+    def test_post_requests_are_not_coalesced(self):
+        self.threads_pool.map(
+            lambda idx: self.manager.perform_request(
+                self.server.url("/page"), {"sub_id" : "1"}),
+            range(4))
+        self.assertEquals(len(self.server.requests), 4)
+
+class TestRequestsManagerCache(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        from api.responsecache import ResponseCache
+        self.directory = tempfile.mkdtemp()
+        self.cache = ResponseCache(self.directory, 
+            ttl_rules = [(r"/stale", 0.2), (r"/download", 0), (r"/", 60)])
+        self.server = LocalHTTPServer()
+        self.server.add_response("/page", "content")
+        self.server.add_response("/download", "file")
+        self.server.add_response("/stale", "stale", headers = {"ETag" : "1"})
+        self.manager = requestsmanager.RequestsManager(cache = self.cache)
+
+    def tearDown(self):
+        import shutil
+        self.manager.close()
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def test_fresh_response_is_not_requested(self):
+        for idx in range(3):
+            self.assertEquals(
+                self.manager.perform_request(self.server.url("/page")), 
+                "content")
+        self.assertEquals(len(self.server.requests), 1)
+        stats = self.cache.stats
+        self.assertEquals(stats['misses'], 1)
+        self.assertEquals(stats['hits'], 2)
+        self.assertEquals(stats['bytes_saved'], len("content") * 2)
+
+    def test_post_is_keyed_by_body(self):
+        self.manager.perform_request(self.server.url("/page"), {"q" : "a"})
+        self.manager.perform_request(self.server.url("/page"), {"q" : "b"})
+        self.manager.perform_request(self.server.url("/page"), {"q" : "a"})
+        self.assertEquals(len(self.server.requests), 2)
+
+    def test_cached_response_headers(self):
+        url = self.server.url("/page")
+        first = self.manager.perform_request(url, response_headers = ["ETag", 
+            "Content-Length"])
+        second = self.manager.perform_request(url, response_headers = [
+            "Content-Length"])
+        self.assertEquals(first, ("content", {"Content-Length" : "7"}))
+        self.assertEquals(second, first)
+
+    def test_stale_response_is_revalidated(self):
+        url = self.server.url("/stale")
+        self.assertEquals(self.manager.perform_request(url), "stale")
+        time.sleep(0.3)
+        self.assertEquals(self.manager.perform_request(url), "stale")
+        self.assertEquals(len(self.server.requests), 2)
+        self.assertEquals(self.cache.stats['revalidations'], 1)
+        # After the revalidation, the entry is fresh again.
+        self.manager.perform_request(url)
+        self.assertEquals(len(self.server.requests), 2)
+
+    def test_stale_entry_is_loaded_once(self):
+        url = self.server.url("/stale")
+        self.manager.perform_request(url)
+        time.sleep(0.3)
+        loads = []
+        original_get = self.cache.get
+        def get(*args, **kwargs):
+            loads.append(args)
+            return original_get(*args, **kwargs)
+        self.cache.get = get
+        self.assertEquals(self.manager.perform_request(url), "stale")
+        self.assertEquals(len(self.server.requests), 2)
+        self.assertEquals(len(loads), 1)
+
+    def test_download_file_is_not_cached(self):
+        self.server.add_response("/subtitle", SRT_CONTENT)
+        url = self.server.url("/subtitle")
+        self.manager.perform_request(url)
+        file_name, content = self.manager.download_file(url)
+        self.assertEquals(content, SRT_CONTENT)
+        self.assertEquals(len(self.server.requests), 2)
+
+class TestRequestsManagerRetries(unittest.TestCase):
+    def setUp(self):
+        self.server = LocalHTTPServer()
+        self.server.add_response("/page", "content")
+        self.server.add_response("/error", "error", status = 503)
+        self.manager = requestsmanager.RequestsManager(
+            backoff_base_secs = 0, failure_threshold = 2, cooldown_secs = 0.5)
+
+    def tearDown(self):
+        self.manager.close()
+        self.server.stop()
+
+    def _request_error(self):
+        with self.assertRaises(ProviderUnavailable):
+            self.manager.perform_request(self.server.url("/error"))
+
+    def test_server_error_is_retried(self):
+        self._request_error()
+        self.assertEquals(len(self.server.requests), 3)
+
+    def test_client_error_is_not_retried(self):
+        self.assertEquals(
+            self.manager.perform_request(self.server.url("/missing")), "")
+        self.assertEquals(len(self.server.requests), 1)
+        self.assertTrue(self.manager.is_available)
+
+    def test_retry_budget_limits_retries(self):
+        self.manager.configure(retry_budget_ratio = 0, failure_threshold = 10)
+        for idx in range(3):
+            self._request_error()
+        # The first 3 retries are always allowed, but no more.
+        self.assertEquals(len(self.server.requests), 6)
+
+    def test_circuit_opens_after_failures(self):
+        self.manager.configure(max_attempts = 1)
+        for idx in range(2):
+            self._request_error()
+        self.assertFalse(self.manager.is_available)
+        with self.assertRaises(ProviderUnavailable):
+            self.manager.perform_request(self.server.url("/page"))
+        with self.assertRaises(ProviderUnavailable):
+            self.manager.download_file(self.server.url("/page"))
+        self.assertEquals(len(self.server.requests), 2)
+
+    def test_circuit_closes_after_successful_probe(self):
+        import time
+        self.manager.configure(max_attempts = 1)
+        for idx in range(2):
+            self._request_error()
+        time.sleep(0.5)
+        self.assertTrue(self.manager.is_available)
+        self.assertEquals(
+            self.manager.perform_request(self.server.url("/page")), "content")
+        self.assertEquals(self.manager.circuit_breaker.state, "closed")
+
+class TestRequestsManagerDownloads(unittest.TestCase):
+    def setUp(self):
+        self.server = LocalHTTPServer()
+        self.server.add_response("/sub.zip", ZIP_CONTENT, headers = {
+            "Content-Disposition" : 'attachment; filename="sub.zip"'})
+        self.server.add_response("/error.html", "<html>Error</html>")
+        self.manager = requestsmanager.RequestsManager(
+            max_download_bytes = len(ZIP_CONTENT), backoff_base_secs = 0)
+
+    def tearDown(self):
+        self.manager.close()
+        self.server.stop()
+
+    def test_download_file(self):
+        file_name, content = self.manager.download_file(
+            self.server.url("/sub.zip"))
+        self.assertEquals(file_name, "sub.zip")
+        self.assertEquals(content, ZIP_CONTENT)
+
+    def test_html_download_is_rejected(self):
+        from api.exceptions import InvalidDownloadContent
+        with self.assertRaises(InvalidDownloadContent):
+            self.manager.download_file(self.server.url("/error.html"))
+
+    def test_missing_download_fails(self):
+        from api.exceptions import FailedDownloadingSubtitleBuffer
+        with self.assertRaises(FailedDownloadingSubtitleBuffer):
+            self.manager.download_file(self.server.url("/missing.zip"))
+        self.assertEquals(self.manager.admission_controller.in_flight, 0)
+
+    def test_content_length_before_read(self):
+        from api.exceptions import DownloadTooLarge
+        self.manager.configure(max_download_bytes = 10)
+        with self.manager.open_download(self.server.url("/sub.zip")) as download:
+            self.assertEquals(download.content_length, len(ZIP_CONTENT))
+            self.assertEquals(self.manager.admission_controller.in_flight, 1)
+            with self.assertRaises(DownloadTooLarge):
+                download.read()
+        self.assertEquals(self.manager.admission_controller.in_flight, 0)
+
+class TestRequestsManagerPriorities(unittest.TestCase):
+    def setUp(self):
+        self.server = LocalHTTPServer()
+        # The first request must stay in flight until all the others are
+        # queued (each one is started 0.1 seconds after the previous one).
+        self.server.delay_secs = 1
+        for path in ["/first", "/ticket", "/scan", "/query"]:
+            self.server.add_response(path, path)
+        self.manager = requestsmanager.RequestsManager()
+        self.threads = []
+
+    def tearDown(self):
+        self.manager.close()
+        self.server.stop()
+
+    def _start(self, func, *args, **kwargs):
+        from threading import Thread
+        thread = Thread(target=func, args=args, kwargs=kwargs)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+        time.sleep(0.1)
+
+    def _scan(self):
+        from api.scheduling import RequestContext, Priorities
+        with RequestContext(Priorities.BATCH):
+            self.manager.perform_request(self.server.url("/scan"))
+
+    def test_requests_are_sent_by_priority(self):
+        from api.scheduling import Priorities
+        self._start(self.manager.perform_request, self.server.url("/first"))
+        self._start(self.manager.perform_request_next, 
+            self.server.url("/ticket"), priority = Priorities.PREFETCH)
+        self._start(self._scan)
+        self._start(self.manager.perform_request, self.server.url("/query"))
+        for thread in self.threads:
+            thread.join(5)
+        self.assertEquals(
+            [request[1] for request in self.server.requests],
+            ["/first", "/query", "/scan", "/ticket"])
+
+    def test_requests_of_different_priorities_are_not_coalesced(self):
+        self._start(self.manager.perform_request, self.server.url("/first"))
+        self._start(self._scan)
+        self._start(self.manager.perform_request, self.server.url("/scan"))
+        for thread in self.threads:
+            thread.join(5)
+        # The interactive request doesn't wait for the scan in the queue.
+        self.assertEquals(
+            [request[1] for request in self.server.requests],
+            ["/first", "/scan", "/scan"])
+        self.assertEquals(self.manager.coalesced_requests, 0)
+
+    def test_cancelled_request_is_not_shared(self):
+        from api.scheduling import RequestContext, Priorities
+        from api.exceptions import RequestCancelled
+        results = {}
+        def _scan(name, context):
+            with context:
+                try:
+                    results[name] = self.manager.perform_request(
+                        self.server.url("/scan"))
+                except RequestCancelled:
+                    results[name] = "cancelled"
+
+        cancelled_context = RequestContext(Priorities.BATCH)
+        self._start(self.manager.perform_request, self.server.url("/first"))
+        self._start(_scan, "cancelled", cancelled_context)
+        self._start(_scan, "waiting", RequestContext(Priorities.BATCH))
+        cancelled_context.cancel()
+        for thread in self.threads:
+            thread.join(5)
+        self.assertEquals(
+            results, {"cancelled" : "cancelled", "waiting" : "/scan"})
+        self.assertEquals(
+            [request[1] for request in self.server.requests],
+            ["/first", "/scan"])
+
+class TestRequestsManagerMetrics(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        from api.responsecache import ResponseCache
+        self.server = LocalHTTPServer()
+        self.server.add_response("/page", "content")
+        self.server.add_response("/error", "error", status = 503)
+        self.server.add_response("/sub.zip", ZIP_CONTENT)
+        self.cache = ResponseCache(
+            tempfile.mkdtemp(), ttl_rules = [(r"/cached", 60)])
+        self.manager = requestsmanager.RequestsManager(
+            "metrics_provider", backoff_base_secs = 0, cache = self.cache)
+        requestsmanager.reset_metrics()
+
+    def tearDown(self):
+        self.manager.close()
+        self.server.stop()
+        self.cache.clear()
+
+    def _get_metrics(self, endpoint):
+        return requestsmanager.get_metrics()["metrics_provider"][endpoint]
+
+    def test_requests_are_recorded(self):
+        self.manager.perform_request(self.server.url("/page"))
+        self.manager.perform_request(self.server.url("/page"), {"a" : "1"})
+        metrics = self._get_metrics("/page")
+        self.assertEquals(metrics['requests'], 2)
+        self.assertEquals(metrics['bytes_in'], len("content") * 2)
+        self.assertEquals(metrics['bytes_out'], len("a=1"))
+        self.assertEquals(metrics['latency_secs']['count'], 2)
+        self.assertEquals(metrics['queue_wait_secs']['count'], 2)
+
+    def test_retries_and_errors_are_recorded(self):
+        with self.assertRaises(ProviderUnavailable):
+            self.manager.perform_request(self.server.url("/error"))
+        metrics = self._get_metrics("/error")
+        self.assertEquals(metrics['requests'], 1)
+        self.assertEquals(metrics['retries'], 2)
+        self.assertEquals(metrics['errors'], 1)
+
+    def test_cache_is_recorded(self):
+        self.server.add_response("/cached", "cached")
+        self.manager.perform_request(self.server.url("/cached"))
+        self.manager.perform_request(self.server.url("/cached"))
+        metrics = self._get_metrics("/cached")
+        self.assertEquals(metrics['cache_misses'], 1)
+        self.assertEquals(metrics['cache_hits'], 1)
+        self.assertEquals(metrics['requests'], 1)
+
+    def test_downloads_are_recorded(self):
+        self.manager.download_file(self.server.url("/sub.zip"))
+        self.assertEquals(
+            self._get_metrics("/sub.zip")['bytes_in'], len(ZIP_CONTENT))
+
+    def test_dump_metrics(self):
+        import json
+        self.manager.perform_request(self.server.url("/page"))
+        metrics = json.loads(requestsmanager.dump_metrics())
+        self.assertEquals(metrics["metrics_provider"]["/page"]["requests"], 1)
+
+class TestManagerFactory(unittest.TestCase):
+    def tearDown(self):
+        requestsmanager.close_all_managers()
+
+    def test_concurrent_creation_returns_single_instance(self):
+        from multiprocessing.dummy import Pool
+        original_class = requestsmanager.RequestsManager
+        class SlowRequestsManager(original_class):
+            def __init__(self, **settings):
+                # Widen the window in which two threads might race.
+                time.sleep(0.2)
+                original_class.__init__(self, **settings)
+
+        requestsmanager.RequestsManager = SlowRequestsManager
+        try:
+            managers = Pool(4).map(
+                lambda idx: requestsmanager.get_manager_instance("raced"), 
+                range(4))
+        finally:
+            requestsmanager.RequestsManager = original_class
+        self.assertEquals(len(set(map(id, managers))), 1)
+
+    def test_creation_does_not_block_other_providers(self):
+        import threading
+        original_class = requestsmanager.RequestsManager
+        creating = threading.Event()
+        other_created = threading.Event()
+        waits = []
+        class BlockedRequestsManager(original_class):
+            def __init__(self, **settings):
+                creating.set()
+                waits.append(other_created.wait(5))
+                original_class.__init__(self, **settings)
+
+        requestsmanager.RequestsManager = BlockedRequestsManager
+        thread = threading.Thread(target = 
+            lambda: requestsmanager.get_manager_instance("blocked"))
+        try:
+            thread.start()
+            creating.wait(5)
+            requestsmanager.RequestsManager = original_class
+            # The other provider's manager is created while "blocked" is.
+            requestsmanager.get_manager_instance("other")
+            other_created.set()
+        finally:
+            requestsmanager.RequestsManager = original_class
+            thread.join()
+        self.assertEquals(waits, [True])
+
+    def test_close_all_managers(self):
+        manager = requestsmanager.get_manager_instance("to_close")
+        requestsmanager.close_all_managers()
+        self.assertTrue(manager.closed)
+        self.assertIsNot(
+            requestsmanager.get_manager_instance("to_close"), manager)
+
 
 def run_tests():
     test_runner = unittest.TextTestRunner(verbosity=0)
@@ -133,4 +666,20 @@ def run_tests():
         TestRequestsManagerAsyncOp))
     tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
         TestPerformRequestContent))
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestRequestsManagerSession))
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestRequestsManagerCoalescing))
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestRequestsManagerCache))
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestRequestsManagerRetries))
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestRequestsManagerDownloads))
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestRequestsManagerPriorities))
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestRequestsManagerMetrics))
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestManagerFactory))
     test_runner.run(tests)
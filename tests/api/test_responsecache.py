@@ -0,0 +1,91 @@
+from api import responsecache
+from api.responsecache import ResponseCache
+
+import os
+import time
+import shutil
+import doctest
+import unittest
+import tempfile
+
+TTL_RULES = [(r"a\.com/never", 0), (r"a\.com/short", 0.2), (r"a\.com/", 60)]
+
+
+class TestResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = ResponseCache(self.directory, ttl_rules = TTL_RULES)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_put_and_get(self):
+        self.cache.put("http://a.com/page", "", "content", {"ETag" : "1"})
+        entry = self.cache.get("http://a.com/page")
+        self.assertEquals(entry.content, "content")
+        self.assertEquals(entry.etag, "1")
+        self.assertTrue(entry.is_fresh)
+        self.assertIsNone(self.cache.get("http://a.com/page", {"q" : "a"}))
+
+    def test_never_cached(self):
+        self.assertIsNone(
+            self.cache.put("http://a.com/never", "", "content", {}))
+        self.assertIsNone(self.cache.get("http://a.com/never"))
+        self.assertIsNone(
+            self.cache.put("http://no.such.rule", "", "content", {}))
+
+    def test_expiration(self):
+        self.cache.put("http://a.com/short", "", "content", {})
+        time.sleep(0.3)
+        entry = self.cache.get("http://a.com/short")
+        self.assertFalse(entry.is_fresh)
+        self.cache.refresh(entry)
+        self.assertTrue(self.cache.get("http://a.com/short").is_fresh)
+
+    def test_persistent(self):
+        self.cache.put("http://a.com/page", {"q" : "a"}, "content", {})
+        other_cache = ResponseCache(self.directory, ttl_rules = TTL_RULES)
+        self.assertEquals(
+            other_cache.get("http://a.com/page", {"q" : "a"}).content, 
+            "content")
+        self.assertEquals(other_cache.stats['entries'], 1)
+
+    def test_lru_eviction(self):
+        self.cache.put("http://a.com/1", "", "a" * 1000, {})
+        entry_size = self.cache.stats['size']
+        self.cache.max_size = entry_size * 2
+        self.cache.put("http://a.com/2", "", "a" * 1000, {})
+        # Use the first one, so the second is the least recently used.
+        self.cache.get("http://a.com/1")
+        self.cache.put("http://a.com/3", "", "a" * 1000, {})
+
+        self.assertIsNotNone(self.cache.get("http://a.com/1"))
+        self.assertIsNone(self.cache.get("http://a.com/2"))
+        self.assertIsNotNone(self.cache.get("http://a.com/3"))
+        self.assertEquals(self.cache.stats['evictions'], 1)
+        self.assertLessEqual(self.cache.stats['size'], self.cache.max_size)
+        self.assertEquals(
+            len(os.listdir(self.directory)), self.cache.stats['entries'])
+
+    def test_stats(self):
+        entry = self.cache.put("http://a.com/page", "", "content", {})
+        self.cache.record_miss()
+        self.cache.record_hit(entry)
+        self.cache.record_hit(entry, revalidated = True)
+        stats = self.cache.stats
+        self.assertEquals(stats['misses'], 1)
+        self.assertEquals(stats['hits'], 2)
+        self.assertEquals(stats['revalidations'], 1)
+        self.assertEquals(stats['bytes_saved'], len("content") * 2)
+        self.cache.reset_stats()
+        self.assertEquals(self.cache.stats['hits'], 0)
+
+
+def run_tests():
+    test_runner = unittest.TextTestRunner(verbosity=0)
+    tests = doctest.DocTestSuite(
+        responsecache, 
+        optionflags=doctest.NORMALIZE_WHITESPACE|doctest.ELLIPSIS)
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestResponseCache))
+    test_runner.run(tests)
@@ -0,0 +1,101 @@
+from api import retrypolicy
+from api.retrypolicy import RetryPolicy, RetryBudget, CircuitBreaker
+from api.retrypolicy import CircuitStates, call_with_retries
+from api.exceptions import ProviderUnavailable
+
+import time
+import doctest
+import unittest
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_delay_is_capped(self):
+        policy = RetryPolicy(base_delay_secs = 1, max_delay_secs = 2)
+        for attempt in range(1, 10):
+            self.assertTrue(0 <= policy.get_delay(attempt) <= 2)
+
+    def test_budget_is_shared_between_requests(self):
+        policy = RetryPolicy(
+            max_attempts = 5, budget = RetryBudget(ratio = 0, min_retries = 2))
+        self.assertTrue(policy.can_retry(1))
+        self.assertTrue(policy.can_retry(1))
+        self.assertFalse(policy.can_retry(1))
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(failure_threshold = 2, cooldown_secs = 0.2)
+
+    def _open(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+
+    def test_success_resets_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEquals(self.breaker.state, CircuitStates.CLOSED)
+
+    def test_half_open_allows_single_probe(self):
+        self._open()
+        self.assertFalse(self.breaker.is_available)
+        time.sleep(0.2)
+        self.assertEquals(self.breaker.state, CircuitStates.HALF_OPEN)
+        self.assertTrue(self.breaker.allow_request())
+        self.assertFalse(self.breaker.allow_request())
+
+    def test_failed_probe_opens_again(self):
+        self._open()
+        time.sleep(0.2)
+        self.assertTrue(self.breaker.allow_request())
+        self.breaker.record_failure()
+        self.assertEquals(self.breaker.state, CircuitStates.OPEN)
+
+    def test_successful_probe_closes(self):
+        self._open()
+        time.sleep(0.2)
+        self.assertTrue(self.breaker.allow_request())
+        self.breaker.record_success()
+        self.assertEquals(self.breaker.state, CircuitStates.CLOSED)
+
+
+class TestCallWithRetries(unittest.TestCase):
+    def setUp(self):
+        self.policy = RetryPolicy(max_attempts = 3, base_delay_secs = 0)
+        self.breaker = CircuitBreaker(failure_threshold = 1)
+        self.calls_count = 0
+
+    def _failing_call(self):
+        self.calls_count += 1
+        raise IOError("failed")
+
+    def test_last_exception_is_raised(self):
+        with self.assertRaises(IOError):
+            call_with_retries(self._failing_call, self.policy, self.breaker)
+        self.assertEquals(self.calls_count, 3)
+        self.assertEquals(self.breaker.state, CircuitStates.OPEN)
+
+    def test_not_retryable_exception_is_not_retried(self):
+        with self.assertRaises(IOError):
+            call_with_retries(
+                self._failing_call, self.policy, self.breaker, (ValueError,))
+        self.assertEquals(self.calls_count, 1)
+        self.assertEquals(self.breaker.state, CircuitStates.CLOSED)
+
+    def test_open_circuit_fails_fast(self):
+        self.breaker.record_failure()
+        with self.assertRaises(ProviderUnavailable):
+            call_with_retries(self._failing_call, self.policy, self.breaker)
+        self.assertEquals(self.calls_count, 0)
+
+
+def run_tests():
+    test_runner = unittest.TextTestRunner(verbosity=0)
+    tests = doctest.DocTestSuite(retrypolicy)
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestRetryPolicy))
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestCircuitBreaker))
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestCallWithRetries))
+    test_runner.run(tests)
@@ -0,0 +1,46 @@
+from api import scheduling
+from api.scheduling import Priorities, RequestContext, get_current_context
+
+import doctest
+import unittest
+from threading import Thread
+
+
+class TestRequestContext(unittest.TestCase):
+    def test_nested_contexts(self):
+        outer = RequestContext(Priorities.BATCH)
+        inner = RequestContext(Priorities.PREFETCH)
+        with outer:
+            with inner:
+                self.assertIs(get_current_context(), inner)
+            self.assertIs(get_current_context(), outer)
+
+    def test_context_is_per_thread(self):
+        contexts = []
+        def other_thread():
+            contexts.append(get_current_context())
+        with RequestContext(Priorities.BATCH):
+            thread = Thread(target=other_thread)
+            thread.start()
+            thread.join()
+        self.assertEquals(contexts[0].priority, Priorities.INTERACTIVE)
+
+    def test_cancel_wakes_registered_controllers(self):
+        class Controller(object):
+            woken = False
+            def wake_waiters(self):
+                self.woken = True
+        controller = Controller()
+        context = RequestContext()
+        context.register_controller(controller)
+        context.cancel()
+        self.assertTrue(context.cancelled)
+        self.assertTrue(controller.woken)
+
+
+def run_tests():
+    test_runner = unittest.TextTestRunner(verbosity=0)
+    tests = doctest.DocTestSuite(scheduling)
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestRequestContext))
+    test_runner.run(tests)
@@ -0,0 +1,83 @@
+from api import singleflight
+from api.singleflight import SingleFlight
+
+import time
+import doctest
+import unittest
+from multiprocessing.dummy import Pool
+
+NUMBER_OF_THREADS = 4
+
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.group = SingleFlight()
+        self.calls_count = 0
+
+    def _slow_call(self, value):
+        self.calls_count += 1
+        time.sleep(0.5)
+        return value
+
+    def test_concurrent_calls_are_coalesced(self):
+        results = Pool(NUMBER_OF_THREADS).map(
+            lambda idx: self.group.do("key", self._slow_call, "value"),
+            range(NUMBER_OF_THREADS))
+        self.assertEquals(results, ["value"] * NUMBER_OF_THREADS)
+        self.assertEquals(self.calls_count, 1)
+        self.assertEquals(self.group.coalesced, NUMBER_OF_THREADS - 1)
+
+    def test_different_keys_are_not_coalesced(self):
+        results = Pool(NUMBER_OF_THREADS).map(
+            lambda idx: self.group.do(idx, self._slow_call, idx),
+            range(NUMBER_OF_THREADS))
+        self.assertEquals(results, range(NUMBER_OF_THREADS))
+        self.assertEquals(self.calls_count, NUMBER_OF_THREADS)
+
+    def test_sequential_calls_are_executed(self):
+        self.group.do("key", self._slow_call, "value")
+        self.group.do("key", self._slow_call, "value")
+        self.assertEquals(self.calls_count, 2)
+
+    def test_exception_is_shared(self):
+        def _failing_call():
+            time.sleep(0.5)
+            raise ValueError("failed")
+
+        def _call(idx):
+            try:
+                self.group.do("key", _failing_call)
+            except ValueError as eX:
+                return str(eX)
+
+        results = Pool(NUMBER_OF_THREADS).map(_call, range(NUMBER_OF_THREADS))
+        self.assertEquals(results, ["failed"] * NUMBER_OF_THREADS)
+
+    def test_unshared_exception_is_retried(self):
+        group = SingleFlight(unshared_errors = [KeyError])
+        def _call_once_failing():
+            self.calls_count += 1
+            time.sleep(0.5)
+            if self.calls_count == 1:
+                raise KeyError("cancelled")
+            return "value"
+
+        def _call(idx):
+            try:
+                return group.do("key", _call_once_failing)
+            except KeyError:
+                return "cancelled"
+
+        results = Pool(NUMBER_OF_THREADS).map(_call, range(NUMBER_OF_THREADS))
+        self.assertEquals(sorted(results), 
+            ["cancelled"] + ["value"] * (NUMBER_OF_THREADS - 1))
+        self.assertEquals(self.calls_count, 2)
+        self.assertEquals(group.coalesced, NUMBER_OF_THREADS - 2)
+
+
+def run_tests():
+    test_runner = unittest.TextTestRunner(verbosity=0)
+    tests = doctest.DocTestSuite(singleflight)
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestSingleFlight))
+    test_runner.run(tests)
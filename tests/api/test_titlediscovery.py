@@ -1,4 +1,7 @@
 from api import titlediscovery
+from api.providers.opensubtitles import OpenSubtitlesProvider
+from api.languages import Languages
+from helpers import FakeOpenSubtitlesManager
 
 import doctest
 from hashlib import sha1
@@ -59,6 +62,79 @@ class TestTitleDiscovery(unittest.TestCase):
         self.assertIsNone(title)
 
 
+class TestDiscoverTitlesFromFilePaths(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        series_directory = os.path.join(self.directory, "Alien")
+        os.mkdir(series_directory)
+        self.file_paths = [
+            self._create_file(self.directory, "first.avi", "a"),
+            self._create_file(self.directory, "second.avi", "a"),
+            self._create_file(series_directory, "unknown1.avi", "b"),
+            self._create_file(series_directory, "unknown2.avi", "c"),
+        ]
+        self.manager = FakeOpenSubtitlesManager(details = {
+            "133093" : {
+                "kind" : "movie", "title" : "The Matrix", "year" : "1999", 
+                "id" : "0133093"},
+            "78748" : {
+                "kind" : "movie", "title" : "Alien", "year" : "1979", 
+                "id" : "0078748"}},
+            queries = {"Alien" : [{"IDMovieImdb" : "78748"}]})
+        provider = OpenSubtitlesProvider([Languages.ENGLISH], self.manager)
+        file_hash, file_size = provider.calculate_file_hash(self.file_paths[0])
+        self.manager.hashes = {file_hash : "133093"}
+        self._original_get_os_provider = titlediscovery._get_os_provider
+        titlediscovery._get_os_provider = lambda: provider
+
+    def tearDown(self):
+        import shutil
+        titlediscovery._get_os_provider = self._original_get_os_provider
+        shutil.rmtree(self.directory)
+
+    def _create_file(self, directory, file_name, content):
+        file_path = os.path.join(directory, file_name)
+        with open(file_path, "wb") as movie_file:
+            movie_file.write(content * 200000)
+        return file_path
+
+    def test_titles_are_discovered_together(self):
+        titles = titlediscovery.discover_titles_from_file_paths(
+            self.file_paths)
+        self.assertEquals(
+            [titles[file_path].name for file_path in self.file_paths],
+            ["The Matrix", "The Matrix", "Alien", "Alien"])
+        calls = [name for name, args in self.manager.calls]
+        self.assertEquals(calls.count("CheckMovieHash2"), 1)
+        # The directory name query is sent once for both unknown files.
+        self.assertEquals(
+            [args["query"] for name, args in self.manager.calls 
+             if name == "SearchSubtitles"],
+            ["unknown1", "Alien", "unknown2"])
+        self.assertEquals(calls.count("GetIMDBMovieDetails"), 2)
+
+    def test_releases_of_an_episode_share_the_query(self):
+        self.manager.details["636294"] = {
+            "kind" : "episode", "title" : '"Lost" Tabula Rasa', 
+            "year" : "2004", "id" : "0636294", "season" : "1", 
+            "episode" : "3", "episodeof" : {"_411008" : "Lost"}}
+        self.manager.queries["Lost S01E03 720p HDTV-A"] = [
+            {"IDMovieImdb" : "636294"}]
+        file_paths = [
+            self._create_file(self.directory, "Lost.S01E03.720p.HDTV-A.avi", 
+                "d"),
+            self._create_file(self.directory, "lost s01e03 1080p-B.avi", "e")]
+        titles = titlediscovery.discover_titles_from_file_paths(file_paths)
+        self.assertEquals(
+            [titles[file_path].episode_name for file_path in file_paths],
+            ["Tabula Rasa", "Tabula Rasa"])
+        self.assertEquals(
+            [args["query"] for name, args in self.manager.calls 
+             if name == "SearchSubtitles"],
+            ["Lost S01E03 720p HDTV-A"])
+
+
 def hash_matches():
     sha1_val = sha1(open(PATH_TO_MOVIE_FILE, "rb").read()).hexdigest()
     return sha1_val == MOVIE_FILE_SHA1
@@ -70,4 +146,6 @@ def run_tests():
         optionflags=doctest.NORMALIZE_WHITESPACE|doctest.ELLIPSIS)
     tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
         TestTitleDiscovery))
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestDiscoverTitlesFromFilePaths))
     test_runner.run(tests)
\ No newline at end of file
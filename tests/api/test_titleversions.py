@@ -284,6 +284,26 @@ class TestTitleVersions(unittest.TestCase):
         name_to_len = {"The Matrix" : 3, "Titanic" : 2, "Gladiator" : 1}
         for title, versions in titles_versions.iter_title_versions():
             self.assertEquals(len(versions), name_to_len[title.name])
+    def test_get_top_versions(self):
+        titles_versions = TitlesVersions()
+        low = ProviderVersion([], MovieTitle("The Matrix"), Languages.HEBREW,
+            MockedProvider(), rank=20)
+        high = ProviderVersion([], MovieTitle("Titanic"), Languages.HEBREW,
+            MockedProvider(), rank=90)
+        second_provider = ProviderVersion([], MovieTitle("The Matrix"),
+            Languages.HEBREW, MockedProvider(), rank=50)
+        first_provider = ProviderVersion([], MovieTitle("The Matrix"),
+            Languages.ENGLISH, MockedProvider(), rank=50)
+        titles_versions.add_version(low)
+        titles_versions.add_version(second_provider, 2)
+        titles_versions.add_version(high)
+        titles_versions.add_version(first_provider, 1)
+
+        self.assertEqual(titles_versions.get_top_versions(3),
+            [high, first_provider, second_provider])
+        self.assertEqual(titles_versions.get_top_versions(10),
+            [high, first_provider, second_provider, low])
+        self.assertEqual(TitlesVersions().get_top_versions(3), [])
 
 def run_tests():
     unittest.TextTestRunner(verbosity=0).run(
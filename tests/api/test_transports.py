@@ -0,0 +1,116 @@
+from api import transports
+from api.requestsmanager import RequestsManager
+from api.transports import FixtureArchive, RecordTransport, ReplayTransport
+from helpers import LocalHTTPServer
+
+import os
+import time
+import doctest
+import tempfile
+import unittest
+
+SRT_CONTENT = "1\r\n00:00:01,000 --> 00:00:02,000\r\nHello\r\n"
+
+
+class TestRecordReplay(unittest.TestCase):
+    def setUp(self):
+        self.server = LocalHTTPServer()
+        self.server.add_response("/page", "content", 
+            headers = {"X-Header" : "value"})
+        self.server.add_response("/post", "posted")
+        self.server.add_response("/sub.srt", SRT_CONTENT)
+        file_descriptor, self.file_path = tempfile.mkstemp()
+        os.close(file_descriptor)
+        os.remove(self.file_path)
+
+    def tearDown(self):
+        self.server.stop()
+        if os.path.exists(self.file_path):
+            os.remove(self.file_path)
+
+    def _record(self, func):
+        archive = FixtureArchive(self.file_path)
+        with RequestsManager(transport = RecordTransport(archive)) as manager:
+            func(manager)
+        archive.save()
+        return archive
+
+    def _replay(self, latency_secs = 0):
+        return RequestsManager(
+            transport = ReplayTransport(
+                FixtureArchive(self.file_path), latency_secs),
+            max_attempts = 1)
+
+    def test_replay_without_network(self):
+        self._record(lambda manager: manager.perform_request(
+            self.server.url("/page")))
+        self.server.stop()
+        with self._replay() as manager:
+            self.assertEquals(
+                manager.perform_request(
+                    self.server.url("/page"), response_headers = ["X-Header"]),
+                ("content", {"X-Header" : "value"}))
+
+    def test_post_body_is_matched(self):
+        self._record(lambda manager: manager.perform_request(
+            self.server.url("/post"), {"b" : "1", "a" : "2"}))
+        with self._replay() as manager:
+            self.assertEquals(manager.perform_request(
+                self.server.url("/post"), {"a" : "2", "b" : "1"}), "posted")
+            self.assertEquals(manager.perform_request(
+                self.server.url("/post"), {"a" : "3"}), "")
+        self.assertEquals(len(self.server.requests), 1)
+
+    def test_responses_are_replayed_in_order(self):
+        def record(manager):
+            manager.perform_request(self.server.url("/page"))
+            self.server.add_response("/page", "changed")
+            manager.perform_request(self.server.url("/page"))
+        self._record(record)
+        with self._replay() as manager:
+            responses = [
+                manager.perform_request(self.server.url("/page"))
+                for idx in range(3)]
+        self.assertEquals(responses, ["content", "changed", "changed"])
+
+    def test_download_is_replayed(self):
+        self._record(lambda manager: manager.download_file(
+            self.server.url("/sub.srt")))
+        with self._replay() as manager:
+            self.assertEquals(
+                manager.download_file(self.server.url("/sub.srt")),
+                ("sub.srt", SRT_CONTENT))
+
+    def test_missing_fixture(self):
+        self._record(lambda manager: None)
+        with self._replay() as manager:
+            self.assertEquals(
+                manager.perform_request(self.server.url("/page")), "")
+        self.assertEquals(self.server.requests, [])
+
+    def test_records_are_listed_in_order(self):
+        def record(manager):
+            manager.perform_request(self.server.url("/page"))
+            manager.perform_request(self.server.url("/post"), {"a" : "1"})
+        self._record(record)
+        records = FixtureArchive(self.file_path).get_records()
+        self.assertEquals(
+            [(record.method, record.body, record.content) 
+             for record in records],
+            [("GET", "", "content"), ("POST", "a=1", "posted")])
+
+    def test_simulated_latency(self):
+        self._record(lambda manager: manager.perform_request(
+            self.server.url("/page")))
+        with self._replay(latency_secs = 0.2) as manager:
+            start_time = time.time()
+            manager.perform_request(self.server.url("/page"))
+            self.assertTrue(time.time() - start_time >= 0.2)
+
+
+def run_tests():
+    test_runner = unittest.TextTestRunner(verbosity=0)
+    tests = doctest.DocTestSuite(transports)
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestRecordReplay))
+    test_runner.run(tests)
@@ -0,0 +1,145 @@
+from api import xmlrpctransport
+from api.xmlrpctransport import SessionTransport
+from api.xmlrpctransport import CompactRow
+
+import socket
+import doctest
+import unittest
+import threading
+import xmlrpclib
+from xmlrpclib import ServerProxy
+
+LARGE_VALUE = "row " * 10000
+SEARCH_REQUEST_BODY = xmlrpclib.dumps(("token", []), "SearchSubtitles")
+
+
+def create_rows(rows_count, fields_count = 60):
+    """ Rows in the format of SearchSubtitles's results. """
+    return [
+        dict([("Field%d" % idx, "value %d" % idx)
+              for idx in range(fields_count)] +
+             [("MovieName", "Movie %d" % row_idx),
+              ("QueryParameters", {"query" : "movie"})])
+        for row_idx in range(rows_count)]
+
+
+class LocalXmlRpcServer(object):
+    """
+    An xml-rpc server that keeps the connections alive, and records the port
+    and the encoding of each response it sends.
+    """
+    def __init__(self):
+        from SimpleXMLRPCServer import SimpleXMLRPCServer
+        from SimpleXMLRPCServer import SimpleXMLRPCRequestHandler
+
+        server = self
+        self.ports = []
+        self.encodings = []
+
+        class Handler(SimpleXMLRPCRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                server.ports.append(self.client_address[1])
+                server.encodings.append(self.accept_encodings().keys())
+                SimpleXMLRPCRequestHandler.do_POST(self)
+
+        self._server = SimpleXMLRPCServer(
+            ("127.0.0.1", 0), Handler, logRequests = False)
+        self._server.register_function(lambda value: value, 'Echo')
+        self._server.register_function(
+            lambda token, queries: {
+                'status' : '200 OK', 'data' : create_rows(3), 'seconds' : 0.1},
+            'SearchSubtitles')
+        thread = threading.Thread(target = self._server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = "http://127.0.0.1:%d/RPC2" % self._server.server_address[1]
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class TestSessionTransport(unittest.TestCase):
+    def setUp(self):
+        import requests
+        self.server = LocalXmlRpcServer()
+        self.session = requests.Session()
+        self.transport = SessionTransport(
+            lambda: self.session, 5, "subit-tests")
+        self.proxy = ServerProxy(self.server.url, self.transport)
+
+    def tearDown(self):
+        self.session.close()
+        self.server.stop()
+
+    def test_connection_is_kept_alive(self):
+        for idx in range(3):
+            self.assertEquals(self.proxy.Echo(idx), idx)
+        self.assertEquals(len(set(self.server.ports)), 1)
+
+    def test_gzipped_response(self):
+        self.assertEquals(self.proxy.Echo(LARGE_VALUE), LARGE_VALUE)
+        self.assertIn("gzip", self.server.encodings[0])
+        bytes_in, bytes_out = self.transport.pop_transferred()
+        # The response was compressed on the wire.
+        self.assertLess(bytes_in, len(LARGE_VALUE) / 10)
+        self.assertGreater(bytes_out, len(LARGE_VALUE))
+        self.assertEquals(self.transport.pop_transferred(), (0, 0))
+
+    def test_default_timeout_is_untouched(self):
+        self.proxy.Echo(1)
+        self.assertIsNone(socket.getdefaulttimeout())
+
+    def test_rows_hold_only_the_declared_fields(self):
+        self.transport.set_row_fields(
+            "SearchSubtitles", ["MovieName", "QueryParameters", "Missing"])
+        response = self.proxy.SearchSubtitles("token", [])
+        self.assertEquals(response['status'], '200 OK')
+        self.assertEquals(len(response['data']), 3)
+        row = response['data'][0]
+        self.assertIsInstance(row, CompactRow)
+        self.assertEquals(row, {
+            "MovieName" : "Movie 0", "QueryParameters" : {"query" : "movie"}})
+        self.assertNotIn("Field1", row)
+        self.assertNotIn("Missing", row)
+        self.assertIsNone(row.get("Missing"))
+        self.assertRaises(KeyError, lambda: row["Field1"])
+
+    def test_rows_of_other_methods_are_untouched(self):
+        self.transport.set_row_fields("SearchSubtitles", ["MovieName"])
+        value = {"data" : [{"MovieName" : "Alien", "MovieYear" : "1979"}]}
+        self.assertEquals(self.proxy.Echo(value), value)
+        self.transport.set_row_fields("Echo", [])
+        self.assertEquals(self.proxy.Echo(value), value)
+
+    def test_response_is_parsed_incrementally(self):
+        self.transport.set_row_fields("SearchSubtitles", ["MovieName"])
+        content = xmlrpclib.dumps(
+            ({'status' : '200 OK', 'data' : create_rows(20)},),
+            methodresponse = True)
+        parser, unmarshaller = self.transport._get_parser(SEARCH_REQUEST_BODY)
+        for idx in range(0, len(content), 7):
+            parser.feed(content[idx:idx + 7])
+        parser.close()
+        response = unmarshaller.close()[0]
+        self.assertEquals(
+            [row["MovieName"] for row in response['data']],
+            ["Movie %d" % idx for idx in range(20)])
+
+    def test_fault(self):
+        self.transport.set_row_fields("SearchSubtitles", ["MovieName"])
+        content = xmlrpclib.dumps(xmlrpclib.Fault(1, "failed"))
+        parser, unmarshaller = self.transport._get_parser(SEARCH_REQUEST_BODY)
+        parser.feed(content)
+        parser.close()
+        self.assertRaises(xmlrpclib.Fault, unmarshaller.close)
+
+
+def run_tests():
+    test_runner = unittest.TextTestRunner(verbosity=0)
+    tests = doctest.DocTestSuite(xmlrpctransport)
+    tests.addTests(unittest.defaultTestLoader.loadTestsFromTestCase(
+        TestSessionTransport))
+    test_runner.run(tests)